@@ -226,24 +226,12 @@ class OpenPowerDataset(TimeSeriesDataset):
         Returns:
             pd.DataFrame: The validated dataset with invalid rows removed.
         """
-        valid_rows = []
-
-        for idx, row in data.iterrows():
-            is_valid = True
-            for col in self.time_series_column_names:
-                arr = row[col]
-                # Check that the shape is either (seq_len,) or (seq_len, 1)
-                if arr.ndim == 1 and len(arr) == self.cfg.seq_len:
-                    continue  # Shape is valid
-                elif arr.ndim == 2 and arr.shape == (self.cfg.seq_len, 1):
-                    continue  # Shape is valid
-                else:
-                    is_valid = False
-                    break
-
-            if is_valid:
-                valid_rows.append(row)
-
-        # Create a new DataFrame with only valid rows
-        validated_data = pd.DataFrame(valid_rows, columns=data.columns)
+        # Each entry must have shape (seq_len,) or (seq_len, 1)
+        valid_shapes = [(self.cfg.seq_len,), (self.cfg.seq_len, 1)]
+        is_valid = np.ones(len(data), dtype=bool)
+        for col in self.time_series_column_names:
+            is_valid &= data[col].map(np.shape).isin(valid_shapes).to_numpy()
+
+        # Keep only valid rows
+        validated_data = data[is_valid]
         return validated_data
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 import warnings
 from typing import Dict, List, Tuple, Union
@@ -39,8 +41,12 @@ class PecanStreetDataset(TimeSeriesDataset):
         self.normalize = cfg.normalize
         self.threshold = (-1 * int(cfg.threshold), int(cfg.threshold))
         self.include_generation = cfg.include_generation
-        self._load_data()
-        self._set_user_flags()
+        self._cached_data = self._read_cache() if self.cfg.cache else None
+        if self._cached_data is not None:
+            self.data = self._cached_data
+        else:
+            self._load_data()
+            self._set_user_flags()
 
         time_series_column_names = ["grid"]
 
@@ -63,12 +69,98 @@ class PecanStreetDataset(TimeSeriesDataset):
             normalization_group_keys=normalization_group_keys,
         )
 
+    def _csv_dir(self) -> str:
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        return os.path.normpath(os.path.join(module_dir, "..", self.cfg.path))
+
+    def _data_file_paths(self) -> List[str]:
+        """
+        Paths of the 15 minute data csv files for the configured geography.
+        """
+        path = self._csv_dir()
+        if self.geography:
+            return [os.path.join(path, f"15minute_data_{self.geography}.csv")]
+        return [
+            os.path.join(path, "15minute_data_newyork.csv"),
+            os.path.join(path, "15minute_data_california.csv"),
+            os.path.join(path, "15minute_data_austin.csv"),
+        ]
+
+    def _cache_path(self) -> str:
+        """
+        Path prefix of the preprocessed data cache. The key covers every setting that
+        affects preprocessing as well as the size and modification time of the csv
+        files, so edited data or settings never hit a stale cache.
+        """
+        source_files = [
+            os.path.join(self._csv_dir(), "metadata.csv")
+        ] + self._data_file_paths()
+        key = {
+            "files": [
+                (os.path.basename(f), os.path.getsize(f), os.stat(f).st_mtime_ns)
+                for f in source_files
+            ],
+            "settings": OmegaConf.to_container(
+                OmegaConf.masked_copy(
+                    self.cfg,
+                    [
+                        "geography",
+                        "data_columns",
+                        "metadata_columns",
+                        "seq_len",
+                        "include_generation",
+                        "user_id",
+                        "user_group",
+                    ],
+                )
+            ),
+        }
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return os.path.join(ROOT_DIR, "data", self.name, "cache", digest[:16])
+
+    def _read_cache(self) -> Union[pd.DataFrame, None]:
+        """
+        Loads the preprocessed data written by `_write_cache`, if there is any for the
+        current csv files and settings.
+        """
+        try:
+            path = self._cache_path()
+        except FileNotFoundError:
+            return None
+        if not os.path.exists(path + ".pkl"):
+            return None
+
+        data = pd.read_pickle(path + ".pkl")
+        with np.load(path + ".npz") as arrays:
+            for column in arrays.files:
+                data[column] = list(arrays[column])
+        return data
+
+    def _write_cache(self, data: pd.DataFrame):
+        """
+        Stores the preprocessed data. Time series columns in which every row is an
+        array are stacked into one binary array each, the rest goes into a pickle.
+        """
+        path = self._cache_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        array_columns = [
+            column
+            for column in ("grid", "solar")
+            if column in data
+            and data[column].map(lambda v: isinstance(v, np.ndarray)).all()
+        ]
+        # Written under temporary names first, so readers never see a partial cache
+        with open(path + ".npz.tmp", "wb") as f:
+            np.savez(f, **{c: np.stack(data[c].to_numpy()) for c in array_columns})
+        data.drop(columns=array_columns).to_pickle(path + ".pkl.tmp")
+        os.replace(path + ".npz.tmp", path + ".npz")
+        os.replace(path + ".pkl.tmp", path + ".pkl")
+
     def _load_data(self) -> pd.DataFrame:
         """
         Loads the csv files into a pandas dataframe object.
         """
-        module_dir = os.path.dirname(os.path.abspath(__file__))
-        path = os.path.normpath(os.path.join(module_dir, "..", self.cfg.path))
+        path = self._csv_dir()
         metadata_csv_path = os.path.join(path, "metadata.csv")
 
         if not os.path.exists(metadata_csv_path):
@@ -82,17 +174,12 @@ class PecanStreetDataset(TimeSeriesDataset):
             self.metadata.rename(columns={"solar": "has_solar"}, inplace=True)
 
         if self.geography:
-            data_file_name = f"15minute_data_{self.geography}.csv"
-            data_file_path = os.path.join(path, data_file_name)
+            (data_file_path,) = self._data_file_paths()
             if not os.path.exists(data_file_path):
                 raise FileNotFoundError(f"Data file not found at {data_file_path}")
             self.data = pd.read_csv(data_file_path)[self.cfg.data_columns]
         else:
-            data_files = [
-                os.path.join(path, "15minute_data_newyork.csv"),
-                os.path.join(path, "15minute_data_california.csv"),
-                os.path.join(path, "15minute_data_austin.csv"),
-            ]
+            data_files = self._data_file_paths()
             for data_file in data_files:
                 if not os.path.exists(data_file):
                     raise FileNotFoundError(f"Data file not found at {data_file}")
@@ -111,6 +198,11 @@ class PecanStreetDataset(TimeSeriesDataset):
         Returns:
             pd.DataFrame: The preprocessed data.
         """
+        if self._cached_data is not None:
+            # Handed over once, so the raw frame is not kept alive alongside self.data
+            data, self._cached_data = self._cached_data, None
+            return data
+
         data["local_15min"] = pd.to_datetime(data["local_15min"], utc=True)
         data["month"] = data["local_15min"].dt.month_name()
         data["weekday"] = data["local_15min"].dt.day_name()
@@ -139,6 +231,8 @@ class PecanStreetDataset(TimeSeriesDataset):
         data = self._get_user_group_data(data)
         data = self._handle_missing_data(data)
         grouped_data.sort_values(by=["month", "weekday", "date_day"], inplace=True)
+        if self.cfg.cache:
+            self._write_cache(data)
         return data
 
     def _preprocess_solar(self, data: pd.DataFrame) -> pd.DataFrame:
@@ -176,10 +270,11 @@ class PecanStreetDataset(TimeSeriesDataset):
         """
         Sets user flags indicating whether a user has solar generation data.
         """
+        has_solar = (
+            self.metadata["has_solar"].notna().groupby(self.metadata["dataid"]).any()
+        )
         self.user_flags = {
-            user_id: self.metadata.loc[self.metadata["dataid"] == user_id]["has_solar"]
-            .notna()
-            .any()
+            user_id: bool(has_solar.get(user_id, False))
             for user_id in self.data["dataid"].unique()
         }
 
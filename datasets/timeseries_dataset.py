@@ -10,7 +10,7 @@ from hydra import compose, initialize_config_dir
 from sklearn.cluster import KMeans
 from torch.utils.data import Dataset
 
-from datasets.utils import encode_conditioning_variables
+from datasets.utils import encode_conditioning_variables, stack_timeseries
 from generator.normalizer import Normalizer
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -24,6 +24,7 @@ class TimeSeriesDataset(Dataset, ABC):
         seq_len: int,
         normalization_group_keys: List = [],
         conditioning_var_column_names: Any = None,
+        entity_column_name: str = None,
         normalize: bool = True,
         scale: bool = True,
         cluster_n_clusters: int = 10,  # Number of clusters for K-Means
@@ -40,6 +41,9 @@ class TimeSeriesDataset(Dataset, ABC):
             else [time_series_column_names]
         )
         self.conditioning_vars = conditioning_var_column_names or []
+        # Identifies the user of each row. As a conditioning variable, it is encoded by
+        # category instead of binned, so a single model is conditioned on every user
+        self.entity_column_name = entity_column_name
         self.seq_len = seq_len
         self.cluster_n_clusters = cluster_n_clusters
         self.cluster_features = cluster_features or ["mean", "std", "max", "min"]
@@ -91,6 +95,10 @@ class TimeSeriesDataset(Dataset, ABC):
         self.data = self.get_clustering_based_rarity()
         self.data = self.get_combined_rarity()
 
+        # Built before any loader worker is forked, so the workers share them
+        self.timeseries_tensor
+        self.conditioning_array
+
     @abstractmethod
     def _preprocess_data(self):
         """
@@ -103,11 +111,12 @@ class TimeSeriesDataset(Dataset, ABC):
         return len(self.data)
 
     def __getitem__(self, idx):
-        sample = self.data.iloc[idx]
-        timeseries = torch.tensor(sample["timeseries"], dtype=torch.float32)
+        # Views into arrays built once from self.data, so no DataFrame row is looked up
+        # per sample
+        timeseries = self.timeseries_tensor[idx]
+        codes = torch.from_numpy(self.conditioning_array)[:, idx]
         conditioning_vars_dict = {
-            var: torch.tensor(sample[var], dtype=torch.long)
-            for var in self.conditioning_vars
+            var: codes[i] for i, var in enumerate(self.conditioning_vars)
         }
         return timeseries, conditioning_vars_dict
 
@@ -159,13 +168,13 @@ class TimeSeriesDataset(Dataset, ABC):
                 f"The following time series columns are missing from the DataFrame: {missing_cols}"
             )
         for col_name in self.time_series_column_names:
+            # Collect the (seq_len, 1) arrays and write the column back at once
+            arrays = []
             for idx, arr in df[col_name].items():
                 if not isinstance(arr, np.ndarray):
                     arr = np.array(arr)
-                    df.at[idx, col_name] = arr
                 if arr.ndim == 1:
                     arr = arr.reshape(-1, 1)
-                    df.at[idx, col_name] = arr
                 elif arr.ndim == 2:
                     if arr.shape[0] != self.seq_len:
                         raise ValueError(
@@ -182,13 +191,16 @@ class TimeSeriesDataset(Dataset, ABC):
                         f"Array in column '{col_name}' at index {idx} must have shape ({self.seq_len}, 1), "
                         f"but has shape {arr.shape}."
                     )
-
-        def merge_row(row):
-            arrays = [row[col_name] for col_name in self.time_series_column_names]
-            merged_array = np.hstack(arrays)  # Shape: (seq_len, n_dim)
-            return merged_array
-
-        df["timeseries"] = df.apply(merge_row, axis=1)
+                arrays.append(arr)
+            df[col_name] = arrays
+
+        # Shape: (seq_len, n_dim) per row
+        df["timeseries"] = [
+            np.hstack(arrays)
+            for arrays in zip(
+                *(df[col_name] for col_name in self.time_series_column_names)
+            )
+        ]
         df = df.drop(columns=self.time_series_column_names)
         return df
 
@@ -299,6 +311,47 @@ class TimeSeriesDataset(Dataset, ABC):
         else:
             return stats
 
+    def _row_normalization_stats(
+        self, data: pd.DataFrame, column: str
+    ) -> Dict[str, Any]:
+        """
+        Looks up the normalization statistics of a column for every row, resolving each
+        normalization group once instead of once per row.
+
+        Args:
+            data (pd.DataFrame): The rows to look up statistics for.
+            column (str): The time series column the statistics belong to.
+
+        Returns:
+            Dict[str, Any]: "mean", "std" and, if scaling, "z_min" and "z_max", each either a
+            scalar or an array of shape (n_rows, 1) that broadcasts against the stacked series
+            flattened to one row per time series.
+        """
+        names = ["mean", "std", "z_min", "z_max"] if self.cfg.scale else ["mean", "std"]
+        column_stats = self.normalization_stats[column]
+        if not self.normalization_group_keys:
+            return {name: column_stats[name] for name in names}
+
+        codes, group_keys = pd.MultiIndex.from_frame(
+            data[self.normalization_group_keys]
+        ).factorize()
+        group_stats = []
+        for group_key in group_keys:
+            stats = column_stats.get(group_key)
+            if not stats:
+                # Fallback to global stats
+                stats = column_stats.get("global")
+                if not stats:
+                    raise ValueError(
+                        f"No stats found for group {group_key} or global stats in column {column}"
+                    )
+            group_stats.append(stats)
+
+        return {
+            name: np.array([stats[name] for stats in group_stats])[codes, None]
+            for name in names
+        }
+
     def _normalize_and_scale(self, data: pd.DataFrame) -> pd.DataFrame:
         """
         Applies standardization followed by min-max scaling to the data.
@@ -309,26 +362,12 @@ class TimeSeriesDataset(Dataset, ABC):
         Returns:
             pd.DataFrame: The normalized and scaled data.
         """
-
-        def normalize_and_scale_row(row, column):
-            if self.normalization_group_keys:
-                group_key = tuple(row[key] for key in self.normalization_group_keys)
-                stats = self.normalization_stats[column].get(group_key)
-                if not stats:
-                    # Fallback to global stats
-                    stats = self.normalization_stats[column].get("global")
-                    if not stats:
-                        raise ValueError(
-                            f"No stats found for group {group_key} or global stats in column {column}"
-                        )
-            else:
-                stats = self.normalization_stats[column]
-
-            mean = stats["mean"]
-            std = stats["std"]
-
-            values = np.array(row[column])
-            standardized = (values - mean) / (std + 1e-8)
+        for column in self.time_series_column_names:
+            stats = self._row_normalization_stats(data, column)
+            values = stack_timeseries(data[column])
+            row_shape = values.shape[1:]
+            values = values.reshape(len(data), -1)
+            standardized = (values - stats["mean"]) / (stats["std"] + 1e-8)
 
             if hasattr(self, "threshold") and self.threshold:
                 standardized = np.clip(standardized, *self.threshold)
@@ -336,59 +375,36 @@ class TimeSeriesDataset(Dataset, ABC):
             if self.cfg.scale:
                 z_min = stats["z_min"]
                 z_max = stats["z_max"]
-                scaled = (standardized - z_min) / (z_max - z_min + 1e-8)
-                return scaled
-            else:
-                return standardized
-
-        for column in self.time_series_column_names:
-            data[column] = data.apply(
-                lambda row: normalize_and_scale_row(row, column), axis=1
-            )
+                standardized = (standardized - z_min) / (z_max - z_min + 1e-8)
+            data[column] = list(standardized.reshape(len(data), *row_shape))
 
         return data
 
-    def inverse_transform_column(self, row: pd.Series, column: str) -> np.ndarray:
+    def inverse_transform_column(self, data: pd.DataFrame, column: str) -> np.ndarray:
         """
         Performs inverse transformation on a normalized and optionally scaled column
         to retrieve original values.
 
         Args:
-            row (pd.Series): A row from the DataFrame that contains the normalized data.
+            data (pd.DataFrame): The rows that contain the normalized data.
             column (str): The column name of the normalized data.
 
         Returns:
-            np.ndarray: The original (un-normalized and un-scaled) time series data.
+            np.ndarray: The original (un-normalized and un-scaled) time series data, one row
+            per row of `data`.
         """
-        if self.normalization_group_keys:
-            group_key = tuple(row[key] for key in self.normalization_group_keys)
-            stats = self.normalization_stats[column].get(group_key)
-            if not stats:
-                # Fallback to global stats
-                stats = self.normalization_stats[column].get("global")
-                if not stats:
-                    raise ValueError(
-                        f"No stats found for group {group_key} or global stats in column {column}"
-                    )
-        else:
-            stats = self.normalization_stats[column]
-
-        mean = stats["mean"]
-        std = stats["std"]
+        stats = self._row_normalization_stats(data, column)
+        values = stack_timeseries(data[column])
+        row_shape = values.shape[1:]
+        values = values.reshape(len(data), -1)
 
         if self.cfg.scale:
             z_min = stats["z_min"]
             z_max = stats["z_max"]
+            values = values * (z_max - z_min + 1e-8) + z_min
 
-        values = np.array(row[column])
-
-        if self.cfg.scale:
-            scaled = values * (z_max - z_min + 1e-8) + z_min
-            unnormalized = scaled * std + mean
-        else:
-            unnormalized = values * std + mean
-
-        return unnormalized
+        unnormalized = values * stats["std"] + stats["mean"]
+        return unnormalized.reshape(len(data), *row_shape)
 
     def inverse_transform(
         self, data: pd.DataFrame, merged: bool = True
@@ -410,15 +426,78 @@ class TimeSeriesDataset(Dataset, ABC):
 
         if not self.use_learned_normalizer:
             for column in self.time_series_column_names:
-                data[column] = data.apply(
-                    lambda row: self.inverse_transform_column(row, column), axis=1
-                )
+                data[column] = list(self.inverse_transform_column(data, column))
 
         if merged:
             data = self.merge_timeseries_columns(data)
 
         return data
 
+    @property
+    def conditioning_array(self) -> np.ndarray:
+        """
+        Encoded conditioning variables as a contiguous int64 array with one row per variable,
+        ordered like `self.conditioning_vars`. Rebuilt only when `self.data` is reassigned.
+
+        Returns:
+            np.ndarray: Array of shape (n_conditioning_vars, n_samples).
+        """
+        if getattr(self, "_conditioning_array_source", None) is not self.data:
+            self._conditioning_array = np.ascontiguousarray(
+                self.data[self.conditioning_vars].to_numpy(dtype=np.int64).T
+            )
+            self._conditioning_array_source = self.data
+        return self._conditioning_array
+
+    @property
+    def timeseries_tensor(self) -> torch.Tensor:
+        """
+        Stacked time series of the dataset as a contiguous float32 tensor, from which
+        `__getitem__` indexes its samples. Rebuilt only when `self.data` is reassigned.
+
+        Returns:
+            torch.Tensor: Tensor of shape (n_samples, seq_len, n_dims).
+        """
+        if getattr(self, "_timeseries_tensor_source", None) is not self.data:
+            self._timeseries_tensor = torch.from_numpy(
+                stack_timeseries(self.data["timeseries"], np.float32)
+            )
+            self._timeseries_tensor_source = self.data
+        return self._timeseries_tensor
+
+    @property
+    def inverse_transformed_data(self) -> pd.DataFrame:
+        """
+        Inverse-transformed version of the dataset's data, computed once and reused
+        until `self.data` is reassigned.
+
+        Returns:
+            pd.DataFrame: DataFrame with the original (un-normalized and un-scaled) time series.
+        """
+        if getattr(self, "_inverse_transform_source", None) is not self.data:
+            self._inverse_transformed_data = self.inverse_transform(
+                self.data.copy(deep=False)
+            )
+            self._inverse_transform_source = self.data
+        return self._inverse_transformed_data
+
+    @property
+    def inverse_transformed_array(self) -> np.ndarray:
+        """
+        Stacked time series of `inverse_transformed_data` as a contiguous float32 array,
+        reused until the inverse-transformed data changes.
+
+        Returns:
+            np.ndarray: Array of shape (n_samples, seq_len, n_dims).
+        """
+        inverse_data = self.inverse_transformed_data
+        if getattr(self, "_inverse_array_source", None) is not inverse_data:
+            self._inverse_transformed_array = stack_timeseries(
+                inverse_data["timeseries"], np.float32
+            )
+            self._inverse_array_source = inverse_data
+        return self._inverse_transformed_array
+
     def _encode_conditioning_vars(
         self,
         data: pd.DataFrame,
@@ -437,6 +516,7 @@ class TimeSeriesDataset(Dataset, ABC):
             data=data,
             columns_to_encode=columns_to_encode,
             bins=self.numeric_conditioning_bins,
+            categorical_columns=[self.entity_column_name],
         )
         return encoded_data, conditioning_codes
 
@@ -454,7 +534,9 @@ class TimeSeriesDataset(Dataset, ABC):
         conditioning_var_dict = {}
 
         for var_name in self.conditioning_vars:
-            if pd.api.types.is_numeric_dtype(data[var_name]):
+            if var_name != self.entity_column_name and pd.api.types.is_numeric_dtype(
+                data[var_name]
+            ):
                 binned = pd.cut(
                     data[var_name],
                     bins=self.numeric_conditioning_bins,
@@ -463,7 +545,7 @@ class TimeSeriesDataset(Dataset, ABC):
                 num_categories = binned.nunique()
                 conditioning_var_dict[var_name] = num_categories
             else:
-                num_categories = data[var_name].astype("category").nunique()
+                num_categories = data[var_name].nunique()
                 conditioning_var_dict[var_name] = num_categories
 
         return conditioning_var_dict
@@ -566,8 +648,8 @@ class TimeSeriesDataset(Dataset, ABC):
             pd.DataFrame: DataFrame with a new column 'is_pattern_rare'.
         """
         try:
-            time_series_data = np.stack(
-                self.data["timeseries"].values, axis=0
+            time_series_data = stack_timeseries(
+                self.data["timeseries"]
             )  # Shape: (num_samples, seq_len, n_dim)
         except ValueError as e:
             raise ValueError(f"Error stacking 'timeseries' data: {e}")
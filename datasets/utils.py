@@ -1,10 +1,38 @@
+import copy
+import os
+import warnings
 from typing import Any, Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
 import torch
-from sklearn.metrics import mean_squared_error
 from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
+
+
+def stack_timeseries(column: pd.Series, dtype: Any = None) -> np.ndarray:
+    """
+    Stacks a column of equally shaped arrays into a single array by filling a preallocated
+    output, optionally casting to `dtype` in the same pass.
+
+    Args:
+        column (pd.Series): Column whose entries are numpy arrays of identical shape.
+        dtype (optional): Output dtype. Defaults to the dtype of the first entry.
+
+    Returns:
+        np.ndarray: Array of shape (len(column), *entry_shape).
+    """
+    values = column.to_numpy()
+    if len(values) == 0:
+        raise ValueError("need at least one array to stack")
+
+    first = np.asarray(values[0])
+    stacked = np.empty((len(values), *first.shape), dtype=dtype or first.dtype)
+    for i, value in enumerate(values):
+        if np.shape(value) != first.shape:
+            raise ValueError("all input arrays must have the same shape")
+        stacked[i] = value
+    return stacked
 
 
 def check_inverse_transform(
@@ -22,28 +50,32 @@ def check_inverse_transform(
         float: The average MSE between the transformed and original time series across all rows.
     """
     unnormalized_df = unnormalized_dataset.data
-    transformed = normalized_dataset.inverse_transform(normalized_dataset.data)
-
-    mse_list: List[float] = []
+    transformed = normalized_dataset.inverse_transformed_data
 
-    for idx in range(len(unnormalized_df)):
-        unnormalized_timeseries = unnormalized_df.iloc[idx]["timeseries"]
-        transformed_timeseries = transformed.iloc[idx]["timeseries"]
+    real = stack_timeseries(unnormalized_df["timeseries"])
+    fake = stack_timeseries(transformed["timeseries"])
 
-        assert (
-            unnormalized_timeseries.shape == transformed_timeseries.shape
-        ), "Shape mismatch between transformed and unnormalized timeseries"
+    assert (
+        real.shape == fake.shape
+    ), "Shape mismatch between transformed and unnormalized timeseries"
 
-        mse = mean_squared_error(unnormalized_timeseries, transformed_timeseries)
-        mse_list.append(mse)
-
-    avg_mse = np.mean(mse_list)
+    # Every row has the same length, so the mean of per-row MSEs is the overall MSE
+    diff = (real - fake).ravel()
+    avg_mse = np.dot(diff, diff) / diff.size
     print(f"Average MSE over all rows: {avg_mse}")
     return avg_mse
 
 
 def prepare_dataloader(
-    dataset: Dataset, batch_size: int, shuffle: bool = True
+    dataset: Dataset,
+    batch_size: int,
+    shuffle: bool = True,
+    *,
+    num_workers: int = None,
+    pin_memory: bool = None,
+    distributed: bool = False,
+    drop_last: bool = False,
+    prefetch_factor: int = 2,
 ) -> DataLoader:
     """
     Prepares a DataLoader for batching the dataset.
@@ -52,11 +84,113 @@ def prepare_dataloader(
         dataset (Dataset): The dataset to be batched.
         batch_size (int): The size of each batch.
         shuffle (bool, optional): Whether to shuffle the dataset before batching. Defaults to True.
+        num_workers (int, optional): Number of loader worker processes. Defaults to half the available CPUs, capped at 8.
+        pin_memory (bool, optional): Whether to pin batches in page-locked memory. Defaults to True if CUDA is available.
+        distributed (bool, optional): Whether to give each process of the initialized process group its own
+            shard through a DistributedSampler. Call `loader.sampler.set_epoch` every epoch to reshuffle. Defaults to False.
+        drop_last (bool, optional): Whether to drop the last incomplete batch. Defaults to False.
+        prefetch_factor (int, optional): Number of batches each worker loads ahead. Defaults to 2.
 
     Returns:
         DataLoader: The DataLoader for the dataset.
     """
-    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+    if num_workers is None:
+        num_workers = min(8, (os.cpu_count() or 2) // 2)
+
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    elif pin_memory and not torch.cuda.is_available():
+        warnings.warn("pin_memory=True has no effect without CUDA; disabling it.")
+        pin_memory = False
+
+    sampler = None
+    if distributed:
+        sampler = DistributedSampler(dataset, shuffle=shuffle)
+        shuffle = False
+
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        sampler=sampler,
+        drop_last=drop_last,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+    )
+
+
+def _batch_to(batch: Any, device: torch.device) -> Any:
+    """
+    Moves the tensors of a (possibly nested) batch to `device` without blocking the host.
+    """
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, dict):
+        return {key: _batch_to(value, device) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_batch_to(value, device) for value in batch)
+    return batch
+
+
+def _record_stream(batch: Any, stream: torch.cuda.Stream):
+    """
+    Marks the tensors of a batch as used on `stream`, so the caching allocator does not
+    reuse their memory while that stream may still read them.
+    """
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            _record_stream(value, stream)
+    elif isinstance(batch, (list, tuple)):
+        for value in batch:
+            _record_stream(value, stream)
+
+
+class PrefetchLoader:
+    """
+    Wraps a DataLoader and yields its batches on `device`. On CUDA, the host-to-device
+    copy of the next batch is issued on a side stream while the current batch is being
+    processed, so with pinned memory the copies overlap with compute.
+
+    Args:
+        loader (DataLoader): The DataLoader to wrap.
+        device (torch.device): The device to move the batches to.
+    """
+
+    def __init__(self, loader: DataLoader, device: Any):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.loader:
+                yield _batch_to(batch, self.device)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        current_stream = torch.cuda.current_stream(self.device)
+        pending = None
+        for batch in self.loader:
+            with torch.cuda.stream(stream):
+                batch = _batch_to(batch, self.device)
+            if pending is not None:
+                yield pending
+            # Work queued after this point on the compute stream sees the finished copy
+            current_stream.wait_stream(stream)
+            _record_stream(batch, current_stream)
+            pending = batch
+        if pending is not None:
+            yield pending
 
 
 def split_dataset(dataset: Dataset, val_split: float = 0.1) -> Tuple[Dataset, Dataset]:
@@ -73,6 +207,14 @@ def split_dataset(dataset: Dataset, val_split: float = 0.1) -> Tuple[Dataset, Da
     val_size = int(len(dataset) * val_split)
     train_size = len(dataset) - val_size
 
+    if isinstance(getattr(dataset, "data", None), pd.DataFrame):
+        # Shallow copies that own a row slice avoid Subset's per-item indirection
+        train_dataset = copy.copy(dataset)
+        train_dataset.data = dataset.data.iloc[:train_size].reset_index(drop=True)
+        val_dataset = copy.copy(dataset)
+        val_dataset.data = dataset.data.iloc[train_size:].reset_index(drop=True)
+        return train_dataset, val_dataset
+
     train_dataset = torch.utils.data.Subset(dataset, range(train_size))
     val_dataset = torch.utils.data.Subset(dataset, range(train_size, len(dataset)))
 
@@ -86,7 +228,10 @@ import pandas as pd
 
 
 def encode_conditioning_variables(
-    data: pd.DataFrame, columns_to_encode: List[str], bins: int
+    data: pd.DataFrame,
+    columns_to_encode: List[str],
+    bins: int,
+    categorical_columns: List[str] = (),
 ) -> Tuple[pd.DataFrame, Dict[str, Dict[int, Any]]]:
     """
     Encodes specified columns in the DataFrame either by binning numeric columns
@@ -97,6 +242,7 @@ def encode_conditioning_variables(
         data (pd.DataFrame): The input DataFrame containing the data.
         columns_to_encode (List[str]): List of column names to encode.
         bins (int): Number of bins for numeric columns.
+        categorical_columns (List[str]): Columns encoded as categories even if numeric, e.g. user ids.
 
     Returns:
         Tuple[pd.DataFrame, Dict[str, Dict[int, Any]]]:
@@ -132,11 +278,22 @@ def encode_conditioning_variables(
     ]
 
     for col in columns_to_encode:
-        if pd.api.types.is_numeric_dtype(encoded_data[col]):
+        if col not in categorical_columns and pd.api.types.is_numeric_dtype(
+            encoded_data[col]
+        ):
             # Numeric column: Perform binning
-            binned = pd.cut(encoded_data[col], bins=bins, include_lowest=True)
-            encoded_data[col] = binned.cat.codes  # Assign integer codes starting from 0
-            bin_intervals = binned.cat.categories
+            values = encoded_data[col].to_numpy(dtype=np.float64)
+            # Derive pd.cut's bin edges and labels from the value range only
+            bin_intervals, edges = pd.cut(
+                [np.nanmin(values), np.nanmax(values)],
+                bins=bins,
+                include_lowest=True,
+                retbins=True,
+            )
+            bin_intervals = bin_intervals.categories
+            codes = np.digitize(values, edges[1:-1], right=True)
+            codes[np.isnan(values)] = -1
+            encoded_data[col] = codes  # Assign integer codes starting from 0
             # Create the mapping from integer code to bin interval
             bin_mapping = {
                 code: str(interval) for code, interval in enumerate(bin_intervals)
@@ -145,55 +302,80 @@ def encode_conditioning_variables(
         else:
             # Categorical/String column
             if col.lower() == "weekday":
-                # Ensure consistent capitalization
-                encoded_data[col] = encoded_data[col].str.capitalize()
-                # Define categorical type with specified order
-                encoded_data[col] = pd.Categorical(
-                    encoded_data[col], categories=weekdays_order, ordered=True
+                # Ensure consistent capitalization and look up chronological codes
+                encoded_data[col] = pd.Index(weekdays_order).get_indexer(
+                    encoded_data[col].str.capitalize()
                 )
-                encoded_data[col] = encoded_data[col].cat.codes
                 # Create the mapping from code to weekday
                 weekday_mapping = {code: day for code, day in enumerate(weekdays_order)}
                 mapping[col] = weekday_mapping
             elif col.lower() == "month":
-                # Ensure consistent capitalization
-                encoded_data[col] = encoded_data[col].str.capitalize()
-                # Define categorical type with specified order
-                encoded_data[col] = pd.Categorical(
-                    encoded_data[col], categories=months_order, ordered=True
+                # Ensure consistent capitalization and look up chronological codes
+                encoded_data[col] = pd.Index(months_order).get_indexer(
+                    encoded_data[col].str.capitalize()
                 )
-                encoded_data[col] = encoded_data[col].cat.codes
                 # Create the mapping from code to month
                 month_mapping = {code: month for code, month in enumerate(months_order)}
                 mapping[col] = month_mapping
             else:
                 # For other categorical/string columns, perform standard encoding
-                encoded_data[col] = encoded_data[col].astype("category").cat.codes
-                categories = data[col].astype("category").cat.categories
+                codes, categories = pd.factorize(encoded_data[col], sort=True)
+                encoded_data[col] = codes
+                # Python scalars, so numeric categories such as user ids stay JSON
+                # serializable
                 category_mapping = {
-                    i: category for i, category in enumerate(categories)
+                    i: category for i, category in enumerate(categories.tolist())
                 }
                 mapping[col] = category_mapping
 
     return encoded_data, mapping
 
 
+def build_mapping_arrays(mapping: Dict[str, Dict[int, Any]]) -> Dict[str, np.ndarray]:
+    """
+    Converts the code-to-value mapping of each conditioning variable into an object array
+    that can be indexed directly with integer codes.
+
+    Args:
+        mapping (Dict[str, Dict[int, Any]]): Mapping dictionary for each encoded column.
+
+    Returns:
+        Dict[str, np.ndarray]: Lookup array for each encoded column, indexed by code.
+    """
+    mapping_arrays = {}
+    for var_name, var_mapping in mapping.items():
+        lookup = np.empty(len(var_mapping), dtype=object)
+        for code in range(len(var_mapping)):
+            lookup[code] = var_mapping[code]
+        mapping_arrays[var_name] = lookup
+    return mapping_arrays
+
+
 def convert_generated_data_to_df(
     data: torch.Tensor,
-    conditioning_vars: Dict[str, Any],
-    mapping: Dict[str, Any],
+    conditioning_vars: Dict[str, torch.Tensor],
+    mapping_arrays: Dict[str, np.ndarray],
 ) -> pd.DataFrame:
+    """
+    Converts generated time series and their conditioning codes into a DataFrame with decoded
+    conditioning values.
+
+    Args:
+        data (torch.Tensor): Generated time series of shape (n_timeseries, seq_len, n_dim).
+        conditioning_vars (Dict[str, torch.Tensor]): Conditioning codes, either a scalar per variable or one code per time series.
+        mapping_arrays (Dict[str, np.ndarray]): Lookup arrays as returned by `build_mapping_arrays`.
+
+    Returns:
+        pd.DataFrame: DataFrame with one column per conditioning variable and a 'timeseries' column.
+    """
     n_timeseries, _, _ = data.shape
     data_np = data.cpu().numpy()
 
-    decoded_conditioning_vars = {}
-    for var_name, code in conditioning_vars.items():
-        decoded_conditioning_vars[var_name] = mapping[var_name][code.item()]
-
-    records = []
-    for i in range(n_timeseries):
-        record = decoded_conditioning_vars.copy()
-        record["timeseries"] = data_np[i]
-        records.append(record)
-    df = pd.DataFrame.from_records(records)
-    return df
+    columns = {
+        var_name: mapping_arrays[var_name][
+            np.broadcast_to(codes.cpu().numpy(), (n_timeseries,))
+        ]
+        for var_name, codes in conditioning_vars.items()
+    }
+    columns["timeseries"] = list(data_np)
+    return pd.DataFrame(columns)
@@ -8,7 +8,7 @@ import torch.nn as nn
 from hydra import compose, initialize_config_dir
 from omegaconf import DictConfig, OmegaConf
 
-from datasets.utils import convert_generated_data_to_df
+from datasets.utils import build_mapping_arrays, convert_generated_data_to_df
 from generator.diffcharge.diffusion import DDPM
 from generator.diffusion_ts.gaussian_diffusion import Diffusion_TS
 from generator.gan.acgan import ACGAN
@@ -202,10 +202,23 @@ class DataGenerator:
 
         data = self.model.generate(conditioning_vars)
         df = convert_generated_data_to_df(
-            data, self.conditioning_var_buffer, self.conditioning_var_codes
+            data, conditioning_vars, self._get_mapping_arrays()
         )
         return df
 
+    def _get_mapping_arrays(self) -> Dict[str, Any]:
+        """
+        Get code-indexed lookup arrays for the conditioning variable mappings, rebuilding them
+        only when the mappings have been replaced.
+        """
+        if (
+            getattr(self, "_mapping_arrays_source", None)
+            is not self.conditioning_var_codes
+        ):
+            self._mapping_arrays = build_mapping_arrays(self.conditioning_var_codes)
+            self._mapping_arrays_source = self.conditioning_var_codes
+        return self._mapping_arrays
+
     def load_model(self, dataset_name: str):
         """
         Load the model from a checkpoint file.
@@ -32,27 +32,24 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 def batch_generator(
-    data: np.ndarray, time: List[int], batch_size: int
-) -> Tuple[np.ndarray, np.ndarray]:
+    data: torch.Tensor, time: torch.Tensor, batch_size: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
     """
     Generates a random batch of data and corresponding sequence lengths.
 
     Args:
-        data (np.ndarray): The dataset, of shape (n_samples, seq_len, n_features).
-        time (List[int]): List of sequence lengths for each sample.
+        data (torch.Tensor): The dataset, of shape (n_samples, seq_len, n_features).
+        time (torch.Tensor): Sequence lengths for each sample.
         batch_size (int): Size of the batch to generate.
 
     Returns:
-        Tuple[np.ndarray, np.ndarray]: Batch of data and corresponding sequence lengths.
+        Tuple[torch.Tensor, torch.Tensor]: Batch of data and corresponding sequence lengths.
     """
     no = len(data)
     idx = np.random.permutation(no)
-    train_idx = idx[:batch_size]
+    train_idx = torch.from_numpy(idx[:batch_size])
 
-    X_mb = np.array([data[i] for i in train_idx])
-    T_mb = np.array([time[i] for i in train_idx])
-
-    return X_mb, T_mb
+    return data[train_idx.to(data.device)], time[train_idx.to(time.device)]
 
 
 class Discriminator(nn.Module):
@@ -92,7 +89,7 @@ class Discriminator(nn.Module):
 
 
 def discriminative_score_metrics(
-    ori_data: np.ndarray, generated_data: np.ndarray
+    ori_data: np.ndarray, generated_data: np.ndarray, device: torch.device = device
 ) -> Tuple[float, float, float]:
     """
     Computes the discriminative score by training a discriminator to classify between original and generated data.
@@ -100,6 +97,7 @@ def discriminative_score_metrics(
     Args:
         ori_data (np.ndarray): Original time series data, shape (n_samples, seq_len, n_features).
         generated_data (np.ndarray): Generated time series data, same shape as ori_data.
+        device (torch.device, optional): Device to train the discriminator on. Defaults to the first GPU if available.
 
     Returns:
         Tuple[float, float, float]: Discriminative score, accuracy on generated data, and accuracy on original data.
@@ -133,6 +131,16 @@ def discriminative_score_metrics(
         test_t_hat,
     ) = train_test_divide(ori_data, generated_data, ori_time, generated_time)
 
+    # Move the splits to the device once; batches are then gathered there
+    train_x, train_x_hat, test_x, test_x_hat = (
+        torch.as_tensor(x, dtype=torch.float32, device=device)
+        for x in (train_x, train_x_hat, test_x, test_x_hat)
+    )
+    train_t, train_t_hat, test_t, test_t_hat = (
+        torch.as_tensor(t, dtype=torch.int64, device=device)
+        for t in (train_t, train_t_hat, test_t, test_t_hat)
+    )
+
     # Training loop
     for _ in tqdm(
         range(iterations), desc="Training Discriminative Score Model", total=iterations
@@ -141,13 +149,8 @@ def discriminative_score_metrics(
         X_mb, T_mb = batch_generator(train_x, train_t, batch_size)
         X_hat_mb, T_hat_mb = batch_generator(train_x_hat, train_t_hat, batch_size)
 
-        X_mb = torch.FloatTensor(X_mb).to(device)
-        X_hat_mb = torch.FloatTensor(X_hat_mb).to(device)
-        T_mb = torch.LongTensor(T_mb).to(device)
-        T_hat_mb = torch.LongTensor(T_hat_mb).to(device)
-
         # Discriminator forward and backward pass
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         y_pred_real = discriminator(X_mb, T_mb)
         y_pred_fake = discriminator(X_hat_mb, T_hat_mb)
 
@@ -159,12 +162,7 @@ def discriminative_score_metrics(
         optimizer.step()
 
     # Testing the discriminator on the testing set
-    with torch.no_grad():
-        test_x = torch.FloatTensor(test_x).to(device)
-        test_x_hat = torch.FloatTensor(test_x_hat).to(device)
-        test_t = torch.LongTensor(test_t).to(device)
-        test_t_hat = torch.LongTensor(test_t_hat).to(device)
-
+    with torch.inference_mode():
         y_pred_real_curr = torch.sigmoid(discriminator(test_x, test_t)).cpu().numpy()
         y_pred_fake_curr = (
             torch.sigmoid(discriminator(test_x_hat, test_t_hat)).cpu().numpy()
@@ -1,7 +1,8 @@
 import datetime
 import logging
 import os
-from typing import Any, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Hashable, List, Tuple
 
 import numpy as np
 import pandas as pd
@@ -10,9 +11,11 @@ import wandb
 from omegaconf import DictConfig, OmegaConf
 from sklearn.metrics import f1_score, precision_score, recall_score
 
+from datasets.utils import stack_timeseries
 from eval.discriminative_metric import discriminative_score_metrics
 from eval.metrics import (
     Context_FID,
+    EmbeddingCache,
     calculate_mmd,
     calculate_period_bound_mse,
     dynamic_time_warping_dist,
@@ -29,6 +32,71 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 logger = logging.getLogger(__name__)
 
 
+def _cond_array_to_device(
+    codes: np.ndarray, names: List[str]
+) -> Dict[str, torch.Tensor]:
+    """
+    Move encoded conditioning codes to the device with a single host-to-device copy.
+
+    Args:
+        codes (np.ndarray): Codes of shape (n_conditioning_vars, n_samples), one row per variable.
+        names (List[str]): Names of the conditioning variables, in row order.
+
+    Returns:
+        Dict[str, torch.Tensor]: Mapping from variable name to a contiguous int64 device tensor.
+    """
+    host = torch.from_numpy(np.ascontiguousarray(codes, dtype=np.int64))
+    if device.type == "cuda":
+        host = host.pin_memory()
+    stacked = host.to(device, non_blocking=True)
+    return {name: stacked[i] for i, name in enumerate(names)}
+
+
+def _cond_to_device(df: pd.DataFrame, names: List[str]) -> Dict[str, torch.Tensor]:
+    """
+    Move conditioning columns to the device with a single host-to-device copy.
+
+    Args:
+        df (pd.DataFrame): DataFrame containing the encoded conditioning columns.
+        names (List[str]): Names of the conditioning columns to transfer.
+
+    Returns:
+        Dict[str, torch.Tensor]: Mapping from column name to a contiguous int64 device tensor.
+    """
+    # Lay the columns out as rows so each per-variable view is contiguous
+    return _cond_array_to_device(df[names].to_numpy(dtype=np.int64).T, names)
+
+
+def _split_by_rarity(
+    rarity_scores: torch.Tensor, quantile: float = 0.8
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Split samples into those scoring above the given rarity quantile and the rest.
+
+    The threshold interpolates between the two order statistics around
+    `quantile * (n - 1)` like torch.quantile, but selects them with kthvalue instead
+    of sorting all scores.
+
+    Args:
+        rarity_scores (torch.Tensor): One rarity score per sample.
+        quantile (float): Quantile of the scores above which a sample is rare.
+
+    Returns:
+        Tuple containing indices of rare and non-rare samples.
+    """
+    n = rarity_scores.numel()
+    rank = torch.tensor(quantile, dtype=rarity_scores.dtype) * (n - 1)
+    below = int(rank)
+    lower = torch.kthvalue(rarity_scores, below + 1).values
+    upper = torch.kthvalue(rarity_scores, min(below + 2, n)).values
+    rarity_threshold = torch.lerp(lower, upper, float(rank - below))
+
+    # A single host transfer of the mask serves both index sets
+    rare_mask = (rarity_scores > rarity_threshold).cpu().numpy()
+
+    return np.flatnonzero(rare_mask), np.flatnonzero(~rare_mask)
+
+
 class Evaluator:
     """
     A class for evaluating generative models on time series data.
@@ -45,6 +113,8 @@ class Evaluator:
         self.real_dataset = real_dataset
         self.cfg = cfg
         self.model_name = cfg.model.name
+        # TS2Vec encoders only depend on the real data, so share them across models
+        self.embedding_cache = EmbeddingCache()
 
         wandb.init(
             config=OmegaConf.to_container(cfg, resolve=True),
@@ -81,9 +151,15 @@ class Evaluator:
         logger.info("----------------------")
 
         # Pass data_label to run_evaluation
-        self.run_evaluation(dataset, model, distinguish_rare)
+        self.run_evaluation(dataset, model, distinguish_rare, user_id)
 
-    def run_evaluation(self, dataset: Any, model: Any, distinguish_rare: bool):
+    def run_evaluation(
+        self,
+        dataset: Any,
+        model: Any,
+        distinguish_rare: bool,
+        user_id: int = None,
+    ):
         """
         Run the evaluation process.
 
@@ -91,20 +167,26 @@ class Evaluator:
             dataset: The dataset to evaluate.
             model: The trained model.
             distinguish_rare (bool): Whether to distinguish between rare and non-rare data samples.
+            user_id (int, optional): The ID of the user the dataset belongs to, None for all users.
         """
+        # Generate and inverse-transform once, then slice per subset
+        syn_data_array = self.generate_synthetic_data(dataset, model)
+
         if distinguish_rare:
             rare_indices, non_rare_indices = self.identify_rare_combinations(
                 dataset, model
             )
-            self.evaluate_subset(dataset, model, rare_indices, data_type="rare")
+            self.evaluate_subset(dataset, model, rare_indices, syn_data_array, user_id)
             self.evaluate_subset(
                 dataset,
                 model,
                 non_rare_indices,
+                syn_data_array,
+                user_id,
             )
         else:
             all_indices = dataset.data.index.to_numpy()
-            self.evaluate_subset(dataset, model, all_indices)
+            self.evaluate_subset(dataset, model, all_indices, syn_data_array, user_id)
 
     def identify_rare_combinations(
         self, dataset: Any, model: Any
@@ -119,32 +201,83 @@ class Evaluator:
         Returns:
             Tuple containing indices of rare and non-rare conditioning combinations.
         """
-        conditioning_vars = {
-            name: torch.tensor(
-                dataset.data[name].values, dtype=torch.long, device=device
+        conditioning_vars = _cond_array_to_device(
+            dataset.conditioning_array, dataset.conditioning_vars
+        )
+
+        with torch.inference_mode():
+            _, mu, _ = model.conditioning_module(conditioning_vars, sample=False)
+            # Negative GMM log-likelihood, built from whitened (Mahalanobis) residuals
+            rarity_scores = -model.conditioning_module.compute_log_likelihood(mu)
+
+        return _split_by_rarity(rarity_scores)
+
+    @torch.inference_mode()
+    def generate_synthetic_data(self, dataset: Any, model: Any) -> np.ndarray:
+        """
+        Generate one synthetic time series per row of the dataset, conditioned on that row's
+        conditioning variables, and bring it back to the original data space.
+
+        Args:
+            dataset: The dataset containing real data.
+            model: The trained model to generate data.
+
+        Returns:
+            np.ndarray: Float32 synthetic data of shape (n_samples, seq_len, n_dims), row-aligned with dataset.data.
+        """
+        conditioning_vars = _cond_array_to_device(
+            dataset.conditioning_array, dataset.conditioning_vars
+        )
+
+        # Generate in bounded chunks into a single preallocated device buffer
+        n_samples = len(dataset.data)
+        chunk_size = self.cfg.model.sampling_batch_size
+        generated = None
+        for start in range(0, n_samples, chunk_size):
+            samples = model.generate(
+                {
+                    name: tensor[start : start + chunk_size]
+                    for name, tensor in conditioning_vars.items()
+                }
             )
-            for name in model.conditioning_var_n_categories.keys()
-        }
+            if generated is None:
+                generated = torch.empty(
+                    (n_samples, *samples.shape[1:]),
+                    dtype=samples.dtype,
+                    device=samples.device,
+                )
+            generated[start : start + len(samples)] = samples
 
-        with torch.no_grad():
-            embeddings = model.conditioning_module(conditioning_vars)
-            mahalanobis_distances = (
-                model.conditioning_module.compute_mahalanobis_distance(embeddings)
+        # Copy back once into pinned host memory
+        host_generated = torch.empty(
+            generated.shape,
+            dtype=generated.dtype,
+            pin_memory=generated.device.type == "cuda",
+        )
+        host_generated.copy_(generated, non_blocking=True)
+        if generated.device.type == "cuda":
+            torch.cuda.current_stream(generated.device).synchronize()
+        generated_ts = host_generated.numpy()
+        if generated_ts.ndim == 2:
+            generated_ts = generated_ts.reshape(
+                generated_ts.shape[0], -1, generated_ts.shape[1]
             )
 
-        rarity_threshold = torch.quantile(mahalanobis_distances, 0.8)
-        rare_mask = mahalanobis_distances > rarity_threshold
+        syn_data = dataset.data.copy(deep=False)
+        syn_data["timeseries"] = list(generated_ts)
 
-        rare_indices = np.where(rare_mask.cpu().numpy())[0]
-        non_rare_indices = np.where(~rare_mask.cpu().numpy())[0]
+        if self.cfg.evaluator.syn_requires_inverse:
+            syn_data = dataset.inverse_transform(syn_data)
 
-        return rare_indices, non_rare_indices
+        return stack_timeseries(syn_data["timeseries"], np.float32)
 
     def evaluate_subset(
         self,
         dataset: Any,
         model: Any,
         indices: np.ndarray,
+        syn_data_array: np.ndarray,
+        user_id: int = None,
     ):
         """
         Evaluate the model on a subset of the data.
@@ -153,46 +286,46 @@ class Evaluator:
             dataset: The dataset containing real data.
             model: The trained model to generate data.
             indices (np.ndarray): Indices of data to use.
+            syn_data_array (np.ndarray): Synthetic data for the whole dataset, as returned by `generate_synthetic_data`.
+            user_id (int, optional): The ID of the user the dataset belongs to, None for all users.
         """
+        real_data_inv = dataset.inverse_transformed_data.iloc[indices].reset_index(
+            drop=True
+        )
 
-        real_data_subset = dataset.data.iloc[indices].reset_index(drop=True)
-        conditioning_vars = {
-            name: torch.tensor(
-                real_data_subset[name].values, dtype=torch.long, device=device
-            )
-            for name in model.conditioning_var_n_categories.keys()
-        }
-
-        generated_ts = model.generate(conditioning_vars).cpu().numpy()
-        if generated_ts.ndim == 2:
-            generated_ts = generated_ts.reshape(
-                generated_ts.shape[0], -1, generated_ts.shape[1]
-            )
-
-        syn_data_subset = real_data_subset.copy()
-        syn_data_subset["timeseries"] = list(generated_ts)
-
-        real_data_inv = dataset.inverse_transform(real_data_subset)
-        syn_data_inv = dataset.inverse_transform(syn_data_subset)
-
-        # Convert to numpy arrays
-        real_data_array = np.stack(real_data_inv["timeseries"])
-        syn_data_array = np.stack(syn_data_inv["timeseries"])
+        # Slice the dataset-wide real and synthetic arrays instead of restacking
+        real_data_array = dataset.inverse_transformed_array[indices]
+        syn_data_array = syn_data_array[indices]
 
         # Compute metrics
         if self.cfg.evaluator.eval_metrics:
-            self.compute_metrics(real_data_array, syn_data_array, real_data_inv)
+            period_ids = (
+                real_data_inv.groupby(["month", "weekday"], sort=False)
+                .ngroup()
+                .to_numpy()
+            )
+            # The user and row indices identify the real subset across evaluated models
+            subset_key = (user_id, indices.tobytes())
+            self.compute_metrics(
+                real_data_array, syn_data_array, period_ids, subset_key
+            )
 
         # Generate plots
         if self.cfg.evaluator.eval_vis:
-            self.create_visualizations(real_data_inv, syn_data_inv, dataset, model)
+            self.create_visualizations(
+                real_data_inv, real_data_array, syn_data_array, dataset, model
+            )
 
         # Evaluate conditioning module rarity predictions
         if self.cfg.evaluator.eval_cond:
             self.evaluate_conditioning_module(model)
 
     def compute_metrics(
-        self, real_data: np.ndarray, syn_data: np.ndarray, real_data_frame: pd.DataFrame
+        self,
+        real_data: np.ndarray,
+        syn_data: np.ndarray,
+        period_ids: np.ndarray,
+        subset_key: Hashable,
     ):
         """
         Compute evaluation metrics and log them.
@@ -200,54 +333,111 @@ class Evaluator:
         Args:
             real_data (np.ndarray): Real data array.
             syn_data (np.ndarray): Synthetic data array.
-            real_data_subset (pd.DataFrame): Real data subset DataFrame.
+            period_ids (np.ndarray): (month, weekday) period id of each real data row.
+            subset_key (Hashable): Identifies the real data subset, so its TS2Vec encoder is reused.
+        """
+        # Collected into a single wandb.log call so all scores share one history step
+        metrics = {}
+
+        # DTW, MMD and the bounded MSE only need the CPU, so they are computed on a
+        # background thread while the TS2Vec encoder and the post-hoc models of the
+        # discriminative and predictive scores train on the GPU
+        distance_pool = ThreadPoolExecutor(max_workers=1)
+        distance_future = distance_pool.submit(
+            self.compute_distance_metrics, real_data, syn_data, period_ids
+        )
+        distance_pool.shutdown(wait=False)
+
+        # FID
+        logger.info(f"--- Starting Context FID computation ---")
+        real_emb, syn_emb = self.embedding_cache.get_or_train(
+            subset_key, real_data, syn_data
+        )
+        fid_score = Context_FID(real_emb, syn_emb, embed=False)
+        metrics["Context_FID"] = fid_score
+        logger.info(f"--- Context FID computation complete ---")
+        logger.info("----------------------")
+
+        # Discriminative and Predictive Scores
+        logger.info(f"--- Starting Discriminative and Predictive Score computation ---")
+        if torch.cuda.device_count() > 1:
+            # Each score trains its own post-hoc model, so with several GPUs both are
+            # trained concurrently, one per device
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                discr_future = pool.submit(
+                    discriminative_score_metrics,
+                    real_data,
+                    syn_data,
+                    device=torch.device("cuda", 0),
+                )
+                pred_future = pool.submit(
+                    predictive_score_metrics,
+                    real_data,
+                    syn_data,
+                    device=torch.device("cuda", 1),
+                )
+                discr_score, _, _ = discr_future.result()
+                pred_score = pred_future.result()
+        else:
+            discr_score, _, _ = discriminative_score_metrics(real_data, syn_data)
+            pred_score = predictive_score_metrics(real_data, syn_data)
+        metrics["Disc_Score"] = discr_score
+        metrics["Pred_Score"] = pred_score
+        logger.info(f"--- Discriminative and Predictive Score computation complete ---")
+        logger.info("----------------------")
+
+        metrics.update(distance_future.result())
+        wandb.log(metrics)
+
+    def compute_distance_metrics(
+        self, real_data: np.ndarray, syn_data: np.ndarray, period_ids: np.ndarray
+    ) -> Dict[str, float]:
+        """
+        Compute the DTW, MMD and bounded MSE scores, which need no GPU.
+
+        Args:
+            real_data (np.ndarray): Real data array.
+            syn_data (np.ndarray): Synthetic data array.
+            period_ids (np.ndarray): (month, weekday) period id of each real data row.
+
+        Returns:
+            Dict[str, float]: The scores, keyed by their wandb names.
         """
+        metrics = {}
+
         # DTW
         logger.info(f"--- Starting DTW distance computation ---")
-        dtw_mean, dtw_std = dynamic_time_warping_dist(real_data, syn_data)
-        wandb.log({"DTW/mean": dtw_mean, "DTW/std": dtw_std})
+        dtw_mean, dtw_std = dynamic_time_warping_dist(
+            real_data,
+            syn_data,
+            window=self.cfg.evaluator.dtw_window,
+            n_jobs=self.cfg.evaluator.n_jobs,
+        )
+        metrics.update({"DTW/mean": dtw_mean, "DTW/std": dtw_std})
         logger.info(f"--- DTW distance computation complete ---")
         logger.info("----------------------")
 
         # MMD
         logger.info(f"--- Starting MMD computation ---")
         mmd_mean, mmd_std = calculate_mmd(real_data, syn_data)
-        wandb.log({"MMD/mean": mmd_mean, "MMD/std": mmd_std})
+        metrics.update({"MMD/mean": mmd_mean, "MMD/std": mmd_std})
         logger.info(f"--- MMD computation complete ---")
         logger.info("----------------------")
 
         # MSE
         logger.info(f"--- Starting Bounded MSE computation ---")
-        mse_mean, mse_std = calculate_period_bound_mse(real_data_frame, syn_data)
-        wandb.log({"MSE/mean": mse_mean, "MSE/std": mse_std})
+        mse_mean, mse_std = calculate_period_bound_mse(real_data, syn_data, period_ids)
+        metrics.update({"MSE/mean": mse_mean, "MSE/std": mse_std})
         logger.info(f"--- Bounded MSE computation complete ---")
         logger.info("----------------------")
 
-        # FID
-        logger.info(f"--- Starting Context FID computation ---")
-        fid_score = Context_FID(real_data, syn_data)
-        wandb.log({"Context_FID": fid_score})
-        logger.info(f"--- Context FID computation complete ---")
-        logger.info("----------------------")
-
-        # Discriminative Score
-        logger.info(f"--- Starting Discriminative Score computation ---")
-        discr_score, _, _ = discriminative_score_metrics(real_data, syn_data)
-        wandb.log({"Disc_Score": discr_score})
-        logger.info(f"--- Discriminative Score computation complete ---")
-        logger.info("----------------------")
-
-        # Predictive Score
-        logger.info(f"--- Starting Predictive Score computation ---")
-        pred_score = predictive_score_metrics(real_data, syn_data)
-        wandb.log({"Pred_Score": pred_score})
-        logger.info(f"--- Predictive Score computation complete ---")
-        logger.info("----------------------")
+        return metrics
 
     def create_visualizations(
         self,
         real_data_df: pd.DataFrame,
-        syn_data_df: pd.DataFrame,
+        real_data_array: np.ndarray,
+        syn_data_array: np.ndarray,
         dataset: Any,
         model: Any,
         num_samples: int = 100,
@@ -258,38 +448,38 @@ class Evaluator:
 
         Args:
             real_data_df (pd.DataFrame): Inverse-transformed real data.
-            syn_data_df (pd.DataFrame): Inverse-transformed synthetic data.
+            real_data_array (np.ndarray): Stacked inverse-transformed real time series.
+            syn_data_array (np.ndarray): Stacked inverse-transformed synthetic time series.
             dataset (Any): The dataset object.
             model (Any): The trained model.
             num_samples (int): Number of samples to generate for visualization.
             num_runs (int): Number of visualization runs.
         """
         logger.info(f"--- Starting Visualizations ---")
-        for i in range(num_runs):
-            sample_index = np.random.randint(low=0, high=real_data_df.shape[0])
-            sample_row = real_data_df.iloc[sample_index]
-
-            conditioning_vars_sample = {
-                var_name: torch.tensor(
-                    [sample_row[var_name]] * num_samples,
-                    dtype=torch.long,
-                    device=device,
-                )
-                for var_name in model.conditioning_var_n_categories.keys()
-            }
-
-            # Generate synthetic samples
-            generated_samples = model.generate(conditioning_vars_sample).cpu().numpy()
-            if generated_samples.ndim == 2:
-                generated_samples = generated_samples.reshape(
-                    generated_samples.shape[0], -1, generated_samples.shape[1]
-                )
+        cond_var_names = list(model.conditioning_var_n_categories.keys())
+        sample_rows = real_data_df.sample(
+            n=num_runs,
+            replace=num_runs > len(real_data_df),
+            random_state=self.cfg.get("seed"),
+        ).reset_index(drop=True)
+
+        # Generate the synthetic samples for all runs in a single call
+        conditioning_vars_all = _cond_to_device(
+            sample_rows.loc[sample_rows.index.repeat(num_samples)], cond_var_names
+        )
+        generated_all = model.generate(conditioning_vars_all).cpu().numpy()
+        generated_all = generated_all.reshape(
+            num_runs, num_samples, -1, generated_all.shape[-1]
+        )
+
+        for i, sample_row in sample_rows.iterrows():
+            generated_samples = generated_all[i]
 
             # Create DataFrame for generated samples
             generated_samples_df = pd.DataFrame(
                 {
                     var_name: [sample_row[var_name]] * num_samples
-                    for var_name in model.conditioning_var_n_categories.keys()
+                    for var_name in cond_var_names
                 }
             )
             generated_samples_df["timeseries"] = list(generated_samples)
@@ -322,10 +512,7 @@ class Evaluator:
             generated_samples_df = dataset.inverse_transform(generated_samples_df)
 
             # Extract conditioning vars for visualization
-            cond_vars_for_vis = {
-                name: tensor[0].item()
-                for name, tensor in conditioning_vars_sample.items()
-            }
+            cond_vars_for_vis = {name: int(sample_row[name]) for name in cond_var_names}
 
             # Visualization: Combined range and closest real time series plot
             comparison_plot = plot_syn_and_real_comparison(
@@ -335,12 +522,11 @@ class Evaluator:
                 wandb.log({f"Comparison_Plot_{i}": wandb.Image(comparison_plot)})
 
         # Visualization 3: KDE plots for real and synthetic data
-        real_data_array = np.stack(real_data_df["timeseries"])
-        syn_data_array = np.stack(syn_data_df["timeseries"])
         kde_plots = visualization(real_data_array, syn_data_array, "kernel")
         if kde_plots is not None:
-            for i, plot in enumerate(kde_plots):
-                wandb.log({f"KDE_Dim_{i}": wandb.Image(plot)})
+            wandb.log(
+                {f"KDE_Dim_{i}": wandb.Image(plot) for i, plot in enumerate(kde_plots)}
+            )
 
         logger.info(f"--- Visualizations complete! ---")
 
@@ -367,17 +553,16 @@ class Evaluator:
             raise ValueError("Model name not recognized!")
 
         model.train_model(dataset)
+        if self.cfg.evaluator.fuse_bn and hasattr(model, "fuse_bn"):
+            model.fuse_bn()
         return model
 
-    def evaluate_conditioning_module(
-        self, model: Any, batch_size: int = 128
-    ) -> Dict[str, float]:
+    def evaluate_conditioning_module(self, model: Any) -> Dict[str, float]:
         """
         Evaluate the computed rarities of conditional embeddings against frequency-based ground truth rarity.
 
         Args:
             model (Any): The trained model containing the conditioning module.
-            batch_size (int): The number of samples to process in each batch.
 
         Returns:
             Dict[str, float]: Precision, recall, and F1 score of the rarity prediction.
@@ -387,27 +572,14 @@ class Evaluator:
         )
         conditioning_vars_list = list(self.cfg.dataset.conditioning_vars.keys())
 
-        true_labels = comb_rarity_df["rare"].astype(bool).tolist()
-        num_samples = len(comb_rarity_df)
-        pred_labels = []
+        true_labels = comb_rarity_df["rare"].astype(bool).to_numpy()
 
-        for start_idx in range(0, num_samples, batch_size):
-            end_idx = min(start_idx + batch_size, num_samples)
-            batch_df = comb_rarity_df.iloc[start_idx:end_idx]
+        # The combination table is small, so all rows go through a single forward pass
+        conditioning_vars = _cond_to_device(comb_rarity_df, conditioning_vars_list)
 
-            conditioning_vars_batch = {
-                var_name: torch.tensor(
-                    batch_df[var_name].values, dtype=torch.long, device=self.cfg.device
-                )
-                for var_name in conditioning_vars_list
-            }
-
-            with torch.no_grad():
-                _, mu_batch, _ = model.conditioning_module(
-                    conditioning_vars_batch, sample=False
-                )
-                pred_rare_mask = model.conditioning_module.is_rare(mu_batch)
-                pred_labels.extend(pred_rare_mask.cpu().tolist())
+        with torch.inference_mode():
+            _, mu, _ = model.conditioning_module(conditioning_vars, sample=False)
+            pred_labels = model.conditioning_module.is_rare(mu).cpu().numpy()
 
         precision = precision_score(true_labels, pred_labels, zero_division=0)
         recall = recall_score(true_labels, pred_labels, zero_division=0)
@@ -1,27 +1,108 @@
-from functools import partial
-from typing import Tuple
+import atexit
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, reduce
+from typing import Hashable, Optional, Tuple
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import scipy
 import seaborn as sns
+import torch
 from dtaidistance import dtw
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 
-from eval.loss import gaussian_kernel_matrix, maximum_mean_discrepancy
 from eval.t2vec.t2vec import TS2Vec
 from eval.utils import generate_title, get_hourly_ticks, get_month_weekday_names
 
+# Prefer the compiled DTW kernel and fall back to the pure Python one if it is unavailable
+_dtw_distance = dtw.distance_fast if dtw.try_import_c() else dtw.distance
 
-def dynamic_time_warping_dist(X: np.ndarray, Y: np.ndarray) -> Tuple[float, float]:
+
+def _dtw_distance_stats(
+    X: np.ndarray, Y: np.ndarray, window: Optional[int] = None
+) -> Tuple[int, float, float]:
+    """
+    Accumulate the running count, mean and sum of squared deviations (Welford) of the
+    multivariate DTW distances between row-aligned time series.
+
+    Args:
+        X: Contiguous float64 array with shape (n_timeseries, n_dimensions, timeseries_length).
+        Y: Contiguous float64 array with the same shape as X.
+        window: Optional Sakoe-Chiba band radius.
+
+    Returns:
+        Tuple[int, float, float]: Number of pairs, mean distance and sum of squared deviations.
+    """
+    n_timeseries, n_dimensions, _ = X.shape
+    mean, m2 = 0.0, 0.0
+    for i in range(n_timeseries):
+        squared_distance = 0.0
+        for dim in range(n_dimensions):
+            squared_distance += _dtw_distance(X[i, dim], Y[i, dim], window=window) ** 2
+        distance = np.sqrt(squared_distance)
+        delta = distance - mean
+        mean += delta / (i + 1)
+        m2 += delta * (distance - mean)
+    return n_timeseries, mean, m2
+
+
+def _merge_distance_stats(
+    a: Tuple[int, float, float], b: Tuple[int, float, float]
+) -> Tuple[int, float, float]:
+    """
+    Combine two (count, mean, sum of squared deviations) accumulators (Chan et al.).
+    """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta**2 * n_a * n_b / n
+
+
+_dtw_executor: Optional[ProcessPoolExecutor] = None
+_dtw_executor_workers = 0
+
+
+def _get_dtw_executor(n_jobs: int) -> ProcessPoolExecutor:
+    """
+    Return a process pool with `n_jobs` workers, reusing the previous pool when its size
+    matches so repeated evaluations (e.g. one per user) only pay the worker start-up once.
+
+    Workers are spawned rather than forked: the pool may be created from a background
+    thread while other threads hold CUDA and library locks, which a forked child would
+    inherit in a locked state.
+    """
+    global _dtw_executor, _dtw_executor_workers
+    if _dtw_executor is None or _dtw_executor_workers != n_jobs:
+        if _dtw_executor is not None:
+            _dtw_executor.shutdown()
+        else:
+            atexit.register(lambda: _dtw_executor.shutdown())
+        _dtw_executor = ProcessPoolExecutor(
+            max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn")
+        )
+        _dtw_executor_workers = n_jobs
+    return _dtw_executor
+
+
+def dynamic_time_warping_dist(
+    X: np.ndarray, Y: np.ndarray, window: Optional[int] = None, n_jobs: int = 1
+) -> Tuple[float, float]:
     """
     Compute the Dynamic Time Warping (DTW) distance between two multivariate time series.
 
     Args:
         X: Time series data 1 with shape (n_timeseries, timeseries_length, n_dimensions).
         Y: Time series data 2 with shape (n_timeseries, timeseries_length, n_dimensions).
+        window: Optional Sakoe-Chiba band radius. Restricts warping to |i - j| <= window, which
+            bounds the work per pair to O(T * window). Defaults to None (unconstrained DTW).
+        n_jobs: Number of worker processes the time series pairs are split across. -1 uses all
+            CPU cores. Defaults to 1 (no multiprocessing).
 
     Returns:
         Tuple[float, float]: The mean and standard deviation of DTW distances between time series pairs.
@@ -31,17 +112,31 @@ def dynamic_time_warping_dist(X: np.ndarray, Y: np.ndarray) -> Tuple[float, floa
         Y.shape[2],
     ), "Input arrays must have the same shape!"
 
-    n_timeseries, _, n_dimensions = X.shape
-    dtw_distances = []
-
-    for i in range(n_timeseries):
-        distances = [
-            dtw.distance(X[i, :, dim], Y[i, :, dim]) ** 2 for dim in range(n_dimensions)
-        ]
-        dtw_distances.append(np.sqrt(sum(distances)))
+    n_timeseries = X.shape[0]
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, n_timeseries))
+
+    # The C kernel expects contiguous float64 sequences, so lay each dimension out as a row
+    X = np.ascontiguousarray(X.transpose(0, 2, 1), dtype=np.float64)
+    Y = np.ascontiguousarray(Y.transpose(0, 2, 1), dtype=np.float64)
+
+    if n_jobs > 1:
+        # Pairs are independent, so each worker handles one contiguous block of rows
+        bounds = np.linspace(0, n_timeseries, n_jobs + 1, dtype=int)
+        blocks = _get_dtw_executor(n_jobs).map(
+            partial(_dtw_distance_stats, window=window),
+            [X[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])],
+            [Y[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])],
+        )
+        # Workers only send back their accumulators, never per-pair distances
+        n, mean, m2 = reduce(_merge_distance_stats, blocks)
+    else:
+        n, mean, m2 = _dtw_distance_stats(X, Y, window=window)
 
-    dtw_distances = np.array(dtw_distances)
-    return np.mean(dtw_distances), np.std(dtw_distances)
+    if n == 0:
+        return np.nan, np.nan
+    return mean, np.sqrt(m2 / n)
 
 
 def get_period_bounds(
@@ -66,40 +161,63 @@ def get_period_bounds(
 
 
 def calculate_period_bound_mse(
-    real_dataframe: pd.DataFrame, synthetic_timeseries: np.ndarray
+    real_timeseries: np.ndarray,
+    synthetic_timeseries: np.ndarray,
+    period_ids: np.ndarray,
 ) -> Tuple[float, float]:
     """
     Calculate the Mean Squared Error (MSE) between synthetic and real time series data, considering period bounds.
 
     Args:
-        real_dataframe: DataFrame containing real time series data.
-        synthetic_timeseries: The synthetic time series data.
+        real_timeseries: The real time series data with shape (n_timeseries, timeseries_length, n_dimensions).
+        synthetic_timeseries: The synthetic time series data, row-aligned with real_timeseries.
+        period_ids: Integer id of the (month, weekday) period each row belongs to.
 
     Returns:
         Tuple[float, float]: The mean and standard deviation of the period-bound MSE.
     """
-    mse_list = []
-    n_dimensions = synthetic_timeseries.shape[-1]
+    _, group_ids = np.unique(period_ids, return_inverse=True)
+
+    # Per-timestamp bounds for every period, computed in one pass
+    order = np.argsort(group_ids, kind="stable")
+    sorted_ids = group_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    min_bounds = np.minimum.reduceat(real_timeseries[order], starts, axis=0)
+    max_bounds = np.maximum.reduceat(real_timeseries[order], starts, axis=0)
+
+    # Values inside the bounds are left unchanged by the clip and contribute zero error
+    excess = synthetic_timeseries - np.clip(
+        synthetic_timeseries, min_bounds[group_ids], max_bounds[group_ids]
+    )
+    mse_list = np.mean(excess**2, axis=(1, 2))
 
-    for idx, (_, row) in enumerate(real_dataframe.iterrows()):
-        month, weekday = row["month"], row["weekday"]
+    return np.mean(mse_list), np.std(mse_list)
 
-        mse = 0.0
-        for dim_idx in range(n_dimensions):
-            min_bounds, max_bounds = get_period_bounds(real_dataframe, month, weekday)
-            syn_timeseries = synthetic_timeseries[idx, :, dim_idx]
 
-            for j in range(len(syn_timeseries)):
-                value = syn_timeseries[j]
-                if value < min_bounds[j, dim_idx]:
-                    mse += (value - min_bounds[j, dim_idx]) ** 2
-                elif value > max_bounds[j, dim_idx]:
-                    mse += (value - max_bounds[j, dim_idx]) ** 2
+def _mean_gaussian_kernel(
+    a: np.ndarray, b: np.ndarray, betas: np.ndarray
+) -> np.ndarray:
+    """
+    Mean of the multi-bandwidth Gaussian kernel matrix between the values of `a` and `b`,
+    batched over the leading dimensions.
 
-        mse /= len(syn_timeseries) * n_dimensions
-        mse_list.append(mse)
+    Args:
+        a: Float64 array of shape (..., len_a).
+        b: Float64 array of shape (..., len_b), with the same leading dimensions as a.
+        betas: Kernel coefficients 1 / (2 * sigma), one per bandwidth.
 
-    return np.mean(mse_list), np.std(mse_list)
+    Returns:
+        np.ndarray: Array with the leading dimensions of a and b.
+    """
+    dist = a[..., :, None] - b[..., None, :]
+    np.square(dist, out=dist)
+    kernel = np.empty_like(dist)
+    mean_kernel = 0.0
+    for beta in betas:
+        np.multiply(dist, -beta, out=kernel)
+        np.exp(kernel, out=kernel)
+        mean_kernel = mean_kernel + kernel.mean(axis=(-2, -1))
+    return mean_kernel
 
 
 def calculate_mmd(X: np.ndarray, Y: np.ndarray) -> Tuple[float, float]:
@@ -119,22 +237,28 @@ def calculate_mmd(X: np.ndarray, Y: np.ndarray) -> Tuple[float, float]:
     ), "Input arrays must have the same shape!"
 
     n_timeseries, _, n_dimensions = X.shape
-    discrepancies = []
-    sigmas = [1]
-    gaussian_kernel = partial(gaussian_kernel_matrix, sigmas=np.array(sigmas))
-
-    for i in range(n_timeseries):
-        distances = []
-        for dim in range(n_dimensions):
-            x = np.expand_dims(X[i, :, dim], axis=-1)
-            y = np.expand_dims(Y[i, :, dim], axis=-1)
-            dist = maximum_mean_discrepancy(x, y, gaussian_kernel)
-            distances.append(dist**2)
-
-        mmd = np.sqrt(sum(distances))
-        discrepancies.append(mmd)
+    sigmas = np.array([1.0])
+    betas = 1.0 / (2.0 * sigmas)
+
+    # (n_timeseries, n_dimensions, seq_len), so the MMD of every series and dimension
+    # is computed in batched array operations. Chunks bound the kernel matrices' size.
+    X = np.ascontiguousarray(X.transpose(0, 2, 1), dtype=np.float64)
+    Y = np.ascontiguousarray(Y.transpose(0, 2, 1), dtype=np.float64)
+    max_len = max(X.shape[2], Y.shape[2])
+    chunk_size = max(1, 2**16 // (n_dimensions * max_len**2))
+    discrepancies = np.empty(n_timeseries)
+    for start in range(0, n_timeseries, chunk_size):
+        x = X[start : start + chunk_size]
+        y = Y[start : start + chunk_size]
+        # E[K(x, x)] + E[K(y, y)] - 2 E[K(x, y)], not allowed to become negative
+        cost = (
+            _mean_gaussian_kernel(x, x, betas)
+            + _mean_gaussian_kernel(y, y, betas)
+            - 2 * _mean_gaussian_kernel(x, y, betas)
+        )
+        cost = np.maximum(cost, 0)
+        discrepancies[start : start + chunk_size] = np.sqrt(np.sum(cost**2, axis=1))
 
-    discrepancies = np.array(discrepancies)
     return np.mean(discrepancies), np.std(discrepancies)
 
 
@@ -157,37 +281,95 @@ def calculate_fid(act1: np.ndarray, act2: np.ndarray) -> float:
     if np.iscomplexobj(covmean):
         covmean = covmean.real
 
-    fid = ssdiff + np.trace(sigma1 + sigma2 - 2.0 * covmean)
+    # Trace is linear, so sum per-matrix traces instead of building sigma1 + sigma2 - 2 * covmean
+    fid = ssdiff + np.trace(sigma1) + np.trace(sigma2) - 2.0 * np.trace(covmean)
     return fid
 
 
-def Context_FID(ori_data: np.ndarray, generated_data: np.ndarray) -> float:
+class EmbeddingCache:
+    """
+    Caches TS2Vec encoders and real data representations for the most recently used real
+    data subsets, so evaluating several models on the same subset trains the encoder only
+    once. Each encoder holds GPU memory, so at most `max_entries` of them are kept and the
+    least recently used one is evicted first.
+    """
+
+    def __init__(self, max_entries: int = 2):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _train(ori_data: np.ndarray) -> TS2Vec:
+        model = TS2Vec(
+            input_dims=ori_data.shape[-1],
+            device=0,
+            batch_size=8,
+            lr=0.001,
+            output_dims=320,
+            max_train_length=50000,
+        )
+        model.fit(ori_data, verbose=False)
+        return model
+
+    @staticmethod
+    def _encode(model: TS2Vec, data: np.ndarray) -> np.ndarray:
+        # Inference tolerates bf16; the FID statistics are still computed in float64
+        with torch.autocast(
+            device_type="cuda",
+            dtype=torch.bfloat16,
+            enabled=torch.cuda.is_available(),
+        ):
+            return model.encode(data, encoding_window="full_series")
+
+    def get_or_train(
+        self, key: Hashable, ori_data: np.ndarray, generated_data: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return full-series TS2Vec representations of the original and generated data, training
+        the encoder on the original data only if no encoder is cached under `key`.
+
+        Args:
+            key: Identifier of the original data, e.g. the user id and subset.
+            ori_data: Original time series data.
+            generated_data: Generated time series data.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Original and generated data representations.
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        else:
+            # Release the evicted encoder before training the next one
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            model = self._train(ori_data)
+            ori_representation = self._encode(model, ori_data)
+            self._entries[key] = (model, ori_representation)
+        model, ori_representation = self._entries[key]
+        gen_representation = self._encode(model, generated_data)
+        return ori_representation, gen_representation
+
+
+def Context_FID(
+    ori_data: np.ndarray, generated_data: np.ndarray, embed: bool = True
+) -> float:
     """
     Calculate the FID score between original and generated data representations using TS2Vec embeddings.
 
     Args:
-        ori_data: Original time series data.
-        generated_data: Generated time series data.
+        ori_data: Original time series data, or its TS2Vec representation if `embed` is False.
+        generated_data: Generated time series data, or its TS2Vec representation if `embed` is False.
+        embed: Whether to train a TS2Vec encoder on `ori_data` and embed both inputs first.
 
     Returns:
         float: FID score between the original and generated data representations.
     """
-    model = TS2Vec(
-        input_dims=ori_data.shape[-1],
-        device=0,
-        batch_size=8,
-        lr=0.001,
-        output_dims=320,
-        max_train_length=50000,
-    )
-    model.fit(ori_data, verbose=False)
-    ori_represenation = model.encode(ori_data, encoding_window="full_series")
-    gen_represenation = model.encode(generated_data, encoding_window="full_series")
-    idx = np.random.permutation(ori_data.shape[0])
-    ori_represenation = ori_represenation[idx]
-    gen_represenation = gen_represenation[idx]
-    results = calculate_fid(ori_represenation, gen_represenation)
-    return results
+    if embed:
+        ori_data, generated_data = EmbeddingCache().get_or_train(
+            None, ori_data, generated_data
+        )
+    # FID only depends on the mean and covariance, so the row order is irrelevant
+    return calculate_fid(ori_data, generated_data)
 
 
 def visualization(
@@ -324,7 +506,9 @@ def plot_syn_and_real_comparison(
     )
     filtered_df = df[condition]
 
-    array_data = np.array([ts[:, dimension] for ts in filtered_df["timeseries"]])
+    array_data = np.array(
+        [ts[:, dimension] for ts in filtered_df["timeseries"]], dtype=np.float64
+    )
 
     if array_data.size == 0:
         print(f"No real data for conditioning variables: {conditioning_vars}")
@@ -345,7 +529,9 @@ def plot_syn_and_real_comparison(
         print(f"No synthetic data for conditioning variables: {conditioning_vars}")
         return
 
-    syn_values = np.array([ts[:, dimension] for ts in syn_filtered_df["timeseries"]])
+    syn_values = np.array(
+        [ts[:, dimension] for ts in syn_filtered_df["timeseries"]], dtype=np.float64
+    )
 
     # Generate timestamps at 15-minute intervals
     timestamps = pd.date_range(start="00:00", end="23:45", freq="15min")
@@ -397,7 +583,7 @@ def plot_syn_and_real_comparison(
         closest_real_ts = None
 
         for real_ts in array_data:
-            distance = dtw.distance(syn_ts, real_ts)
+            distance = _dtw_distance(syn_ts, real_ts)
             if distance < min_dtw_distance:
                 min_dtw_distance = distance
                 closest_real_ts = real_ts
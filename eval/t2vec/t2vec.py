@@ -6,7 +6,7 @@ Author: Xinyu Yuan
 License: MIT License
 
 Modifications:
-- None
+- Representations are returned in float32 so that encoding can run under autocast
 
 Note: Please ensure compliance with the repository's license and credit the original authors when using or distributing this code.
 """
@@ -244,7 +244,7 @@ class TS2Vec:
             if slicing is not None:
                 out = out[:, slicing]
 
-        return out.cpu()
+        return out.cpu().float()
 
     def encode(
         self,
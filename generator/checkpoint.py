@@ -0,0 +1,76 @@
+import threading
+
+import torch
+
+
+def copy_to_host(obj, buffers, key=()):
+    """
+    Copy every tensor nested in `obj` into a reusable host buffer from `buffers` (pinned
+    if CUDA is available) without waiting for the copies. Synchronize before reading them.
+    """
+    if isinstance(obj, torch.Tensor):
+        buffer = buffers.get(key)
+        if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+            buffer = buffers[key] = torch.empty(
+                obj.shape, dtype=obj.dtype, pin_memory=torch.cuda.is_available()
+            )
+        return buffer.copy_(obj, non_blocking=True)
+    if isinstance(obj, dict):
+        return {k: copy_to_host(v, buffers, key + (k,)) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(
+            copy_to_host(v, buffers, key + (i,)) for i, v in enumerate(obj)
+        )
+    return obj
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints on a background thread, so serialization and file IO overlap with
+    training. Each checkpoint is snapshotted into host buffers that are reused by the
+    next one, so at most one checkpoint is written at a time. A failed write is raised
+    from the next `wait` or `save` call.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+
+    def save(self, checkpoint, path, message=None):
+        """
+        Snapshot the tensors in `checkpoint` to host memory and write it to `path` in the
+        background, printing `message` once it is written. Call `wait` before reading
+        the file.
+        """
+        # The previous checkpoint may still be written from the same host buffers
+        self.wait()
+        checkpoint = copy_to_host(checkpoint, self._buffers)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self._thread = threading.Thread(
+            target=self._write, args=(checkpoint, path, message)
+        )
+        self._thread.start()
+
+    def _write(self, checkpoint, path, message):
+        try:
+            torch.save(checkpoint, path)
+        except Exception as error:
+            # Raised on the training thread by `wait`
+            self._error = error
+            return
+        if message is not None:
+            print(message)
+
+    def wait(self):
+        """
+        Block until the checkpoint being written by the last `save` call is on disk, and
+        re-raise the exception if writing it failed.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
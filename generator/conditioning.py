@@ -1,12 +1,138 @@
+from functools import partial
+
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from sklearn.mixture import GaussianMixture
+
+
+class GaussianMixture:
+    """
+    Full-covariance Gaussian Mixture Model fitted with EM on the device of its training
+    data, so the fit runs as batched GEMMs instead of on host BLAS.
+
+    Follows scikit-learn's `GaussianMixture(covariance_type="full")`: k-means
+    initialization, `reg_covar` added to every covariance diagonal and convergence once
+    the mean log-likelihood changes by less than `tol`. The fitted attributes
+    (`weights_`, `means_`, `covariances_`, `precisions_cholesky_`) carry the same names
+    and are float64 tensors on that device.
+    """
+
+    def __init__(
+        self, n_components, reg_covar=1e-6, tol=1e-3, max_iter=100, random_state=None
+    ):
+        self.n_components = n_components
+        self.reg_covar = reg_covar
+        self.tol = tol
+        self.max_iter = max_iter
+        self.random_state = random_state
+
+    def fit(self, X):
+        """
+        Args:
+            X (torch.Tensor): shape (num_samples, n_features)
+
+        Returns:
+            GaussianMixture: The fitted model.
+        """
+        X = torch.as_tensor(X, dtype=torch.float64)
+        generator = torch.Generator(device=X.device)
+        if self.random_state is None:
+            generator.seed()
+        else:
+            generator.manual_seed(self.random_state)
+
+        labels = self._kmeans(X, generator)
+        self._m_step(X, F.one_hot(labels, self.n_components).to(X.dtype))
+
+        lower_bound = -np.inf
+        self.converged_ = False
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            log_prob_norm, log_resp = self._e_step(X)
+            self._m_step(X, log_resp.exp())
+            change = log_prob_norm - lower_bound
+            lower_bound = log_prob_norm
+            if abs(change) < self.tol:
+                self.converged_ = True
+                break
+        self.lower_bound_ = lower_bound
+        return self
+
+    def _kmeans(self, X, generator, max_iter=300):
+        """
+        Lloyd's algorithm from k-means++ seeds. Returns the cluster label of every sample.
+        """
+        n_samples = X.shape[0]
+        first = torch.randint(n_samples, (1,), generator=generator, device=X.device)
+        centers = X[first]
+        closest_sq_dist = torch.cdist(X, centers).squeeze(1) ** 2
+        for _ in range(1, self.n_components):
+            weights = closest_sq_dist
+            if not weights.any():
+                # Fewer distinct samples than components: any sample will do
+                weights = torch.ones_like(weights)
+            new = torch.multinomial(weights, 1, generator=generator)
+            centers = torch.cat([centers, X[new]])
+            closest_sq_dist = torch.minimum(
+                closest_sq_dist, torch.cdist(X, X[new]).squeeze(1) ** 2
+            )
+
+        labels = None
+        for _ in range(max_iter):
+            new_labels = torch.cdist(X, centers).argmin(dim=1)
+            if labels is not None and torch.equal(new_labels, labels):
+                break
+            labels = new_labels
+            counts = torch.bincount(labels, minlength=self.n_components)
+            sums = torch.zeros_like(centers).index_add_(0, labels, X)
+            # Empty clusters keep their previous center
+            centers = torch.where(
+                counts[:, None] > 0, sums / counts.clamp(min=1)[:, None], centers
+            )
+        return labels
+
+    def _e_step(self, X):
+        """
+        Returns:
+            log_prob_norm (float): Mean log-likelihood of X.
+            log_resp (torch.Tensor): Log-responsibilities, shape (num_samples, n_components).
+        """
+        weighted_log_prob = self._estimate_weighted_log_prob(X)
+        log_prob_norm = torch.logsumexp(weighted_log_prob, dim=1)
+        log_resp = weighted_log_prob - log_prob_norm[:, None]
+        return log_prob_norm.mean().item(), log_resp
+
+    def _m_step(self, X, resp):
+        n_samples, n_features = X.shape
+        nk = resp.sum(dim=0) + 10 * torch.finfo(resp.dtype).eps
+        self.weights_ = nk / n_samples
+        self.means_ = (resp.T @ X) / nk[:, None]
+
+        diff = X.unsqueeze(0) - self.means_.unsqueeze(1)
+        covariances = (resp.T.unsqueeze(-1) * diff).mT @ diff / nk[:, None, None]
+        eye = torch.eye(n_features, dtype=X.dtype, device=X.device)
+        self.covariances_ = covariances + self.reg_covar * eye
+
+        cov_chol = torch.linalg.cholesky(self.covariances_)
+        self.precisions_cholesky_ = torch.linalg.solve_triangular(
+            cov_chol, eye.expand_as(cov_chol), upper=False
+        ).mT
+
+    def _estimate_weighted_log_prob(self, X):
+        chol = self.precisions_cholesky_
+        log_det = torch.log(torch.diagonal(chol, dim1=-2, dim2=-1)).sum(dim=-1)
+        y = torch.einsum("nd,kde->nke", X, chol) - torch.einsum(
+            "kd,kde->ke", self.means_, chol
+        )
+        sq_mahalanobis = torch.einsum("nke,nke->nk", y, y)
+        log_gaussian = log_det - 0.5 * (X.shape[1] * np.log(2 * np.pi) + sq_mahalanobis)
+        return log_gaussian + torch.log(self.weights_)
 
 
 class ConditioningModule(nn.Module):
-    def __init__(self, categorical_dims, embedding_dim, device, n_components=10):
+    def __init__(
+        self, categorical_dims, embedding_dim, device, n_components=10, compile=False
+    ):
         """
         Args:
             categorical_dims (dict): {var_name: num_categories} for each conditioning variable.
@@ -14,25 +140,50 @@ class ConditioningModule(nn.Module):
             device: Torch device (CPU or GPU).
             n_components (int): Number of components for the Gaussian Mixture Model.
             kl_alpha (float): Weight for KL regularization (hyperparam).
+            compile (bool): If True, compile the forward pass (embedding lookups, MLP and
+                reparameterization) with torch.compile.
         """
         super().__init__()
         self.embedding_dim = embedding_dim
         self.device = device
 
-        self.category_embeddings = nn.ModuleDict(
+        self._names = tuple(categorical_dims.keys())
+        total_dim = len(categorical_dims) * embedding_dim
+        hidden_dim = 128
+
+        # Concatenating per-variable embeddings and applying a Linear layer equals summing
+        # each embedding table projected through its slice of the weight. Each table is
+        # therefore stored pre-projected to the hidden size, initialized from that
+        # composition so training starts from the same distribution.
+        category_embeddings = {
+            name: nn.Embedding(num_categories, embedding_dim)
+            for name, num_categories in categorical_dims.items()
+        }
+        first_layer = nn.Linear(total_dim, hidden_dim)
+        self.fused_embeddings = nn.ModuleDict(
             {
-                name: nn.Embedding(num_categories, embedding_dim)
+                name: nn.Embedding(num_categories, hidden_dim)
                 for name, num_categories in categorical_dims.items()
             }
-        ).to(device)
-
-        total_dim = len(categorical_dims) * embedding_dim
+        )
+        with torch.no_grad():
+            for name, weight_slice in zip(
+                self._names, first_layer.weight.split(embedding_dim, dim=1)
+            ):
+                self.fused_embeddings[name].weight.copy_(
+                    category_embeddings[name].weight @ weight_slice.T
+                )
+        self.fused_bias = nn.Parameter(first_layer.bias.detach().clone())
 
         self.mlp = nn.Sequential(
-            nn.Linear(total_dim, 128),
             nn.ReLU(),
-            nn.Linear(128, 2 * embedding_dim),
-        ).to(device)
+            nn.Linear(hidden_dim, 2 * embedding_dim),
+        )
+        self.to(device)
+
+        if compile:
+            # Batch sizes vary between training, GMM fitting and sampling
+            self.compile(dynamic=True)
 
         # ====== GMM-Related Attributes ======
         self.n_components = n_components
@@ -44,7 +195,9 @@ class ConditioningModule(nn.Module):
         Forward pass to compute mu and (optionally) sample z via reparameterization.
 
         Args:
-            categorical_vars (dict): e.g. {var_name: Tensor[int64]}
+            categorical_vars (dict): e.g. {var_name: Tensor[int64]}, already on `self.device`.
+                Callers move the codes once per batch (non-blocking from pinned memory) so the
+                forward pass does not issue host-to-device copies of its own.
             sample (bool): If True, return z = mu + sigma*eps, else return mu.
 
         Returns:
@@ -52,13 +205,11 @@ class ConditioningModule(nn.Module):
             mu (Tensor): The mean of the embedding distribution (shape: [batch_size, embedding_dim]).
             logvar (Tensor): Log-variance (shape: [batch_size, embedding_dim]).
         """
-        embeddings = []
-        for name, embedding_layer in self.category_embeddings.items():
-            cat_tensor = categorical_vars[name].to(self.device)
-            embeddings.append(embedding_layer(cat_tensor))
+        hidden = self.fused_bias
+        for name in self._names:
+            hidden = hidden + self.fused_embeddings[name](categorical_vars[name])
 
-        conditioning_matrix = torch.cat(embeddings, dim=1)
-        stats = self.mlp(conditioning_matrix)
+        stats = self.mlp(hidden)
         mu = stats[:, : self.embedding_dim]
         logvar = stats[:, self.embedding_dim :]
 
@@ -69,6 +220,29 @@ class ConditioningModule(nn.Module):
 
         return z, mu, logvar
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """
+        Convert checkpoints saved with separate embeddings and a first Linear layer
+        into the fused layout before loading.
+        """
+        first_weight_key = prefix + "mlp.0.weight"
+        if first_weight_key in state_dict:
+            first_weight = state_dict.pop(first_weight_key)
+            state_dict[prefix + "fused_bias"] = state_dict.pop(prefix + "mlp.0.bias")
+            offset = 0
+            for name in self._names:
+                table = state_dict.pop(f"{prefix}category_embeddings.{name}.weight")
+                weight_slice = first_weight[:, offset : offset + table.shape[1]]
+                state_dict[f"{prefix}fused_embeddings.{name}.weight"] = (
+                    table @ weight_slice.T
+                )
+                offset += table.shape[1]
+            for param in ("weight", "bias"):
+                state_dict[f"{prefix}mlp.1.{param}"] = state_dict.pop(
+                    f"{prefix}mlp.2.{param}"
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     @staticmethod
     def reparameterize(mu, logvar):
         """
@@ -90,17 +264,16 @@ class ConditioningModule(nn.Module):
 
     def fit_gmm(self, embeddings):
         """
-        Fit a Gaussian Mixture Model (GMM) to the provided embeddings (mu).
+        Fit a Gaussian Mixture Model (GMM) to the provided embeddings (mu) on `self.device`.
 
         Args:
             embeddings (torch.Tensor or np.ndarray): shape (num_samples, embedding_dim)
         """
         if isinstance(embeddings, torch.Tensor):
-            embeddings = embeddings.cpu().numpy()
+            embeddings = embeddings.detach()
+        embeddings = torch.as_tensor(embeddings, device=self.device)
 
-        self.gmm = GaussianMixture(
-            n_components=self.n_components, covariance_type="full", random_state=42
-        )
+        self.gmm = GaussianMixture(n_components=self.n_components, random_state=42)
         self.gmm.fit(embeddings)
 
     def set_rare_threshold(self, embeddings, fraction=0.1):
@@ -115,17 +288,54 @@ class ConditioningModule(nn.Module):
         if self.gmm is None:
             raise ValueError("GMM is not fitted. Call `fit_gmm` first.")
 
-        if isinstance(embeddings, torch.Tensor):
-            embeddings = embeddings.cpu().numpy()
+        log_probs = self.compute_log_likelihood(embeddings)
+        # Interpolate between the order statistics around the percentile like
+        # np.percentile, selecting them without a full sort
+        n = log_probs.numel()
+        rank = fraction * (n - 1)
+        below = int(rank)
+        lower = log_probs.kthvalue(below + 1).values
+        upper = log_probs.kthvalue(min(below + 2, n)).values
+        self.log_prob_threshold = torch.lerp(lower, upper, rank - below).item()
+
+    def _gmm_parameters(self):
+        """
+        Device-side terms of the fitted GMM's log-density that do not depend on the input.
+        Rebuilt whenever the GMM is replaced or refitted.
+
+        Returns:
+            precisions_chol (torch.Tensor): shape (n_components, embedding_dim, embedding_dim)
+            whitened_means (torch.Tensor): means projected by precisions_chol, shape (n_components, embedding_dim)
+            log_norm (torch.Tensor): log-weight plus Gaussian normalizer per component, shape (n_components,)
+        """
+        precisions_chol = self.gmm.precisions_cholesky_
+        if getattr(self, "_gmm_params_source", None) is not precisions_chol:
+            # Evaluated in float64 on this module's device, wherever the GMM was fitted
+            to_tensor = partial(
+                torch.as_tensor, dtype=torch.float64, device=self.device
+            )
+            chol = to_tensor(precisions_chol)
+            means = to_tensor(self.gmm.means_)
+            log_weights = torch.log(to_tensor(self.gmm.weights_))
 
-        log_probs = self.gmm.score_samples(embeddings)
-        cutoff = np.percentile(log_probs, fraction * 100)
-        self.log_prob_threshold = cutoff
+            log_det = torch.log(torch.diagonal(chol, dim1=-2, dim2=-1)).sum(dim=-1)
+            log_norm = log_weights + log_det - 0.5 * means.shape[1] * np.log(2 * np.pi)
+
+            self._gmm_params = (
+                chol,
+                torch.einsum("kd,kde->ke", means, chol),
+                log_norm,
+            )
+            self._gmm_params_source = precisions_chol
+        return self._gmm_params
 
     def compute_log_likelihood(self, embeddings):
         """
         Compute the log probability of each embedding under the GMM.
 
+        The density is evaluated on the embeddings' device from the GMM's precision Cholesky
+        factors, so no covariance is inverted and no host round trip is needed.
+
         Args:
             embeddings (torch.Tensor): shape (batch_size, embedding_dim)
 
@@ -135,14 +345,19 @@ class ConditioningModule(nn.Module):
         if self.gmm is None:
             raise ValueError("GMM is not fitted. Call `fit_gmm` first.")
 
+        precisions_chol, whitened_means, log_norm = self._gmm_parameters()
         if isinstance(embeddings, torch.Tensor):
-            embeddings_np = embeddings.cpu().numpy()
-        else:
-            embeddings_np = embeddings
+            embeddings = embeddings.detach()
+        x = torch.as_tensor(embeddings, dtype=torch.float64, device=self.device)
+
+        # Whitened residuals per component, shape: (batch_size, n_components, embedding_dim)
+        y = torch.einsum("nd,kde->nke", x, precisions_chol) - whitened_means
+
+        # Squared Mahalanobis distance to each component, shape: (batch_size, n_components)
+        sq_mahalanobis = torch.einsum("nke,nke->nk", y, y)
 
         # shape: (batch_size,)
-        log_probs_np = self.gmm.score_samples(embeddings_np)
-        return torch.from_numpy(log_probs_np).to(self.device)
+        return torch.logsumexp(log_norm - 0.5 * sq_mahalanobis, dim=1)
 
     def is_rare(self, embeddings):
         """
@@ -20,24 +20,34 @@ import copy
 import math
 import os
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from omegaconf import DictConfig
-from sklearn.mixture import GaussianMixture
+from torch.nn.parallel import DistributedDataParallel as DDP
 from tqdm.auto import tqdm
 
-from datasets.utils import prepare_dataloader
+from datasets.utils import PrefetchLoader, prepare_dataloader
+from generator.checkpoint import AsyncCheckpointWriter
 from generator.conditioning import ConditioningModule
 from generator.diffcharge.network import CNN, Attention
-from generator.diffusion_ts.gaussian_diffusion import cosine_beta_schedule
+from generator.distributed import (
+    all_gather_tensor,
+    broadcast_object,
+    is_distributed,
+    is_main_process,
+    no_sync,
+    setup_ddp,
+)
 
 try:
     import wandb
 except ImportError:
     wandb = None
 
+# Let float32 matmuls use TF32 tensor cores on GPUs that support them
+torch.backends.cuda.matmul.allow_tf32 = True
+
 
 def linear_beta_schedule(timesteps, device):
     scale = 1000 / timesteps
@@ -57,28 +67,63 @@ def cosine_beta_schedule(timesteps, device, s=0.004):
     return torch.clip(betas, 0, 0.999).to(device)
 
 
+def _q_sample(x0, sqrt_alpha_bar, sqrt_one_minus_alpha_bar, eps):
+    return sqrt_alpha_bar * x0 + sqrt_one_minus_alpha_bar * eps
+
+
+def _posterior_step(xt, eps_theta, eps_coef, inv_sqrt_alpha, sqrt_sigma2, noise):
+    return (xt - eps_coef * eps_theta) * inv_sqrt_alpha + sqrt_sigma2 * noise
+
+
 class EMA:
-    def __init__(self, model, beta, update_every, device):
+    def __init__(self, model, beta, update_every, device, compile=False):
         self.model = model
-        self.ema_model = copy.deepcopy(model).eval().to(device)
+        self.model_params = list(model.parameters())
+        # Only the averaged parameters and a snapshot of the buffers are kept; the
+        # module evaluating them is built on first use of `ema_model` and wraps these
+        # tensors instead of copying them.
+        self.ema_params = [p.detach().clone().to(device) for p in model.parameters()]
+        self.ema_buffers = [b.detach().clone().to(device) for b in model.buffers()]
         self.beta = beta
         self.update_every = update_every
         self.step = 0
         self.device = device
-        for param in self.ema_model.parameters():
-            param.requires_grad = False
+        self.compile = compile
+        self._ema_model = None
+
+    @property
+    def ema_model(self):
+        if self._ema_model is None:
+            memo = {
+                id(param): nn.Parameter(ema_param, requires_grad=False)
+                for param, ema_param in zip(self.model.parameters(), self.ema_params)
+            }
+            memo.update(
+                (id(buffer), ema_buffer)
+                for buffer, ema_buffer in zip(self.model.buffers(), self.ema_buffers)
+            )
+            self._ema_model = copy.deepcopy(self.model, memo).eval()
+            if self.compile:
+                self._ema_model.compile(dynamic=True)
+        return self._ema_model
+
+    def to(self, device):
+        self.device = device
+        self.ema_params = [p.to(device) for p in self.ema_params]
+        self.ema_buffers = [b.to(device) for b in self.ema_buffers]
+        self._ema_model = None
+        return self
 
     def update(self):
         self.step += 1
         if self.step % self.update_every != 0:
             return
+        # One multi-tensor kernel per operation instead of two launches per parameter
         with torch.no_grad():
-            for ema_param, model_param in zip(
-                self.ema_model.parameters(), self.model.parameters()
-            ):
-                ema_param.data.mul_(self.beta).add_(
-                    model_param.data, alpha=1.0 - self.beta
-                )
+            torch._foreach_mul_(self.ema_params, self.beta)
+            torch._foreach_add_(
+                self.ema_params, self.model_params, alpha=1.0 - self.beta
+            )
 
     def forward(self, x):
         return self.ema_model(x)
@@ -100,6 +145,7 @@ class DDPM(nn.Module):
             categorical_dims=cfg.dataset.conditioning_vars,
             embedding_dim=cfg.model.cond_emb_dim,
             device=self.device,
+            compile=cfg.model.use_compile,
         ).to(self.device)
 
         if cfg.model.network == "attention":
@@ -122,14 +168,7 @@ class DDPM(nn.Module):
                 ** 2
             )
 
-        self.alpha = 1.0 - self.beta
-        self.alpha_bar = torch.cumprod(self.alpha, dim=0)
-        self.sigma2 = torch.cat(
-            (
-                torch.tensor([self.beta[0]], device=self.device),
-                self.beta[1:] * (1 - self.alpha_bar[:-1]) / (1 - self.alpha_bar[1:]),
-            )
-        )
+        self._set_schedule(self.beta)
         self.optimizer = torch.optim.Adam(
             self.eps_model.parameters(), lr=cfg.model.init_lr
         )
@@ -146,14 +185,30 @@ class DDPM(nn.Module):
             beta=cfg.model.ema_decay,
             update_every=cfg.model.ema_update_interval,
             device=self.device,
+            compile=cfg.model.use_compile,
         )
+        if cfg.model.use_compile:
+            # Shapes vary with the rare/non-rare split, so graphs are traced with dynamic
+            # shapes instead of captured as CUDA graphs.
+            self.eps_model.compile(dynamic=True)
+            # Fuse the elementwise forward and reverse process updates into one kernel each
+            self._q_sample = torch.compile(_q_sample, dynamic=True, fullgraph=True)
+            self._posterior_step = torch.compile(
+                _posterior_step, dynamic=True, fullgraph=True
+            )
+        else:
+            self._q_sample = _q_sample
+            self._posterior_step = _posterior_step
         self.sparse_conditioning_loss_weight = cfg.model.sparse_conditioning_loss_weight
         self.warm_up_epochs = cfg.model.warm_up_epochs
         self.kl_weight = cfg.model.kl_weight
         self.gmm_fitted = False
         self.wandb_enabled = getattr(self.cfg, "wandb_enabled", False)
+        self._checkpoint_writer = AsyncCheckpointWriter()
+        self._noise_buffer = None
+        self._t_buffer = None
 
-        if self.wandb_enabled and wandb is not None:
+        if self.wandb_enabled and wandb is not None and is_main_process():
             wandb.init(
                 project=cfg.wandb.project,
                 entity=cfg.wandb.entity,
@@ -161,149 +216,265 @@ class DDPM(nn.Module):
                 dir=cfg.run_dir,
             )
 
+    def _set_schedule(self, beta):
+        """
+        Set the noise schedule and precompute every per-step coefficient used by the forward
+        and reverse processes, so that training and sampling only gather them.
+        """
+        self.beta = beta
+        self.alpha = 1.0 - beta
+        self.alpha_bar = torch.cumprod(self.alpha, dim=0)
+        self.sigma2 = torch.empty_like(beta)
+        self.sigma2[0] = beta[0]
+        self.sigma2[1:] = (
+            beta[1:] * (1 - self.alpha_bar[:-1]) / (1 - self.alpha_bar[1:])
+        )
+        self.sqrt_alpha_bar = self.alpha_bar.sqrt()
+        self.sqrt_one_minus_alpha_bar = (1 - self.alpha_bar).sqrt()
+        self.inv_sqrt_alpha = self.alpha.rsqrt()
+        self.eps_coef = (1 - self.alpha) / self.sqrt_one_minus_alpha_bar
+        self.sqrt_sigma2 = self.sigma2.sqrt()
+
     def gather(self, const, t):
         return const.gather(-1, t).view(-1, 1, 1)
 
     def q_xt_x0(self, x0, t):
-        alpha_bar = self.gather(self.alpha_bar, t)
-        mean = alpha_bar.sqrt() * x0
-        var = 1 - alpha_bar
+        mean = self.gather(self.sqrt_alpha_bar, t) * x0
+        var = 1 - self.gather(self.alpha_bar, t)
         return mean, var
 
     def q_sample(self, x0, t, eps):
-        mean, var = self.q_xt_x0(x0, t)
-        return mean + var.sqrt() * eps
+        return self._q_sample(
+            x0,
+            self.gather(self.sqrt_alpha_bar, t),
+            self.gather(self.sqrt_one_minus_alpha_bar, t),
+            eps,
+        )
 
     def p_sample_step(self, xt, z, t):
         eps_theta = self.eps_model(torch.cat([xt, z], dim=-1), t)
-        alpha_bar = self.gather(self.alpha_bar, t)
-        alpha = self.gather(self.alpha, t)
-        eps_coef = (1 - alpha) / (1 - alpha_bar).sqrt()
-        mean = (xt - eps_coef * eps_theta) / alpha.sqrt()
-        var = self.gather(self.sigma2, t)
-        z_noise = torch.zeros_like(xt) if (t == 0).all() else torch.randn_like(xt)
-        return mean + var.sqrt() * z_noise
-
-    def cal_loss(self, x0, z):
+        # No noise is added at the last step; masking its scale per sample instead of
+        # branching on `t` avoids a device-to-host sync
+        noise_scale = self.gather(self.sqrt_sigma2, t) * (t > 0).view(-1, 1, 1)
+        return self._posterior_step(
+            xt,
+            eps_theta,
+            self.gather(self.eps_coef, t),
+            self.gather(self.inv_sqrt_alpha, t),
+            noise_scale,
+            torch.randn_like(xt),
+        )
+
+    def _draw_t_and_noise(self, x0):
+        """
+        Random timesteps and Gaussian noise for a batch like `x0`, drawn in place into
+        buffers that are reused across training steps instead of allocated per step.
+        Each step's backward pass runs before the next draw overwrites them.
+        """
         bsz = x0.shape[0]
-        t = torch.randint(0, self.n_steps, (bsz,), device=self.device)
-        noise = torch.randn_like(x0)
+        buffer = self._noise_buffer
+        if (
+            buffer is None
+            or buffer.shape[0] < bsz
+            or buffer.shape[1:] != x0.shape[1:]
+            or buffer.dtype != x0.dtype
+            or buffer.device != x0.device
+        ):
+            self._noise_buffer = torch.empty_like(x0)
+            self._t_buffer = torch.empty(bsz, dtype=torch.long, device=x0.device)
+        t = self._t_buffer[:bsz].random_(0, self.n_steps)
+        noise = self._noise_buffer[:bsz].normal_()
+        return t, noise
+
+    def cal_loss(self, x0, z, eps_model=None, weights=None):
+        """
+        Denoising loss of a batch. If `weights` of shape (batch_size,) are given, returns the
+        batch mean of the per-sample losses scaled by them.
+        """
+        eps_model = eps_model or self.eps_model
+        t, noise = self._draw_t_and_noise(x0)
         xt = self.q_sample(x0, t, eps=noise)
         B, seq_len, input_dim = xt.shape
         cond_dim = z.shape[1]
-        z_expanded = z.unsqueeze(1).repeat(1, seq_len, 1)
+        z_expanded = z.unsqueeze(1).expand(-1, seq_len, -1)
         inp = torch.cat([xt, z_expanded], dim=-1)
-        eps_theta = self.eps_model(inp, t)
+        eps_theta = eps_model(inp, t)
 
-        return self.loss_func(noise, eps_theta)
+        if weights is None:
+            return self.loss_func(noise, eps_theta)
+        per_sample = F.mse_loss(eps_theta, noise, reduction="none").mean(dim=(1, 2))
+        return (weights * per_sample).mean()
 
     def fit_gmm(self, loader):
         all_mu = []
         self.conditioning_module.eval()
         with torch.no_grad():
-            for x0, cond_vars in loader:
-                x0 = x0.to(self.device)
+            # Only the conditioning codes are needed, so the time series stay on the host
+            for _, cond_vars in loader:
                 for k in cond_vars:
-                    cond_vars[k] = cond_vars[k].to(self.device)
+                    cond_vars[k] = cond_vars[k].to(self.device, non_blocking=True)
                 _, mu, logvar = self.conditioning_module(cond_vars, sample=False)
-                all_mu.append(mu.cpu())
+                all_mu.append(mu)
         all_mu = torch.cat(all_mu, dim=0)
-        self.conditioning_module.gmm = GaussianMixture(
-            n_components=self.conditioning_module.n_components,
-            covariance_type="full",
-            random_state=42,
-        )
-        self.conditioning_module.gmm.fit(all_mu.numpy())
-        log_probs = self.conditioning_module.gmm.score_samples(all_mu.numpy())
-        cutoff = np.percentile(log_probs, 10.0)
-        self.conditioning_module.log_prob_threshold = cutoff
+
+        if not is_distributed():
+            self.conditioning_module.fit_gmm(all_mu)
+            self.conditioning_module.set_rare_threshold(all_mu, fraction=0.1)
+        else:
+            # Fit on rank 0 with every shard's embeddings, then share the result
+            all_mu = all_gather_tensor(all_mu)
+            if is_main_process():
+                self.conditioning_module.fit_gmm(all_mu)
+                self.conditioning_module.set_rare_threshold(all_mu, fraction=0.1)
+            cond = self.conditioning_module
+            cond.gmm, cond.log_prob_threshold = broadcast_object(
+                (cond.gmm, cond.log_prob_threshold)
+            )
         self.gmm_fitted = True
 
+    def _setup_distributed(self):
+        """
+        Join the process group started by torchrun and move all state to this process's GPU.
+
+        Returns:
+            Tuple[DDP, DDP]: Wrapped eps model and conditioning module for the training forward.
+        """
+        self.device = setup_ddp()
+        self.conditioning_module.device = self.device
+        self.to(self.device)
+        self.ema.to(self.device)
+        self._set_schedule(self.beta.to(self.device))
+
+        eps_model = DDP(
+            self.eps_model,
+            device_ids=[self.device.index],
+            broadcast_buffers=False,
+        )
+        conditioning_module = DDP(
+            self.conditioning_module,
+            device_ids=[self.device.index],
+            broadcast_buffers=False,
+        )
+        return eps_model, conditioning_module
+
+    def _training_loss(self, x0, cond_vars, eps_model, conditioning_module):
+        """
+        Loss of one batch: the KL-regularized reconstruction loss during warm-up, and the
+        rare/non-rare weighted reconstruction loss afterwards.
+        """
+        z, mu, logvar = conditioning_module(cond_vars, sample=False)
+
+        if self.current_epoch <= self.warm_up_epochs:
+            loss_main = self.cal_loss(x0, z, eps_model)
+            if mu is not None and logvar is not None:
+                kl_loss_val = self.conditioning_module.kl_divergence(mu, logvar)
+                loss_main = loss_main + self.kl_weight * kl_loss_val
+                if self.wandb_enabled and wandb is not None and is_main_process():
+                    wandb.log({"Loss/KL": kl_loss_val.item()})
+        else:
+            with torch.no_grad():
+                mu_detach = mu.detach()
+                if self.gmm_fitted:
+                    is_rare = self.conditioning_module.is_rare(mu_detach)
+                else:
+                    is_rare = torch.zeros(
+                        x0.size(0), dtype=torch.bool, device=self.device
+                    )
+
+            # lam * (N_r / N) * mean rare loss + (1 - lam) * (N_nr / N) * mean non-rare loss
+            # is the batch mean of per-sample losses weighted by lam or 1 - lam, so a single
+            # forward pass over the whole batch suffices
+            lam = self.sparse_conditioning_loss_weight
+            weights = torch.where(is_rare, lam, 1 - lam)
+            loss_main = self.cal_loss(x0, z, eps_model, weights=weights)
+
+        return loss_main
+
     def train_model(self, train_dataset):
+        """
+        Train the model. When launched with torchrun on several GPUs, the eps model and the
+        conditioning module are trained with DistributedDataParallel, each process on its own
+        shard of the dataset.
+        """
         self.train()
-        self.to(self.device)
-        train_loader = prepare_dataloader(
-            train_dataset, batch_size=self.cfg.model.batch_size, shuffle=True
+        distributed = is_distributed()
+        if distributed:
+            eps_model, conditioning_module = self._setup_distributed()
+        else:
+            self.to(self.device)
+            eps_model, conditioning_module = self.eps_model, self.conditioning_module
+
+        train_loader = PrefetchLoader(
+            prepare_dataloader(
+                train_dataset,
+                batch_size=self.cfg.model.batch_size,
+                shuffle=True,
+                num_workers=self.cfg.model.num_workers,
+                prefetch_factor=self.cfg.model.prefetch_factor,
+                distributed=distributed,
+            ),
+            self.device,
         )
+        main_process = is_main_process()
+        grad_accum = self.cfg.model.grad_accum
         n_epochs = self.cfg.model.n_epochs
-        for epoch in tqdm(range(n_epochs), desc="DDPM Training"):
+        self.optimizer.zero_grad(set_to_none=True)
+        epoch_bar = tqdm(
+            range(n_epochs), desc="DDPM Training", disable=not main_process
+        )
+        for epoch in epoch_bar:
             self.current_epoch = epoch + 1
-            batch_losses = []
+            if distributed:
+                train_loader.sampler.set_epoch(epoch)
+            batch_losses = torch.empty(len(train_loader), device=self.device)
             if self.current_epoch > self.warm_up_epochs:
                 for param in self.conditioning_module.parameters():
                     param.requires_grad = False
+                # Frozen, so there are no gradients left to synchronize
+                conditioning_module = self.conditioning_module
+
+            loader_it = tqdm(
+                train_loader,
+                desc=f"Epoch {epoch+1}",
+                leave=False,
+                disable=not main_process,
+            )
+            for i, (x0, cond_vars) in enumerate(loader_it):
+                # Gradients are only all-reduced and applied on the last micro-batch
+                sync = (i + 1) % grad_accum == 0 or i + 1 == len(train_loader)
 
-            loader_it = tqdm(train_loader, desc=f"Epoch {epoch+1}", leave=False)
-            for x0, cond_vars in loader_it:
-                x0 = x0.to(self.device)
-                for k in cond_vars:
-                    cond_vars[k] = cond_vars[k].to(self.device)
-
-                z, mu, logvar = self.conditioning_module(cond_vars, sample=False)
-
-                if self.current_epoch <= self.warm_up_epochs:
-                    loss_main = self.cal_loss(x0, z)
-                    if mu is not None and logvar is not None:
-                        kl_loss_val = self.conditioning_module.kl_divergence(mu, logvar)
-                        loss_main = loss_main + self.kl_weight * kl_loss_val
-                        if self.wandb_enabled and wandb is not None:
-                            wandb.log({"Loss/KL": kl_loss_val.item()})
-                else:
-                    with torch.no_grad():
-                        mu_detach = mu.detach()
-                        if self.gmm_fitted:
-                            rare_mask = (
-                                self.conditioning_module.is_rare(mu_detach)
-                                .float()
-                                .to(self.device)
-                            )
-                        else:
-                            rare_mask = torch.zeros(x0.size(0), device=self.device)
-
-                    rare_idx = (rare_mask == 1.0).nonzero(as_tuple=True)[0]
-                    non_rare_idx = (rare_mask == 0.0).nonzero(as_tuple=True)[0]
-                    loss_rare = torch.tensor(0.0, device=self.device)
-                    loss_non_rare = torch.tensor(0.0, device=self.device)
-
-                    if len(rare_idx) > 0:
-                        x0_rare = x0[rare_idx]
-                        z_rare = z[rare_idx]
-                        loss_rare = self.cal_loss(x0_rare, z_rare)
-
-                    if len(non_rare_idx) > 0:
-                        x0_non_rare = x0[non_rare_idx]
-                        z_non_rare = z[non_rare_idx]
-                        loss_non_rare = self.cal_loss(x0_non_rare, z_non_rare)
-
-                    N_r = rare_mask.sum().item()
-                    N_nr = (1 - rare_mask).sum().item()
-                    N = x0.size(0)
-                    lam = self.sparse_conditioning_loss_weight
-                    loss_main = (
-                        lam * (N_r / N) * loss_rare
-                        + (1 - lam) * (N_nr / N) * loss_non_rare
+                with no_sync(eps_model, conditioning_module, enabled=not sync):
+                    loss_main = self._training_loss(
+                        x0, cond_vars, eps_model, conditioning_module
                     )
+                    (loss_main / grad_accum).backward()
 
-                self.optimizer.zero_grad()
-                loss_main.backward()
-                self.optimizer.step()
-                self.ema.update()
+                if sync:
+                    self.optimizer.step()
+                    self.optimizer.zero_grad(set_to_none=True)
+                    self.ema.update()
 
-                batch_losses.append(loss_main.item())
-                if self.wandb_enabled and wandb is not None:
+                batch_losses[i] = loss_main.detach()
+                if self.wandb_enabled and wandb is not None and main_process:
                     wandb.log({"Loss/reconstruction": loss_main.item()})
 
-            epoch_loss = sum(batch_losses) / len(batch_losses)
-            loader_it.set_postfix({"Epoch Loss": epoch_loss})
-            print(f"Epoch {epoch+1}/{n_epochs}, Loss: {epoch_loss:.4f}")
+            if distributed:
+                # Every process steps the scheduler with the same loss, so the learning
+                # rates stay in sync
+                batch_losses = all_gather_tensor(batch_losses)
+            epoch_loss = batch_losses.mean().item()
+            # Shown on the progress bar instead of printed, so there is no extra stdout
+            # write and flush per epoch
+            epoch_bar.set_postfix({"Epoch Loss": f"{epoch_loss:.4f}"})
             self.lr_scheduler.step(epoch_loss)
 
             if self.current_epoch == self.warm_up_epochs and not self.gmm_fitted:
-                self.fit_gmm(train_loader)
+                self.fit_gmm(train_loader.loader)
 
-            if (epoch + 1) % self.cfg.model.save_cycle == 0:
+            if (epoch + 1) % self.cfg.model.save_cycle == 0 and main_process:
                 self.save(epoch=self.current_epoch)
 
+        self.wait_for_checkpoint()
         print("Training complete")
 
     @torch.no_grad()
@@ -312,22 +483,66 @@ class DDPM(nn.Module):
         device = self.device
         x = torch.randn(shape, device=device)
         z, mu, logvar = self.conditioning_module(cond_vars, sample=True)
-        for t in tqdm(reversed(range(self.n_steps)), desc="DDPM Sampling"):
+        # The conditioning part of the model input is the same at every step, so it is
+        # written once and only the noisy sample is copied in per step
+        input_dim = x.shape[-1]
+        inp = torch.empty((*x.shape[:-1], input_dim + z.shape[-1]), device=device)
+        inp[..., input_dim:] = z.unsqueeze(1)
+        # Only the eps model runs in reduced precision; x is updated in float32
+        device_type = torch.device(device).type
+        autocast = torch.autocast(
+            device_type=device_type,
+            dtype=torch.bfloat16,
+            enabled=self.cfg.model.amp_sampling and device_type == "cuda",
+        )
+        n_inference_steps = self.cfg.model.n_inference_steps
+        if n_inference_steps:
+            # DDIM (eta = 0) over evenly spaced steps. Its update
+            #   x' = sqrt(ab') * (x - sqrt(1 - ab) * eps) / sqrt(ab) + sqrt(1 - ab') * eps
+            # is a posterior step whose noise is the predicted eps itself.
+            # Spaced down from the last step, so even a single step starts from pure noise
+            timesteps = torch.linspace(
+                self.n_steps - 1, 0, min(n_inference_steps, self.n_steps), device=device
+            )
+            timesteps = timesteps.round().long().flip(0)
+            alpha_bar = self.alpha_bar[timesteps]
+            alpha_bar_prev = torch.cat([alpha_bar.new_ones(1), alpha_bar[:-1]])
+            steps = zip(
+                timesteps.tolist(),
+                (1 - alpha_bar).sqrt(),
+                (alpha_bar_prev / alpha_bar).sqrt(),
+                (1 - alpha_bar_prev).sqrt(),
+            )
+        else:
+            steps = zip(
+                range(self.n_steps),
+                self.eps_coef,
+                self.inv_sqrt_alpha,
+                self.sqrt_sigma2,
+            )
+        # Every sample is at the same step, so the coefficients are scalars
+        for t, eps_coef, inv_sqrt_alpha, noise_scale in tqdm(
+            reversed(list(steps)), desc="DDPM Sampling"
+        ):
             t_tensor = torch.full((x.shape[0],), t, device=device, dtype=torch.long)
-            eps_theta = model(torch.cat([x, z], dim=-1), t_tensor)
-            alpha_bar = self.gather(self.alpha_bar, t_tensor)
-            alpha = self.gather(self.alpha, t_tensor)
-            eps_coef = (1 - alpha) / (1 - alpha_bar).sqrt()
-            mean = (x - eps_coef * eps_theta) / alpha.sqrt()
-            var = self.gather(self.sigma2, t_tensor)
-            noise = torch.zeros_like(x) if t == 0 else torch.randn_like(x)
-            x = mean + var.sqrt() * noise
+            inp[..., :input_dim] = x
+            with autocast:
+                eps_theta = model(inp, t_tensor)
+            eps_theta = eps_theta.float()
+            if n_inference_steps:
+                noise = eps_theta
+            else:
+                noise = torch.zeros_like(x) if t == 0 else torch.randn_like(x)
+            x = self._posterior_step(
+                x, eps_theta, eps_coef, inv_sqrt_alpha, noise_scale, noise
+            )
         return x
 
-    def gather(self, const, t):
-        return const.gather(-1, t).view(-1, 1, 1)
-
     def save(self, path: str = None, epoch: int = None):
+        """
+        Snapshot the training state to host memory and write it to `path` on a background
+        thread. Call `wait_for_checkpoint` before reading the file.
+        """
         if path is None:
             hydra_output_dir = os.path.join(self.cfg.run_dir)
             if not os.path.exists(os.path.join(hydra_output_dir, "checkpoints")):
@@ -339,31 +554,31 @@ class DDPM(nn.Module):
                 "checkpoints",
                 f"ddpm_checkpoint_{epoch if epoch else self.current_epoch}.pt",
             )
-        model_sd = {k: v.cpu() for k, v in self.eps_model.state_dict().items()}
-        opt_sd = {
-            k: v.cpu() if isinstance(v, torch.Tensor) else v
-            for k, v in self.optimizer.state_dict().items()
-        }
-        ema_sd = {k: v.cpu() for k, v in self.ema.ema_model.state_dict().items()}
-        cond_sd = self.conditioning_module.state_dict()
-        torch.save(
+        self._checkpoint_writer.save(
             {
                 "epoch": epoch if epoch is not None else self.current_epoch,
-                "eps_model_state_dict": model_sd,
-                "optimizer_state_dict": opt_sd,
-                "ema_state_dict": ema_sd,
-                "alpha_bar": self.alpha_bar.cpu(),
-                "beta": self.beta.cpu(),
-                "conditioning_module_state_dict": cond_sd,
+                "eps_model_state_dict": self.eps_model.state_dict(),
+                "optimizer_state_dict": self.optimizer.state_dict(),
+                "ema_state_dict": self.ema.ema_model.state_dict(),
+                "alpha_bar": self.alpha_bar,
+                "beta": self.beta,
+                "conditioning_module_state_dict": self.conditioning_module.state_dict(),
             },
             path,
+            message=f"DDPM checkpoint saved to {path}",
         )
-        print(f"DDPM checkpoint saved to {path}")
+
+    def wait_for_checkpoint(self):
+        """
+        Block until the checkpoint being written by the last `save` call is on disk.
+        """
+        self._checkpoint_writer.wait()
 
     def load(self, path: str):
+        self.wait_for_checkpoint()
         if not os.path.exists(path):
             raise FileNotFoundError(f"Checkpoint not found at {path}")
-        ckp = torch.load(path, map_location=self.device)
+        ckp = torch.load(path, map_location=self.device, mmap=True)
         if "eps_model_state_dict" in ckp:
             self.eps_model.load_state_dict(ckp["eps_model_state_dict"])
             print("Loaded eps_model state.")
@@ -373,11 +588,9 @@ class DDPM(nn.Module):
         if "ema_state_dict" in ckp:
             self.ema.ema_model.load_state_dict(ckp["ema_state_dict"])
             print("Loaded EMA model state.")
-        if "alpha_bar" in ckp:
-            self.alpha_bar = ckp["alpha_bar"].to(self.device)
-            print("Loaded alpha_bar.")
         if "beta" in ckp:
-            self.beta = ckp["beta"].to(self.device)
+            # alpha_bar and the other coefficients are derived from beta
+            self._set_schedule(ckp["beta"].to(self.device))
             print("Loaded beta.")
         if "conditioning_module_state_dict" in ckp:
             self.conditioning_module.load_state_dict(
@@ -389,7 +602,7 @@ class DDPM(nn.Module):
             print(f"Loaded epoch number: {self.current_epoch}")
         self.eps_model.to(self.device)
         self.conditioning_module.to(self.device)
-        self.ema.ema_model.to(self.device)
+        self.ema.to(self.device)
         print(f"DDPM loaded and moved to {self.device}.")
 
     def generate(self, conditioning_vars):
@@ -404,18 +617,9 @@ class DDPM(nn.Module):
                 for var_name, var_tensor in conditioning_vars.items()
             }
             current_bs = end_idx - start_idx
-            shape = (
-                current_bs,
-                self.n_steps,
-                self.n_steps,
-            )  # Adjusted based on your model's requirements
-
-            if getattr(self.cfg.model, "use_ema_sampling", False):
-                samples = self.ema.ema_model.sample(
-                    shape, batch_conditioning_vars, use_ema=True
-                )
-            else:
-                samples = self.sample(shape, batch_conditioning_vars, use_ema=False)
+            shape = (current_bs, self.cfg.dataset.seq_len, self.cfg.dataset.input_dim)
+            use_ema = getattr(self.cfg.model, "use_ema_sampling", False)
+            samples = self.sample(shape, batch_conditioning_vars, use_ema=use_ema)
 
             generated_samples.append(samples)
 
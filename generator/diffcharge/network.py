@@ -8,11 +8,13 @@ License: None
 Modifications (if any):
 - Changes to conditioning logic
 - Added classifier-free-guidance sampling
+- Output projection applied without permuting to the channels-first layout
 
 Note: Please ensure compliance with the repository's license and credit the original authors when using or distributing this code.
 """
 
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 
@@ -152,6 +154,11 @@ class CNN(nn.Module):
         )
         hid_enc = hid_enc + time_emb  # (B, L, hidden_dim)
 
-        hid_enc = hid_enc.permute(0, 2, 1)
-        output = self.output_projector(hid_enc).permute(0, 2, 1)
-        return output
+        # The 1x1 convolutions are per-position linear maps, so they are applied in the
+        # (B, L, hidden_dim) layout instead of on a permuted, non-contiguous view. Batch
+        # norm over (B * L, hidden_dim) uses the same statistics as over (B, hidden_dim, L).
+        conv_in, norm, conv_out = self.output_projector
+        hid_enc = F.linear(hid_enc, conv_in.weight.squeeze(-1), conv_in.bias)
+        hid_enc = norm(hid_enc.flatten(0, 1)).view_as(hid_enc)
+        output = F.linear(hid_enc, conv_out.weight.squeeze(-1), conv_out.bias)
+        return output  # (B, L, input_dim)
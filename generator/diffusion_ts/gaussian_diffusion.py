@@ -27,14 +27,25 @@ from einops import reduce
 from omegaconf import DictConfig
 from sklearn.mixture import GaussianMixture
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.optim import Adam
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
+from datasets.utils import PrefetchLoader, prepare_dataloader
+from generator.checkpoint import AsyncCheckpointWriter
 from generator.conditioning import ConditioningModule
 from generator.diffusion_ts.model_utils import default, extract, identity
 from generator.diffusion_ts.transformer import Transformer
+from generator.distributed import (
+    all_gather_tensor,
+    broadcast_object,
+    get_rank,
+    is_distributed,
+    is_main_process,
+    no_sync,
+    setup_ddp,
+)
 
 
 def linear_beta_schedule(timesteps, device):
@@ -70,12 +81,17 @@ class Diffusion_TS(nn.Module):
         self.warm_up_epochs = cfg.model.warm_up_epochs
         self.sparse_conditioning_loss_weight = cfg.model.sparse_conditioning_loss_weight
         self.kl_weight = cfg.model.kl_weight
+        self.use_amp = cfg.model.use_amp and torch.device(self.device).type == "cuda"
         self.gmm_fitted = False
         self.current_epoch = 0
         self.wandb_enabled = getattr(self.cfg, "wandb_enabled", False)
+        self._checkpoint_writer = AsyncCheckpointWriter()
 
         self.conditioning_module = ConditioningModule(
-            self.conditioning_var_n_categories, self.embedding_dim, self.device
+            self.conditioning_var_n_categories,
+            self.embedding_dim,
+            self.device,
+            compile=self.cfg.model.use_compile,
         ).to(self.device)
 
         self.fc = nn.Linear(self.input_dim + self.embedding_dim, self.input_dim)
@@ -93,6 +109,13 @@ class Diffusion_TS(nn.Module):
             n_embd=cfg.model.d_model,
             conv_params=[cfg.model.kernel_size, cfg.model.padding_size],
         )
+        if cfg.model.use_compile:
+            # Batch sizes differ between training, the last batch of an epoch and
+            # sampling, so graphs are traced with dynamic shapes instead of captured as
+            # CUDA graphs for one batch size. Sequence length and feature sizes are
+            # fixed by the config, so with `compile_static_shapes` each of the few batch
+            # sizes gets its own graph specialized to the full input shape instead.
+            self.model.compile(dynamic=not cfg.model.compile_static_shapes)
 
         if cfg.model.beta_schedule == "linear":
             betas = linear_beta_schedule(cfg.model.n_steps, self.device)
@@ -160,11 +183,23 @@ class Diffusion_TS(nn.Module):
             z, mu, logvar = self.conditioning_module(conditioning_vars, sample=False)
             cvec = mu.unsqueeze(1).repeat(1, self.seq_len, 1)
             x = torch.cat([x, cvec], dim=-1)
-        trend, season = self.model(x, t, padding_masks=padding_masks)
-        model_out = trend + season
-        out = self.fc(model_out)
+        out = self._denoise(x, t, padding_masks=padding_masks)
         return out, mu, logvar
 
+    def _denoise(self, x, t, padding_masks=None):
+        trend, season = self.model(x, t, padding_masks=padding_masks)
+        return self.fc(trend + season)
+
+    def _sampling_input(self, shape, conditioning_vars):
+        """
+        Model input buffer for sampling. The conditioning embedding is the same at every
+        step, so it is written once and each step only copies in the current sample.
+        """
+        _, mu, _ = self.conditioning_module(conditioning_vars, sample=False)
+        inp = torch.empty((*shape[:-1], shape[-1] + mu.shape[-1]), device=mu.device)
+        inp[..., shape[-1] :] = mu.unsqueeze(1)
+        return inp
+
     def model_predictions(self, x, t, conditioning_vars, clip_x_start=False):
         fn = partial(torch.clamp, min=-1.0, max=1.0) if clip_x_start else identity
         x_start, mu, logvar = self.output(x, t, conditioning_vars=conditioning_vars)
@@ -193,13 +228,28 @@ class Diffusion_TS(nn.Module):
     def sample(self, shape, conditioning_vars):
         dev = self.betas.device
         img = torch.randn(shape, device=dev)
+        inp = self._sampling_input(shape, conditioning_vars)
+        # Every sample is at the same step, so the posterior coefficients are read from
+        # the host once instead of gathered on the device at every step
+        steps = zip(
+            range(self.num_timesteps),
+            self.posterior_mean_coef1.tolist(),
+            self.posterior_mean_coef2.tolist(),
+            (0.5 * self.posterior_log_variance_clipped).exp().tolist(),
+        )
         loop = tqdm(
-            reversed(range(0, self.num_timesteps)),
+            reversed(list(steps)),
             desc="sampling loop time step",
             total=self.num_timesteps,
         )
-        for t in loop:
-            img, _ = self.p_sample(img, t, conditioning_vars)
+        for t, coef1, coef2, std in loop:
+            bt = torch.full((shape[0],), t, device=dev, dtype=torch.long)
+            inp[..., : shape[-1]] = img
+            x_start = self._denoise(inp, bt).clamp(-1.0, 1.0)
+            img_next = coef1 * x_start + coef2 * img
+            if t > 0:
+                img_next = img_next + std * torch.randn_like(img)
+            img = img_next
         return img
 
     @torch.no_grad()
@@ -213,23 +263,36 @@ class Diffusion_TS(nn.Module):
         times = list(reversed(times.int().tolist()))
         pairs = list(zip(times[:-1], times[1:]))
         img = torch.randn(shape, device=dev)
-        loop = tqdm(pairs, desc="sampling loop time step")
-        for time, time_next in loop:
+        inp = self._sampling_input(shape, conditioning_vars)
+        # The DDIM coefficients of all steps are computed at once and read from the
+        # host, instead of a handful of scalar kernels per step
+        cur = torch.tensor([time for time, _ in pairs], device=dev)
+        nxt = torch.tensor([max(time_next, 0) for _, time_next in pairs], device=dev)
+        alpha = self.alphas_cumprod[cur]
+        alpha_next = self.alphas_cumprod[nxt]
+        sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
+        c = (1 - alpha_next - sigma**2).sqrt()
+        steps = zip(
+            pairs,
+            self.sqrt_recip_alphas_cumprod[cur].tolist(),
+            self.sqrt_recipm1_alphas_cumprod[cur].tolist(),
+            alpha_next.sqrt().tolist(),
+            c.tolist(),
+            sigma.tolist(),
+        )
+        loop = tqdm(list(steps), desc="sampling loop time step")
+        for (time, time_next), recip, recipm1, sqrt_alpha_next, c, sigma in loop:
             bt = torch.full((batch,), time, device=dev, dtype=torch.long)
-            pn, xst = self.model_predictions(
-                img, bt, conditioning_vars, clip_x_start=clip_denoised
-            )
+            inp[..., : shape[-1]] = img
+            xst = self._denoise(inp, bt)
+            if clip_denoised:
+                xst = xst.clamp(-1.0, 1.0)
             if time_next < 0:
                 img = xst
                 continue
-            alpha = self.alphas_cumprod[time]
-            alpha_next = self.alphas_cumprod[time_next]
-            sigma = (
-                eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-            )
-            c = (1 - alpha_next - sigma**2).sqrt()
+            pn = (recip * img - xst) / recipm1
             noise = torch.randn_like(img)
-            img = xst * alpha_next.sqrt() + c * pn + sigma * noise
+            img = xst * sqrt_alpha_next + c * pn + sigma * noise
         return img
 
     def sample_conditioning_vars(self, dataset, batch_size, random=False):
@@ -295,7 +358,13 @@ class Diffusion_TS(nn.Module):
             + extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * n
         )
 
-    def _train_loss(self, x_start, t, target=None, noise=None, conditioning_vars=None):
+    def _train_loss(
+        self, x_start, t, target=None, noise=None, conditioning_vars=None, weights=None
+    ):
+        """
+        Denoising loss of a batch. If `weights` of shape (batch_size,) are given, the
+        per-sample losses are scaled by them before taking the batch mean.
+        """
         with torch.set_grad_enabled(self.training):
             z, mu, logvar = self.conditioning_module(conditioning_vars, sample=False)
         n = default(noise, lambda: torch.randn_like(x_start))
@@ -317,6 +386,8 @@ class Diffusion_TS(nn.Module):
         loss_main = reduce(loss_main, "b ... -> b (...)", "mean")
         lw = extract(self.loss_weight, t, loss_main.shape)
         loss_main = loss_main * lw
+        if weights is not None:
+            return (weights * loss_main.mean(dim=1)).mean(), mu, logvar
         return loss_main.mean(), mu, logvar
 
     def forward(self, x, conditioning_vars=None, **kwargs):
@@ -333,27 +404,77 @@ class Diffusion_TS(nn.Module):
         all_mu = []
         self.conditioning_module.eval()
         with torch.no_grad():
-            for bx, cond_vars in loader:
-                bx = bx.to(self.device)
+            # Only the conditioning codes are needed, so the time series stay on the host
+            for _, cond_vars in loader:
                 for k in cond_vars:
-                    cond_vars[k] = cond_vars[k].to(self.device)
-                l, mu, _ = self(bx, cond_vars)
-                all_mu.append(mu.cpu())
+                    cond_vars[k] = cond_vars[k].to(self.device, non_blocking=True)
+                _, mu, _ = self.conditioning_module(cond_vars, sample=False)
+                all_mu.append(mu)
         a = torch.cat(all_mu, dim=0)
-        self.conditioning_module.fit_gmm(a)
-        self.conditioning_module.set_rare_threshold(a, fraction=0.1)
+        if not is_distributed():
+            self.conditioning_module.fit_gmm(a)
+            self.conditioning_module.set_rare_threshold(a, fraction=0.1)
+        else:
+            # Fit on rank 0 with every shard's embeddings, then share the result
+            a = all_gather_tensor(a)
+            if is_main_process():
+                self.conditioning_module.fit_gmm(a)
+                self.conditioning_module.set_rare_threshold(a, fraction=0.1)
+            cond = self.conditioning_module
+            cond.gmm, cond.log_prob_threshold = broadcast_object(
+                (cond.gmm, cond.log_prob_threshold)
+            )
         self.gmm_fitted = True
 
+    def _setup_distributed(self):
+        """
+        Join the process group started by torchrun and move all state to this process's GPU.
+        """
+        self.device = setup_ddp()
+        self.conditioning_module.device = self.device
+        self.to(self.device)
+        # Draw different diffusion steps and noise on every process
+        torch.manual_seed(torch.initial_seed() + get_rank())
+
+    def _autocast(self):
+        """
+        bf16 autocast for the training forward pass when `use_amp` is enabled on CUDA.
+        The losses are computed in float32 by autocast's own casting rules.
+        """
+        return torch.autocast(
+            device_type=torch.device(self.device).type,
+            dtype=torch.bfloat16,
+            enabled=self.use_amp,
+        )
+
+    def _wrap_ddp(self):
+        return DDP(self, device_ids=[self.device.index], broadcast_buffers=False)
+
     def train_model(self, train_dataset):
+        """
+        Train the model. When launched with torchrun on several GPUs, it is trained with
+        DistributedDataParallel, each process on its own shard of the dataset.
+        """
         self.train_timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         self.train()
-        self.to(self.device)
-        loader = DataLoader(
-            train_dataset,
-            batch_size=self.cfg.model.batch_size,
-            shuffle=self.cfg.dataset.shuffle,
-            drop_last=True,
+        distributed = is_distributed()
+        if distributed:
+            self._setup_distributed()
+        else:
+            self.to(self.device)
+        loader = PrefetchLoader(
+            prepare_dataloader(
+                train_dataset,
+                batch_size=self.cfg.model.batch_size,
+                shuffle=self.cfg.dataset.shuffle,
+                num_workers=self.cfg.model.num_workers,
+                prefetch_factor=self.cfg.model.prefetch_factor,
+                distributed=distributed,
+                drop_last=True,
+            ),
+            self.device,
         )
+        main_process = is_main_process()
         self.optimizer = Adam(
             filter(lambda p: p.requires_grad, self.parameters()),
             lr=self.cfg.model.base_lr,
@@ -368,7 +489,7 @@ class Diffusion_TS(nn.Module):
         self.scheduler = ReduceLROnPlateau(
             self.optimizer, **self.cfg.model.lr_scheduler_params
         )
-        if self.wandb_enabled and wandb is not None:
+        if self.wandb_enabled and wandb is not None and main_process:
             wandb.init(
                 project=self.cfg.wandb.project,
                 entity=self.cfg.wandb.entity,
@@ -376,85 +497,101 @@ class Diffusion_TS(nn.Module):
                 dir=self.cfg.run_dir,
             )
 
+        model = self
+        grad_accum = self.cfg.model.gradient_accumulate_every
+        self.optimizer.zero_grad(set_to_none=True)
         for epoch in tqdm(
-            range(self.cfg.model.n_epochs), desc="Epoch", total=self.cfg.model.n_epochs
+            range(self.cfg.model.n_epochs),
+            desc="Epoch",
+            total=self.cfg.model.n_epochs,
+            disable=not main_process,
         ):
             self.current_epoch = epoch + 1
+            if distributed:
+                loader.sampler.set_epoch(epoch)
             total_loss = 0.0
             for param in self.conditioning_module.parameters():
                 param.requires_grad = True
             if self.current_epoch > self.warm_up_epochs:
                 for param in self.conditioning_module.parameters():
                     param.requires_grad = False
+            if distributed and self.current_epoch in (1, self.warm_up_epochs + 1):
+                # DDP only synchronizes the parameters that require gradients when it is
+                # built, so rewrap once the conditioning module is frozen
+                model = self._wrap_ddp()
             for i, (ts_batch, cond_batch) in enumerate(loader):
-                ts_batch = ts_batch.to(self.device)
-                for k in cond_batch:
-                    cond_batch[k] = cond_batch[k].to(self.device)
+                # Gradients are only all-reduced and applied on the last micro-batch
+                sync = (i + 1) % grad_accum == 0 or i + 1 == len(loader)
                 bsz = ts_batch.size(0)
-                if self.current_epoch <= self.warm_up_epochs:
-                    loss, mu, logvar = self(ts_batch, conditioning_vars=cond_batch)
-                    kl_loss_val = 0.0
-                    if mu is not None and logvar is not None:
-                        kl_loss_t = self.conditioning_module.kl_divergence(mu, logvar)
-                        kl_loss_val = kl_loss_t.item()
-                        loss = loss + self.kl_weight * kl_loss_t
-                    if self.wandb_enabled and wandb is not None:
-                        wandb.log(
-                            {"Loss/reconstruction": loss.item(), "Loss/KL": kl_loss_val}
-                        )
-                else:
-                    with torch.no_grad():
-                        _, mu, _ = self(ts_batch, conditioning_vars=cond_batch)
-                        md = mu.detach()
-                        if self.gmm_fitted:
-                            rm = (
-                                self.conditioning_module.is_rare(md)
-                                .float()
-                                .to(self.device)
+                with no_sync(model, enabled=not sync):
+                    if self.current_epoch <= self.warm_up_epochs:
+                        with self._autocast():
+                            loss, mu, logvar = model(
+                                ts_batch, conditioning_vars=cond_batch
+                            )
+                        kl_loss_val = 0.0
+                        if mu is not None and logvar is not None:
+                            kl_loss_t = self.conditioning_module.kl_divergence(
+                                mu.float(), logvar.float()
+                            )
+                            kl_loss_val = kl_loss_t.item()
+                            loss = loss + self.kl_weight * kl_loss_t
+                        if self.wandb_enabled and wandb is not None and main_process:
+                            wandb.log(
+                                {
+                                    "Loss/reconstruction": loss.item(),
+                                    "Loss/KL": kl_loss_val,
+                                }
                             )
-                        else:
-                            rm = torch.zeros((bsz,), device=self.device)
-                    ri = (rm == 1.0).nonzero(as_tuple=True)[0]
-                    nr = (rm == 0.0).nonzero(as_tuple=True)[0]
-                    loss_rare = torch.tensor(0.0, device=self.device)
-                    loss_non_rare = torch.tensor(0.0, device=self.device)
-                    if len(ri) > 0:
-                        ts_r = ts_batch[ri]
-                        c_r = {kk: vv[ri] for kk, vv in cond_batch.items()}
-                        loss_r, _, _ = self(ts_r, c_r)
-                        loss_rare = loss_r
-                    if len(nr) > 0:
-                        ts_nr = ts_batch[nr]
-                        c_nr = {kk: vv[nr] for kk, vv in cond_batch.items()}
-                        loss_nr, _, _ = self(ts_nr, c_nr)
-                        loss_non_rare = loss_nr
-                    n_r = rm.sum().item()
-                    n_nr = (1 - rm).sum().item()
-                    n_tot = float(bsz)
-                    lam = self.sparse_conditioning_loss_weight
-                    loss = (
-                        lam * (n_r / n_tot) * loss_rare
-                        + (1 - lam) * (n_nr / n_tot) * loss_non_rare
-                    )
-                    if self.wandb_enabled and wandb is not None:
-                        wandb.log({"Loss/reconstruction": loss.item()})
-                loss = loss / self.cfg.model.gradient_accumulate_every
-                self.optimizer.zero_grad()
-                loss.backward()
+                    else:
+                        with torch.no_grad():
+                            _, mu, _ = self.conditioning_module(
+                                cond_batch, sample=False
+                            )
+                            if self.gmm_fitted:
+                                is_rare = self.conditioning_module.is_rare(mu)
+                            else:
+                                is_rare = torch.zeros(
+                                    bsz, dtype=torch.bool, device=self.device
+                                )
+                        # lam * (N_r / N) * mean rare loss + (1 - lam) * (N_nr / N)
+                        # * mean non-rare loss is the batch mean of per-sample losses
+                        # weighted by lam or 1 - lam, so one forward pass suffices
+                        lam = self.sparse_conditioning_loss_weight
+                        weights = torch.where(is_rare, lam, 1 - lam)
+                        with self._autocast():
+                            loss, _, _ = model(
+                                ts_batch, conditioning_vars=cond_batch, weights=weights
+                            )
+                        if self.wandb_enabled and wandb is not None and main_process:
+                            wandb.log({"Loss/reconstruction": loss.item()})
+                    loss = loss / grad_accum
+                    loss.backward()
                 total_loss += loss.item()
-                if (i + 1) % self.cfg.model.gradient_accumulate_every == 0:
+                if sync:
                     torch.nn.utils.clip_grad_norm_(self.parameters(), 1.0)
                     self.optimizer.step()
+                    self.optimizer.zero_grad(set_to_none=True)
                     self.ema.update()
+            if distributed:
+                # Every process steps the scheduler with the same loss, so the learning
+                # rates stay in sync
+                total_loss = (
+                    all_gather_tensor(torch.tensor([total_loss], device=self.device))
+                    .mean()
+                    .item()
+                )
             self.scheduler.step(total_loss)
             if self.current_epoch == self.warm_up_epochs and not self.gmm_fitted:
-                self._fit_gmm(loader)
-            if (epoch + 1) % self.cfg.model.save_cycle == 0:
+                self._fit_gmm(loader.loader)
+            if (epoch + 1) % self.cfg.model.save_cycle == 0 and main_process:
                 self.save(epoch=self.current_epoch)
+        self.wait_for_checkpoint()
         print("Training complete")
 
     def load(self, path: str):
-        ckp = torch.load(path)
+        self.wait_for_checkpoint()
+        ckp = torch.load(path, map_location=self.device, mmap=True)
         if "model_state_dict" in ckp:
             self.load_state_dict(ckp["model_state_dict"])
             print("Loaded regular model state.")
@@ -499,23 +636,23 @@ class Diffusion_TS(nn.Module):
                 "checkpoints",
                 f"diffusion_ts_checkpoint_{epoch if epoch else self.current_epoch}.pt",
             )
-        m_sd = {k: v.cpu() for k, v in self.state_dict().items()}
-        opt_sd = {
-            k: v.cpu() if isinstance(v, torch.Tensor) else v
-            for k, v in self.optimizer.state_dict().items()
-        }
-        ema_sd = {k: v.cpu() for k, v in self.ema.ema_model.state_dict().items()}
-        torch.save(
+        self._checkpoint_writer.save(
             {
                 "epoch": epoch,
-                "model_state_dict": m_sd,
-                "optimizer_state_dict": opt_sd,
-                "ema_state_dict": ema_sd,
+                "model_state_dict": self.state_dict(),
+                "optimizer_state_dict": self.optimizer.state_dict(),
+                "ema_state_dict": self.ema.ema_model.state_dict(),
                 "conditioning_module_state_dict": self.conditioning_module.state_dict(),
             },
             path,
         )
 
+    def wait_for_checkpoint(self):
+        """
+        Block until the checkpoint being written by the last `save` call is on disk.
+        """
+        self._checkpoint_writer.wait()
+
 
 class EMA:
     def __init__(self, model, beta, update_every, device):
@@ -528,16 +665,19 @@ class EMA:
         self.device = device
         for param in self.ema_model.parameters():
             param.requires_grad = False
+        self.ema_params = list(self.ema_model.parameters())
+        self.model_params = list(model.parameters())
 
     def update(self):
         self.step += 1
         if self.step % self.update_every != 0:
             return
+        # One multi-tensor kernel per operation instead of two launches per parameter
         with torch.no_grad():
-            for ema_p, model_p in zip(
-                self.ema_model.parameters(), self.model.parameters()
-            ):
-                ema_p.data.mul_(self.beta).add_(model_p.data, alpha=1.0 - self.beta)
+            torch._foreach_mul_(self.ema_params, self.beta)
+            torch._foreach_add_(
+                self.ema_params, self.model_params, alpha=1.0 - self.beta
+            )
 
     def forward(self, x):
         return self.ema_model(x)
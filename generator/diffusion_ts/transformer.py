@@ -6,7 +6,8 @@ Author: Xinyu Yuan
 License: MIT License
 
 Modifications:
-- None
+- FullAttention and CrossAttention use the fused scaled_dot_product_attention kernel
+  and no longer return attention maps
 
 Note: Please ensure compliance with the repository's license and credit the original authors when using or distributing this code.
 """
@@ -197,19 +198,18 @@ class FullAttention(nn.Module):
         v = (
             self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
         )  # (B, nh, T, hs)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))  # (B, nh, T, T)
-
-        att = F.softmax(att, dim=-1)  # (B, nh, T, T)
-        att = self.attn_drop(att)
-        y = att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        # Fused attention kernel; the (B, nh, T, T) attention map is never materialized,
+        # so none is returned
+        y = F.scaled_dot_product_attention(
+            q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0
+        )  # (B, nh, T, hs)
         y = (
             y.transpose(1, 2).contiguous().view(B, T, C)
         )  # re-assemble all head outputs side by side, (B, T, C)
-        att = att.mean(dim=1, keepdim=False)  # (B, T, T)
 
         # output projection
         y = self.resid_drop(self.proj(y))
-        return y, att
+        return y, None
 
 
 class CrossAttention(nn.Module):
@@ -252,19 +252,18 @@ class CrossAttention(nn.Module):
             .view(B, T_E, self.n_head, C // self.n_head)
             .transpose(1, 2)
         )  # (B, nh, T, hs)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))  # (B, nh, T, T)
-
-        att = F.softmax(att, dim=-1)  # (B, nh, T, T)
-        att = self.attn_drop(att)
-        y = att @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        # Fused attention kernel; the (B, nh, T, T) attention map is never materialized,
+        # so none is returned
+        y = F.scaled_dot_product_attention(
+            q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0
+        )  # (B, nh, T, hs)
         y = (
             y.transpose(1, 2).contiguous().view(B, T, C)
         )  # re-assemble all head outputs side by side, (B, T, C)
-        att = att.mean(dim=1, keepdim=False)  # (B, T, T)
 
         # output projection
         y = self.resid_drop(self.proj(y))
-        return y, att
+        return y, None
 
 
 class EncoderBlock(nn.Module):
@@ -0,0 +1,85 @@
+import os
+from contextlib import ExitStack
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+
+def is_distributed() -> bool:
+    """
+    Whether the process was launched as one of several workers, e.g. by
+    `torchrun --nproc_per_node=N`.
+    """
+    return int(os.environ.get("WORLD_SIZE", 1)) > 1
+
+
+def get_rank() -> int:
+    """
+    Global rank of this process. Falls back to the launcher's environment so it can be
+    queried before the process group is initialized.
+    """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return int(os.environ.get("RANK", 0))
+
+
+def is_main_process() -> bool:
+    """
+    Whether this process should own logging, progress bars and checkpointing.
+    """
+    return get_rank() == 0
+
+
+def setup_ddp() -> torch.device:
+    """
+    Initialize the NCCL process group (once) and bind this process to its local GPU.
+
+    Returns:
+        torch.device: The CUDA device assigned to this process.
+    """
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if not dist.is_initialized():
+        dist.init_process_group(backend="nccl")
+    torch.cuda.set_device(local_rank)
+    return torch.device("cuda", local_rank)
+
+
+def all_gather_tensor(tensor: torch.Tensor) -> torch.Tensor:
+    """
+    Concatenate equally shaped tensors from all processes along the first dimension.
+
+    Args:
+        tensor (torch.Tensor): This process's tensor, on its CUDA device.
+
+    Returns:
+        torch.Tensor: Tensors of all processes, ordered by rank.
+    """
+    gathered = [torch.empty_like(tensor) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, tensor.contiguous())
+    return torch.cat(gathered, dim=0)
+
+
+def broadcast_object(obj, src: int = 0):
+    """
+    Send a picklable object from rank `src` to all processes.
+
+    Returns:
+        The object held by rank `src`.
+    """
+    container = [obj]
+    dist.broadcast_object_list(container, src=src)
+    return container[0]
+
+
+def no_sync(*models, enabled: bool = True) -> ExitStack:
+    """
+    Suppress the DDP gradient all-reduce of the given models while accumulating
+    gradients. Models that are not wrapped in DDP are ignored.
+    """
+    stack = ExitStack()
+    if enabled:
+        for model in models:
+            if isinstance(model, DDP):
+                stack.enter_context(model.no_sync())
+    return stack
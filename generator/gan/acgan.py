@@ -16,16 +16,29 @@ Note: Please ensure compliance with the repository's license and credit the orig
 
 import os
 from datetime import datetime
+from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import wandb
 from omegaconf import DictConfig
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint_sequential
 from tqdm import tqdm
 
-from datasets.utils import prepare_dataloader
+from datasets.utils import PrefetchLoader, prepare_dataloader
+from generator.checkpoint import AsyncCheckpointWriter
 from generator.conditioning import ConditioningModule
+from generator.distributed import (
+    broadcast_object,
+    get_rank,
+    is_distributed,
+    is_main_process,
+    setup_ddp,
+)
 
 
 class Generator(nn.Module):
@@ -92,11 +105,41 @@ class Generator(nn.Module):
             x = noise
         x = self.fc(x)
         x = x.view(-1, self.base_channels, self.final_window_length)
+        # Channels-first (batch_size, n_dim, seq_length), the layout the discriminator's
+        # conv layers consume
         x = self.conv_transpose_layers(x)
-        x = x.permute(0, 2, 1)  # (batch_size, seq_length, n_dim)
 
         return x, mu, logvar
 
+    @torch.no_grad()
+    def fuse_bn(self):
+        """
+        Fold each BatchNorm layer into the linear or transposed conv layer feeding it and
+        switch to eval mode. Only for sampling: the BatchNorm running statistics are used
+        instead of batch statistics, and the fused generator can no longer be trained.
+        """
+        self.eval()
+        layers = self.conv_transpose_layers
+
+        # The first BatchNorm normalizes the channels of the reshaped fc output
+        bn = layers[0]
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        weight = self.fc.weight.view(self.base_channels, self.final_window_length, -1)
+        weight.mul_(scale[:, None, None])
+        bias = self.fc.bias.view(self.base_channels, self.final_window_length)
+        bias.mul_(scale[:, None]).add_(shift[:, None])
+        layers[0] = nn.Identity()
+
+        for i in range(1, len(layers)):
+            if isinstance(layers[i], nn.BatchNorm1d) and isinstance(
+                layers[i - 1], nn.ConvTranspose1d
+            ):
+                layers[i - 1] = fuse_conv_bn_eval(
+                    layers[i - 1], layers[i], transpose=True
+                )
+                layers[i] = nn.Identity()
+
 
 class Discriminator(nn.Module):
     def __init__(
@@ -106,6 +149,7 @@ class Discriminator(nn.Module):
         device,
         conditioning_var_n_categories=None,
         base_channels=256,
+        grad_checkpoint=False,
     ):
         super(Discriminator, self).__init__()
         self.input_dim = input_dim
@@ -113,6 +157,7 @@ class Discriminator(nn.Module):
         self.conditioning_var_n_categories = conditioning_var_n_categories
         self.base_channels = base_channels
         self.device = device
+        self.grad_checkpoint = grad_checkpoint
 
         self.conv_layers = nn.Sequential(
             nn.Conv1d(
@@ -139,28 +184,45 @@ class Discriminator(nn.Module):
             self.device
         )
 
-        self.aux_classifiers = nn.ModuleDict()
-        for var_name, num_classes in self.conditioning_var_n_categories.items():
-            self.aux_classifiers[var_name] = nn.Linear(
-                (window_length // 8) * base_channels, num_classes
-            ).to(self.device)
-        self.softmax = nn.Softmax(dim=1).to(self.device)
+        # One classifier for all conditioning variables, split into per-variable logits
+        self._aux_split_sizes = list(self.conditioning_var_n_categories.values())
+        self.aux_fc = nn.Linear(
+            (window_length // 8) * base_channels, sum(self._aux_split_sizes)
+        ).to(self.device)
 
     def forward(self, x):
-        x = x.permute(
-            0, 2, 1
-        )  # Permute to (n_samples, n_dim, seq_length) for conv layers
-        x = self.conv_layers(x)
+        # x is channels-first: (n_samples, n_dim, seq_length)
+        if self.grad_checkpoint and self.training and torch.is_grad_enabled():
+            # Recompute the conv activations in two segments during backward instead of
+            # storing them. The recomputation updates the BatchNorm running statistics a
+            # second time with the same batch statistics.
+            x = checkpoint_sequential(self.conv_layers, 2, x, use_reentrant=False)
+        else:
+            x = self.conv_layers(x)
         x = x.view(x.size(0), -1)
-        validity = torch.sigmoid(self.fc_discriminator(x))
+        validity = self.fc_discriminator(x)  # logits
 
-        aux_outputs = {}
-        for var_name, classifier in self.aux_classifiers.items():
-            aux_output = classifier(x)
-            aux_outputs[var_name] = self.softmax(aux_output)
+        aux_logits = self.aux_fc(x).split(self._aux_split_sizes, dim=1)
+        aux_outputs = dict(zip(self.conditioning_var_n_categories.keys(), aux_logits))
 
         return validity, aux_outputs
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """
+        Convert checkpoints saved with one auxiliary classifier per conditioning variable
+        into the fused layout before loading.
+        """
+        names = self.conditioning_var_n_categories.keys()
+        if f"{prefix}aux_classifiers.{next(iter(names))}.weight" in state_dict:
+            for param in ("weight", "bias"):
+                state_dict[f"{prefix}aux_fc.{param}"] = torch.cat(
+                    [
+                        state_dict.pop(f"{prefix}aux_classifiers.{name}.{param}")
+                        for name in names
+                    ]
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 class ACGAN(nn.Module):
     def __init__(self, cfg: DictConfig):
@@ -184,7 +246,10 @@ class ACGAN(nn.Module):
         ), "window_length must be a multiple of 8 in this architecture!"
 
         self.conditioning_module = ConditioningModule(
-            self.conditioning_var_n_categories, self.cond_emb_dim, self.device
+            self.conditioning_var_n_categories,
+            self.cond_emb_dim,
+            self.device,
+            compile=cfg.model.use_compile,
         ).to(self.device)
 
         self.generator = Generator(
@@ -202,21 +267,61 @@ class ACGAN(nn.Module):
             self.input_dim,
             self.device,
             self.conditioning_var_n_categories,
+            grad_checkpoint=cfg.model.grad_checkpoint,
         ).to(self.device)
 
-        self.adversarial_loss = nn.BCELoss().to(self.device)
+        if cfg.model.use_compile:
+            # The last batch of an epoch is smaller, so graphs are traced with dynamic
+            # shapes instead of captured as CUDA graphs for one batch size.
+            self.generator.compile(dynamic=True)
+            self.discriminator.compile(dynamic=True)
+
+        # The discriminator returns logits, which keeps the loss safe under autocast
+        self.adversarial_loss = nn.BCEWithLogitsLoss().to(self.device)
         self.auxiliary_loss = nn.CrossEntropyLoss().to(self.device)
 
+        # The discriminator and generator updates are captured in CUDA graphs, optimizer
+        # steps included
+        self.use_cuda_graphs = (
+            cfg.model.use_cuda_graphs and torch.device(self.device).type == "cuda"
+        )
         self.optimizer_G = optim.Adam(
-            self.generator.parameters(), lr=self.lr_gen, betas=(0.5, 0.999)
+            self.generator.parameters(),
+            lr=self.lr_gen,
+            betas=(0.5, 0.999),
+            capturable=self.use_cuda_graphs,
         )
         self.optimizer_D = optim.Adam(
-            self.discriminator.parameters(), lr=self.lr_discr, betas=(0.5, 0.999)
+            self.discriminator.parameters(),
+            lr=self.lr_discr,
+            betas=(0.5, 0.999),
+            capturable=self.use_cuda_graphs,
+        )
+        self._graphs = {}
+        self._graph_warmup_steps = {}
+        self._graph_static_tensors = {}
+        self._soft_label_cache = {}
+        self._noise_buffer = None
+        self._checkpoint_writer = AsyncCheckpointWriter()
+        self.register_buffer(
+            "_n_categories",
+            torch.tensor(
+                list(self.conditioning_var_n_categories.values()), device=self.device
+            ),
+            persistent=False,
         )
 
+        # bf16 needs no gradient scaling; optimizer states stay in float32
+        self.use_amp = cfg.model.use_amp and torch.device(self.device).type == "cuda"
+
         self.gmm_fitted = False
 
-        if self.cfg.wandb_enabled:
+        if torch.device(self.device).type == "cuda":
+            # Batch shapes are fixed apart from the last batch of an epoch, so the conv
+            # algorithms are autotuned once per shape
+            torch.backends.cudnn.benchmark = True
+
+        if self.cfg.wandb_enabled and is_main_process():
             wandb.init(
                 project=cfg.wandb.project,
                 entity=cfg.wandb.entity,
@@ -224,175 +329,157 @@ class ACGAN(nn.Module):
                 dir=cfg.run_dir,
             )
 
+    def _setup_distributed(self):
+        """
+        Join the process group started by torchrun and move all state to this process's GPU.
+        Every process gets its own random stream, so their noise and sampled conditioning
+        variables differ.
+
+        Returns:
+            Tuple[DDP, DDP]: Wrapped generator and discriminator for the training updates.
+        """
+        self.device = setup_ddp()
+        self.conditioning_module.device = self.device
+        self.to(self.device)
+        self._noise_buffer = None
+        self._soft_label_cache = {}
+        # Gradient all-reduces cannot be captured alongside the optimizer step
+        self.use_cuda_graphs = False
+        torch.manual_seed(torch.initial_seed() + get_rank())
+
+        discriminator = DDP(
+            self.discriminator,
+            device_ids=[self.device.index],
+            broadcast_buffers=False,
+            # The auxiliary classifier only receives gradients from the auxiliary losses
+            find_unused_parameters=not self.cfg.model.include_auxiliary_losses,
+        )
+        return self._wrap_generator(), discriminator
+
+    def _wrap_generator(self):
+        """
+        Wrap the generator in DDP. DDP only synchronizes the parameters that require
+        gradients when it is created, so the generator is wrapped again once the
+        conditioning module is frozen.
+        """
+        return DDP(
+            self.generator,
+            device_ids=[self.device.index],
+            broadcast_buffers=False,
+        )
+
     def train_model(self, dataset):
+        """
+        Train the generator and discriminator. When launched with torchrun on several GPUs,
+        both are trained with DistributedDataParallel, each process on its own shard of the
+        dataset.
+        """
         self.train_timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         batch_size = self.cfg.model.batch_size
         num_epoch = self.cfg.model.n_epochs
-        train_loader = prepare_dataloader(dataset, batch_size)
+        distributed = is_distributed()
+        if distributed:
+            generator, discriminator = self._setup_distributed()
+        else:
+            generator, discriminator = self.generator, self.discriminator
+
+        train_loader = PrefetchLoader(
+            prepare_dataloader(
+                dataset,
+                batch_size,
+                num_workers=self.cfg.model.num_workers,
+                prefetch_factor=self.cfg.model.prefetch_factor,
+                distributed=distributed,
+            ),
+            self.device,
+        )
+        main_process = is_main_process()
+        log_wandb = self.cfg.wandb_enabled and main_process
 
         for epoch in range(num_epoch):
             self.current_epoch = epoch + 1
+            if distributed:
+                train_loader.sampler.set_epoch(epoch)
 
             if self.current_epoch > self.warm_up_epochs:
                 for param in self.generator.conditioning_module.parameters():
                     param.requires_grad = False
+                if distributed and self.current_epoch == self.warm_up_epochs + 1:
+                    generator = self._wrap_generator()
 
             # ======================================================
             # TRAINING LOOP
             # ======================================================
             for _, (time_series_batch, conditioning_vars_batch) in enumerate(
-                tqdm(train_loader, desc=f"Epoch {epoch + 1}")
+                tqdm(train_loader, desc=f"Epoch {epoch + 1}", disable=not main_process)
             ):
-                time_series_batch = time_series_batch.to(self.device)
+                # Channels-first view; the discriminator step copies it into the
+                # concatenated real and fake batch anyway
+                time_series_batch = time_series_batch.transpose(1, 2)
                 conditioning_vars_batch = {
                     name: conditioning_vars_batch[name]
                     for name in self.conditioning_var_n_categories.keys()
                 }
 
                 current_batch_size = time_series_batch.size(0)
-                noise = torch.randn((current_batch_size, self.code_size)).to(
-                    self.device
-                )
-
-                # ---------------------
-                # Forward pass G
-                # ---------------------
-                generated_time_series, mu, logvar = self.generator(
-                    noise, conditioning_vars_batch
-                )
 
                 # ---------------------
                 # Train Discriminator
                 # ---------------------
-                self.optimizer_D.zero_grad()
-                soft_zero, soft_one = 0, 0.95
-
-                real_pred, aux_outputs_real = self.discriminator(time_series_batch)
-                fake_pred, aux_outputs_fake = self.discriminator(generated_time_series)
-
-                d_real_loss = self.adversarial_loss(
-                    real_pred, torch.ones_like(real_pred) * soft_one
-                )
-                d_fake_loss = self.adversarial_loss(
-                    fake_pred, torch.ones_like(fake_pred) * soft_zero
-                )
+                if self.use_cuda_graphs and current_batch_size == batch_size:
+                    d_loss, d_adv_loss = self._graphed_step(
+                        "discriminator",
+                        self._discriminator_step,
+                        self.optimizer_D,
+                        time_series_batch,
+                        conditioning_vars_batch,
+                    )
+                else:
+                    self.optimizer_D.zero_grad(set_to_none=True)
+                    d_loss, d_adv_loss = self._discriminator_step(
+                        time_series_batch, conditioning_vars_batch, discriminator
+                    )
 
-                if self.cfg.wandb_enabled:
+                if log_wandb:
                     wandb.log(
                         {
-                            "Loss/Discr_adv": d_real_loss.item() + d_fake_loss.item(),
+                            "Loss/Discr_adv": d_adv_loss.item(),
                         }
                     )
 
-                if self.cfg.model.include_auxiliary_losses:
-                    for var_name in self.conditioning_var_n_categories.keys():
-                        labels = conditioning_vars_batch[var_name].to(self.device)
-                        d_real_loss += self.auxiliary_loss(
-                            aux_outputs_real[var_name], labels
-                        )
-                        d_fake_loss += self.auxiliary_loss(
-                            aux_outputs_fake[var_name], labels
-                        )
-
-                d_loss = 0.5 * (d_real_loss + d_fake_loss)
-                d_loss.backward()
-                self.optimizer_D.step()
-
                 # -----------------
                 # Train Generator
                 # -----------------
-                self.optimizer_G.zero_grad()
-                noise = torch.randn((current_batch_size, self.code_size)).to(
-                    self.device
-                )
-                gen_categorical_vars = self.sample_conditioning_vars(
-                    dataset, current_batch_size, random=True
-                )
-                generated_time_series, mu_g, logvar_g = self.generator(
-                    noise, gen_categorical_vars
-                )
-                validity, aux_outputs = self.discriminator(generated_time_series)
-
-                # Only apply GMM-based rare logic if GMM is fitted
-                if self.gmm_fitted:
-                    gen_batch_embeddings = mu_g.detach()
-                    rare_mask_gen = (
-                        self.generator.conditioning_module.is_rare(gen_batch_embeddings)
-                        .float()
-                        .to(self.device)
+                # The KL term and the trainable conditioning module change the step
+                # until warm-up ends, so it is only captured afterwards
+                if (
+                    self.use_cuda_graphs
+                    and current_batch_size == batch_size
+                    and self.current_epoch > self.warm_up_epochs
+                ):
+                    g_loss, g_adv_loss, kl_loss = self._graphed_step(
+                        "generator",
+                        partial(self._generator_step, current_batch_size),
+                        self.optimizer_G,
                     )
                 else:
-                    rare_mask_gen = torch.zeros((current_batch_size,)).to(self.device)
-
-                # Adversarial Loss for Generator
-                g_loss_rare = self.adversarial_loss(
-                    validity.squeeze() * rare_mask_gen,
-                    torch.ones_like(validity.squeeze()) * rare_mask_gen * soft_one,
-                )
-                g_loss_non_rare = self.adversarial_loss(
-                    validity.squeeze() * (1 - rare_mask_gen),
-                    torch.ones_like(validity.squeeze())
-                    * (1 - rare_mask_gen)
-                    * soft_one,
-                )
+                    self.optimizer_G.zero_grad(set_to_none=True)
+                    g_loss, g_adv_loss, kl_loss = self._generator_step(
+                        current_batch_size, generator
+                    )
 
-                if self.cfg.wandb_enabled:
+                if log_wandb:
                     wandb.log(
                         {
-                            "Loss/Gen_adv": g_loss_rare.item() + g_loss_non_rare.item(),
+                            "Loss/Gen_adv": g_adv_loss.item(),
                         }
                     )
-
-                if self.cfg.model.include_auxiliary_losses:
-                    for var_name in self.conditioning_var_n_categories.keys():
-                        labels = gen_categorical_vars[var_name]
-                        rare_indices = rare_mask_gen.bool()
-                        non_rare_indices = ~rare_mask_gen.bool()
-
-                        if rare_indices.any():
-                            g_loss_rare += self.auxiliary_loss(
-                                aux_outputs[var_name][rare_indices],
-                                labels[rare_indices],
-                            )
-
-                        if non_rare_indices.any():
-                            g_loss_non_rare += self.auxiliary_loss(
-                                aux_outputs[var_name][non_rare_indices],
-                                labels[non_rare_indices],
-                            )
-
-                _lambda = self.sparse_conditioning_loss_weight
-                N_r = rare_mask_gen.sum().item()
-                N_nr = (1 - rare_mask_gen).sum().item()
-                N = current_batch_size
-                g_loss_main = (
-                    _lambda * (N_r / N) * g_loss_rare
-                    + (1 - _lambda) * (N_nr / N) * g_loss_non_rare
-                )
-
-                # KL Divergence (only before warm-up ends)
-                if (
-                    mu_g is not None
-                    and logvar_g is not None
-                    and self.current_epoch <= self.warm_up_epochs
-                ):
-                    kl_loss = self.conditioning_module.kl_divergence(mu_g, logvar_g)
-
-                    if self.cfg.wandb_enabled:
+                    if kl_loss is not None:
                         wandb.log(
                             {
                                 "Loss/KL": kl_loss.item(),
                             }
                         )
-
-                    g_loss = g_loss_main + self.kl_weight * kl_loss
-                else:
-                    g_loss = g_loss_main
-
-                g_loss.backward()
-                self.optimizer_G.step()
-
-                if self.cfg.wandb_enabled:
                     wandb.log(
                         {
                             "Loss/discr_total": d_loss.item(),
@@ -404,45 +491,62 @@ class ACGAN(nn.Module):
             # After last warmup Epoch - Fit GMM if Warm-Up Just Ended
             # ======================================================
             if self.current_epoch == self.warm_up_epochs and not self.gmm_fitted:
-                all_embeddings = []
-                full_loader = prepare_dataloader(dataset, batch_size)
-                self.generator.conditioning_module.eval()
-
-                with torch.no_grad():
-                    for _, (ts_batch, cond_vars_batch) in enumerate(full_loader):
-                        cond_vars_batch = {
-                            name: cond_vars_batch[name].to(self.device)
-                            for name in self.conditioning_var_n_categories.keys()
-                        }
-                        _, mu_train, _ = self.generator.conditioning_module(
-                            cond_vars_batch, sample=False
-                        )
-                        all_embeddings.append(mu_train.cpu())
-
-                all_embeddings = torch.cat(
-                    all_embeddings, dim=0
-                )  # shape (N, cond_emb_dim)
-
-                self.generator.conditioning_module.fit_gmm(all_embeddings)
-                self.generator.conditioning_module.set_rare_threshold(
-                    all_embeddings, fraction=0.1
-                )
+                # Fitted on the main process over the full dataset, then shared
+                if main_process:
+                    self._fit_gmm(dataset)
+                if distributed:
+                    cond = self.generator.conditioning_module
+                    cond.gmm, cond.log_prob_threshold = broadcast_object(
+                        (cond.gmm, cond.log_prob_threshold)
+                    )
                 self.gmm_fitted = True
 
-            if (epoch + 1) % self.cfg.model.save_cycle == 0:
+            if (epoch + 1) % self.cfg.model.save_cycle == 0 and main_process:
                 self.save(epoch=self.current_epoch)
 
+        self.wait_for_checkpoint()
+
+    def _fit_gmm(self, dataset):
+        """
+        Fit the conditioning module's GMM and rarity threshold to the embeddings of all
+        conditioning variables in the dataset.
+        """
+        # Embeddings only depend on the codes, so each distinct combination of conditioning
+        # variables is embedded once and expanded to every row of the dataset
+        codes, row_to_combination = torch.unique(
+            torch.from_numpy(dataset.conditioning_array), dim=1, return_inverse=True
+        )
+        codes = codes.to(self.device)
+        cond_vars = {
+            name: codes[dataset.conditioning_vars.index(name)]
+            for name in self.conditioning_var_n_categories.keys()
+        }
+        self.generator.conditioning_module.eval()
+
+        with torch.no_grad():
+            _, mu_train, _ = self.generator.conditioning_module(cond_vars, sample=False)
+
+        # shape (N, cond_emb_dim)
+        all_embeddings = mu_train[row_to_combination.to(self.device)]
+
+        self.generator.conditioning_module.fit_gmm(all_embeddings)
+        self.generator.conditioning_module.set_rare_threshold(
+            all_embeddings, fraction=0.1
+        )
+
     def sample_conditioning_vars(self, dataset, batch_size, random=False):
         conditioning_vars = {}
         if random:
-            for var_name, num_categories in self.conditioning_var_n_categories.items():
-                conditioning_vars[var_name] = torch.randint(
-                    0,
-                    num_categories,
-                    (batch_size,),
-                    dtype=torch.long,
-                    device=self.device,
-                )
+            # One draw for all variables, reduced modulo each variable's category count;
+            # the modulo bias of a 62-bit draw is negligible
+            codes = torch.randint(
+                0,
+                2**62,
+                (batch_size, len(self._n_categories)),
+                device=self._n_categories.device,
+            ).remainder_(self._n_categories)
+            for i, var_name in enumerate(self.conditioning_var_n_categories.keys()):
+                conditioning_vars[var_name] = codes[:, i]
         else:
             sampled_rows = dataset.data.sample(n=batch_size).reset_index(drop=True)
             for var_name in self.conditioning_var_n_categories.keys():
@@ -452,6 +556,231 @@ class ACGAN(nn.Module):
 
         return conditioning_vars
 
+    def _autocast(self):
+        """
+        bf16 autocast for the generator and discriminator forward passes when `use_amp`
+        is enabled on CUDA. Weight casts are not cached across calls while the
+        training steps are captured in CUDA graphs.
+        """
+        return torch.autocast(
+            device_type=torch.device(self.device).type,
+            dtype=torch.bfloat16,
+            enabled=self.use_amp,
+            cache_enabled=not self.use_cuda_graphs,
+        )
+
+    def _draw_noise(self, batch_size):
+        """
+        Gaussian noise of shape (batch_size, code_size), drawn in place into a buffer that
+        is reused across training steps instead of allocated per step. Each update's
+        backward pass runs before the next draw overwrites it.
+        """
+        buffer = self._noise_buffer
+        if buffer is None or buffer.shape[0] < batch_size:
+            self._noise_buffer = torch.empty(
+                (batch_size, self.code_size), device=self.device
+            )
+        return self._noise_buffer[:batch_size].normal_()
+
+    def _soft_labels(self, batch_size):
+        """
+        Discriminator targets for `batch_size` real samples followed by as many fakes,
+        shape (2 * batch_size, 1). Allocated once per batch size and reused.
+        """
+        if batch_size not in self._soft_label_cache:
+            soft_zero, soft_one = 0, 0.95
+            self._soft_label_cache[batch_size] = torch.cat(
+                [
+                    torch.full((batch_size, 1), soft_one, device=self.device),
+                    torch.full((batch_size, 1), soft_zero, device=self.device),
+                ]
+            )
+        return self._soft_label_cache[batch_size]
+
+    def _discriminator_step(
+        self, time_series_batch, conditioning_vars_batch, discriminator=None
+    ):
+        """
+        One discriminator update on a batch of real time series and fakes generated for the
+        same conditioning variables. Free of host synchronization, so it can be captured
+        in a CUDA graph. `discriminator` is the module to run, e.g. the DDP-wrapped one;
+        defaults to `self.discriminator`.
+
+        Returns:
+            d_loss (torch.Tensor): The total discriminator loss.
+            d_adv_loss (torch.Tensor): Its adversarial part on real and fake samples.
+        """
+        current_batch_size = time_series_batch.size(0)
+        noise = self._draw_noise(current_batch_size)
+
+        # The fakes only serve as inputs here; gradients reaching the generator through
+        # this loss were discarded before its own update anyway
+        with torch.no_grad(), self._autocast():
+            generated_time_series, _, _ = self.generator(noise, conditioning_vars_batch)
+
+        # Real and fake samples share one forward pass, so BatchNorm normalizes them
+        # with the statistics of the combined batch
+        if discriminator is None:
+            discriminator = self.discriminator
+        with self._autocast():
+            pred, aux_outputs = discriminator(
+                torch.cat([time_series_batch, generated_time_series], dim=0)
+            )
+
+        # Means over the combined batch equal the halved sums of the real and fake losses
+        d_loss = self.adversarial_loss(pred, self._soft_labels(current_batch_size))
+        d_adv_loss = 2 * d_loss.detach()
+
+        if self.cfg.model.include_auxiliary_losses:
+            for var_name in self.conditioning_var_n_categories.keys():
+                labels = conditioning_vars_batch[var_name].repeat(2)
+                d_loss = d_loss + self.auxiliary_loss(aux_outputs[var_name], labels)
+
+        d_loss.backward()
+        self.optimizer_D.step()
+        return d_loss.detach(), d_adv_loss
+
+    def _generator_step(self, batch_size, generator=None):
+        """
+        One generator update on `batch_size` fakes generated for randomly sampled
+        conditioning variables. Free of host synchronization, so it can be captured in a
+        CUDA graph. `generator` is the module to run, e.g. the DDP-wrapped one; defaults to
+        `self.generator`.
+
+        Returns:
+            g_loss (torch.Tensor): The total generator loss.
+            g_adv_loss (torch.Tensor): Its adversarial part.
+            kl_loss (torch.Tensor): The KL divergence of the conditioning embeddings, or
+                None after warm-up.
+        """
+        noise = self._draw_noise(batch_size)
+        gen_categorical_vars = self.sample_conditioning_vars(
+            None, batch_size, random=True
+        )
+        if generator is None:
+            generator = self.generator
+        with self._autocast():
+            generated_time_series, mu_g, logvar_g = generator(
+                noise, gen_categorical_vars
+            )
+            # Unwrapped, so the discriminator gradients of this pass, which are
+            # never applied, are not all-reduced
+            validity, aux_outputs = self.discriminator(generated_time_series)
+
+        # Only apply GMM-based rare logic if GMM is fitted
+        if self.gmm_fitted:
+            rare_mask_gen = self.generator.conditioning_module.is_rare(
+                mu_g.detach()
+            ).float()
+        else:
+            rare_mask_gen = torch.zeros((batch_size,), device=self.device)
+        non_rare_mask_gen = 1 - rare_mask_gen
+
+        # Adversarial Loss for Generator, averaged over the whole batch with the
+        # samples outside each group weighted out
+        validity = validity.squeeze().float()
+        soft_ones = self._soft_labels(batch_size)[:batch_size, 0]
+        g_loss_rare = F.binary_cross_entropy_with_logits(
+            validity, soft_ones, weight=rare_mask_gen
+        )
+        g_loss_non_rare = F.binary_cross_entropy_with_logits(
+            validity, soft_ones, weight=non_rare_mask_gen
+        )
+        g_adv_loss = (g_loss_rare + g_loss_non_rare).detach()
+
+        if self.cfg.model.include_auxiliary_losses:
+            # Means over the samples of each group, zero for an empty group
+            n_rare = rare_mask_gen.sum().clamp(min=1)
+            n_non_rare = non_rare_mask_gen.sum().clamp(min=1)
+            for var_name in self.conditioning_var_n_categories.keys():
+                aux_loss = F.cross_entropy(
+                    aux_outputs[var_name],
+                    gen_categorical_vars[var_name],
+                    reduction="none",
+                )
+                g_loss_rare = g_loss_rare + (aux_loss * rare_mask_gen).sum() / n_rare
+                g_loss_non_rare = (
+                    g_loss_non_rare + (aux_loss * non_rare_mask_gen).sum() / n_non_rare
+                )
+
+        _lambda = self.sparse_conditioning_loss_weight
+        g_loss = (
+            _lambda * rare_mask_gen.mean() * g_loss_rare
+            + (1 - _lambda) * non_rare_mask_gen.mean() * g_loss_non_rare
+        )
+
+        # KL Divergence (only before warm-up ends)
+        kl_loss = None
+        if (
+            mu_g is not None
+            and logvar_g is not None
+            and self.current_epoch <= self.warm_up_epochs
+        ):
+            kl_loss = self.conditioning_module.kl_divergence(
+                mu_g.float(), logvar_g.float()
+            )
+            g_loss = g_loss + self.kl_weight * kl_loss
+            kl_loss = kl_loss.detach()
+
+        g_loss.backward()
+        self.optimizer_G.step()
+        return g_loss.detach(), g_adv_loss, kl_loss
+
+    def _graphed_step(self, name, step, optimizer, *inputs):
+        """
+        `step(*inputs)` replayed from the CUDA graph registered under `name`, for full
+        batches. The first calls run eagerly on a side stream to warm up, the next one is
+        captured, and every later one copies its inputs, tensors or dicts of tensors, into
+        the captured input buffers before replaying the graph.
+        """
+        if name not in self._graphs:
+            warmup_steps = self._graph_warmup_steps.get(name, 0)
+            if warmup_steps < 3:
+                self._graph_warmup_steps[name] = warmup_steps + 1
+                side_stream = torch.cuda.Stream()
+                side_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(side_stream):
+                    optimizer.zero_grad(set_to_none=True)
+                    outputs = step(*inputs)
+                torch.cuda.current_stream().wait_stream(side_stream)
+                return outputs
+
+            static_inputs = tuple(
+                (
+                    {key: value.clone() for key, value in x.items()}
+                    if isinstance(x, dict)
+                    else x.clone()
+                )
+                for x in inputs
+            )
+            graph = torch.cuda.CUDAGraph()
+            # Gradients are allocated inside the graph, so every replay overwrites them
+            optimizer.zero_grad(set_to_none=True)
+            with torch.cuda.graph(graph):
+                static_outputs = step(*static_inputs)
+            self._graphs[name] = graph
+            self._graph_static_tensors[name] = (static_inputs, static_outputs)
+        else:
+            static_inputs, static_outputs = self._graph_static_tensors[name]
+            for static, x in zip(static_inputs, inputs):
+                if isinstance(static, dict):
+                    for key, value in static.items():
+                        value.copy_(x[key])
+                else:
+                    static.copy_(x)
+
+        self._graphs[name].replay()
+        return static_outputs
+
+    def fuse_bn(self):
+        """
+        Fold the generator's BatchNorm layers into the adjacent layers for faster
+        sampling. The generator then samples in eval mode with the BatchNorm running
+        statistics, and the model can no longer be trained or saved in its original
+        layout, so call this only once training is done.
+        """
+        self.generator.fuse_bn()
+
     def generate(self, conditioning_vars):
         bs = self.cfg.model.sampling_batch_size
         total = len(next(iter(conditioning_vars.values())))
@@ -465,17 +794,20 @@ class ACGAN(nn.Module):
             }
             current_bs = end_idx - start_idx
             noise = torch.randn((current_bs, self.noise_dim)).to(self.device)
-            with torch.no_grad():
+            with torch.inference_mode():
                 generated_data, mu, logvar = self.generator(
                     noise, batch_conditioning_vars
                 )
-            generated_samples.append(generated_data)
+            # (batch_size, seq_length, n_dim)
+            generated_samples.append(generated_data.permute(0, 2, 1))
 
         return torch.cat(generated_samples, dim=0)
 
     def save(self, path: str = None, epoch: int = None):
         """
-        Save the generator and discriminator models, optimizers, and epoch number.
+        Save the generator and discriminator models, optimizers, and epoch number. The
+        state is snapshotted to host memory and written on a background thread, so call
+        `wait_for_checkpoint` before reading the file.
 
         Args:
             path (str, optional): The file path to save the checkpoint to.
@@ -503,8 +835,15 @@ class ACGAN(nn.Module):
             "conditioning_module_state_dict": self.conditioning_module.state_dict(),
             "gmm_fitted": self.gmm_fitted,
         }
-        torch.save(checkpoint, path)
-        print(f"Saved ACGAN checkpoint to {path}")
+        self._checkpoint_writer.save(
+            checkpoint, path, message=f"Saved ACGAN checkpoint to {path}"
+        )
+
+    def wait_for_checkpoint(self):
+        """
+        Block until the checkpoint being written by the last `save` call is on disk.
+        """
+        self._checkpoint_writer.wait()
 
     def load(self, path: str):
         """
@@ -513,7 +852,9 @@ class ACGAN(nn.Module):
         Args:
             path (str): The file path to load the checkpoint from.
         """
-        checkpoint = torch.load(path, map_location=self.device)
+        self.wait_for_checkpoint()
+        # Memory-map the checkpoint instead of reading every tensor into memory up front
+        checkpoint = torch.load(path, map_location=self.device, mmap=True)
 
         if "generator_state_dict" in checkpoint:
             self.generator.load_state_dict(checkpoint["generator_state_dict"])
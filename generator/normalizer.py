@@ -9,6 +9,7 @@ import torch.nn.functional as F
 from omegaconf import OmegaConf
 from torch.utils.data import DataLoader, Dataset
 
+from datasets.utils import stack_timeseries
 from generator.conditioning import ConditioningModule
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -32,17 +33,14 @@ class StatsHead(nn.Module):
 
     def forward(self, z: torch.Tensor):
         out = self.net(z)
-        batch_size = out.size(0)
         if self.do_scale:
-            out = out.view(batch_size, 4, self.n_dims)
-            pred_mu = out[:, 0, :]
-            pred_log_sigma = out[:, 1, :]
-            pred_z_min = out[:, 2, :]
-            pred_z_max = out[:, 3, :]
+            pred_mu, pred_log_sigma, pred_z_min, pred_z_max = out.view(
+                out.size(0), 4, self.n_dims
+            ).unbind(dim=1)
         else:
-            out = out.view(batch_size, 2, self.n_dims)
-            pred_mu = out[:, 0, :]
-            pred_log_sigma = out[:, 1, :]
+            pred_mu, pred_log_sigma = out.view(out.size(0), 2, self.n_dims).unbind(
+                dim=1
+            )
             pred_z_min = None
             pred_z_max = None
 
@@ -86,7 +84,7 @@ class Normalizer:
          + multiple time series columns (e.g., dataset.time_series_column_names).
       2) Computes row-level dimension-wise (mean,std), then aggregates by context -> group_stats.
       3) Trains a NormalizerModule (ConditioningModule + multi-dim StatsHead) to predict (mu_array, sigma_array).
-      4) Transforms or inverse-transforms data row-by-row, dimension-wise, using the learned model.
+      4) Transforms or inverse-transforms all rows in one batch, dimension-wise, using the learned model.
       5) Can save/load the model checkpoint.
 
     Retains config handling and method signatures from the previous single-dim logic.
@@ -133,32 +131,34 @@ class Normalizer:
         compute global mean, std, then compute z = (x - mu)/std,
         finally get z_min, z_max for each dimension.
         """
-        df = self.dataset.data.copy()
+        df = self.dataset.data
         grouped_stats = {}
 
-        for group_vals, group_df in df.groupby(self.context_vars):
-            dimension_points = [[] for _ in range(self.n_dims)]
-            for _, row in group_df.iterrows():
-                for d, col_name in enumerate(self.time_series_cols):
-                    arr = np.array(row[col_name], dtype=np.float32).flatten()
-                    dimension_points[d].append(arr)
-            for d in range(self.n_dims):
-                dimension_points[d] = np.concatenate(dimension_points[d], axis=0)
-
-            mu_array = np.array(
-                [pts.mean() for pts in dimension_points], dtype=np.float32
-            )
-            std_array = np.array(
-                [pts.std() + 1e-8 for pts in dimension_points], dtype=np.float32
+        # Stack every dimension column once; each group gathers its rows by position
+        dimension_arrays = [
+            stack_timeseries(df[col_name], np.float32).reshape(len(df), -1)
+            for col_name in self.time_series_cols
+        ]
+
+        for group_vals, positions in df.groupby(self.context_vars).indices.items():
+            if not isinstance(group_vals, tuple):
+                group_vals = (group_vals,)
+            # Gather every dimension's points straight into one (n_dims, n_points) array
+            points = np.empty(
+                (self.n_dims, len(positions), dimension_arrays[0].shape[1]),
+                dtype=np.float32,
             )
+            for d, arr in enumerate(dimension_arrays):
+                np.take(arr, positions, axis=0, out=points[d])
+            points = points.reshape(self.n_dims, -1)
 
-            z_min_array = np.zeros_like(mu_array)
-            z_max_array = np.zeros_like(mu_array)
+            mu_array = points.mean(axis=1)
+            std_array = points.std(axis=1) + np.float32(1e-8)
 
             if self.do_scale:
-                for d in range(self.n_dims):
-                    z_vals = (dimension_points[d] - mu_array[d]) / std_array[d]
-                    z_min_array[d], z_max_array[d] = z_vals.min(), z_vals.max()
+                # z is monotonic in x, so its extremes are those of the raw points
+                z_min_array = (points.min(axis=1) - mu_array) / std_array
+                z_max_array = (points.max(axis=1) - mu_array) / std_array
             else:
                 z_min_array = None
                 z_max_array = None
@@ -173,51 +173,35 @@ class Normalizer:
         self.group_stats = grouped_stats
 
     def create_training_dataset(self):
-        data_tuples = []
-        for ctx_tuple, (
-            mu_arr,
-            sigma_arr,
-            zmin_arr,
-            zmax_arr,
-        ) in self.group_stats.items():
-            # If scale=False, zmin_arr, zmax_arr could be None. We'll store zeros or something
-            if self.do_scale and zmin_arr is not None and zmax_arr is not None:
-                data_tuples.append((ctx_tuple, mu_arr, sigma_arr, zmin_arr, zmax_arr))
-            else:
-                data_tuples.append((ctx_tuple, mu_arr, sigma_arr, None, None))
+        """
+        One sample per context group: its codes as a (K,) int64 tensor and its target
+        statistics stacked as a (n_stats, n_dims) float tensor, ordered as mu, sigma
+        and, if do_scale, z_min, z_max. All samples are encoded into two tensors up
+        front.
+        """
+        ctx_tuples = list(self.group_stats.keys())
+        stats = list(self.group_stats.values())
+        n_stats = 4 if self.do_scale else 2
 
         class _TrainSet(Dataset):
-            def __init__(self, samples, context_vars, n_dims, do_scale):
+            def __init__(self, cat_tensor, stats_tensor):
                 super().__init__()
-                self.samples = samples
-                self.context_vars = context_vars
-                self.n_dims = n_dims
-                self.do_scale = do_scale
+                self.cat_tensor = cat_tensor
+                self.stats_tensor = stats_tensor
 
             def __len__(self):
-                return len(self.samples)
+                return len(self.cat_tensor)
 
             def __getitem__(self, idx):
-                ctx_tuple, mu_arr, sigma_arr, zmin_arr, zmax_arr = self.samples[idx]
-                cat_vars_dict = {}
-                for i, var_name in enumerate(self.context_vars):
-                    cat_vars_dict[var_name] = torch.tensor(
-                        ctx_tuple[i], dtype=torch.long
-                    )
-                mu_t = torch.from_numpy(mu_arr).float()
-                sigma_t = torch.from_numpy(sigma_arr).float()
-
-                if self.do_scale and (zmin_arr is not None) and (zmax_arr is not None):
-                    zmin_t = torch.from_numpy(zmin_arr).float()
-                    zmax_t = torch.from_numpy(zmax_arr).float()
-                else:
-                    # If scale=False or they're None
-                    zmin_t = None
-                    zmax_t = None
-
-                return cat_vars_dict, mu_t, sigma_t, zmin_t, zmax_t
-
-        return _TrainSet(data_tuples, self.context_vars, self.n_dims, self.do_scale)
+                return self.cat_tensor[idx], self.stats_tensor[idx]
+
+        cat_tensor = torch.tensor(ctx_tuples, dtype=torch.long).view(
+            len(ctx_tuples), len(self.context_vars)
+        )
+        stats_tensor = torch.from_numpy(
+            np.array([s[:n_stats] for s in stats], dtype=np.float32)
+        ).view(len(stats), n_stats, self.n_dims)
+        return _TrainSet(cat_tensor, stats_tensor)
 
     def train_normalizer(self):
         ds = self.create_training_dataset()
@@ -230,20 +214,17 @@ class Normalizer:
 
         for epoch in range(self.normalizer_cfg.n_epochs):
             epoch_loss = 0.0
-            for batch in loader:
-                cat_vars_dict, mu_t, sigma_t, zmin_t, zmax_t = batch
-
+            for codes, stats in loader:
                 # Move to device
-                for var_name in cat_vars_dict:
-                    cat_vars_dict[var_name] = cat_vars_dict[var_name].to(self.device)
-                mu_t = mu_t.to(self.device)
-                sigma_t = sigma_t.to(self.device)
-
-                if self.do_scale and (zmin_t is not None) and (zmax_t is not None):
-                    zmin_t = zmin_t.to(self.device)
-                    zmax_t = zmax_t.to(self.device)
+                codes = codes.to(self.device)
+                stats = stats.to(self.device)
+                cat_vars_dict = {
+                    var_name: codes[:, i]
+                    for i, var_name in enumerate(self.context_vars)
+                }
+                mu_t, sigma_t = stats[:, 0], stats[:, 1]
 
-                self.optim.zero_grad()
+                self.optim.zero_grad(set_to_none=True)
 
                 pred_mu, pred_sigma, pred_z_min, pred_z_max = self.normalizer_model(
                     cat_vars_dict
@@ -253,15 +234,9 @@ class Normalizer:
                 loss_sigma = F.mse_loss(pred_sigma, sigma_t)
                 total_loss = loss_mu + loss_sigma
 
-                if (
-                    self.do_scale
-                    and pred_z_min is not None
-                    and pred_z_max is not None
-                    and zmin_t is not None
-                    and zmax_t is not None
-                ):
-                    loss_z_min = F.mse_loss(pred_z_min, zmin_t)
-                    loss_z_max = F.mse_loss(pred_z_max, zmax_t)
+                if self.do_scale:
+                    loss_z_min = F.mse_loss(pred_z_min, stats[:, 2])
+                    loss_z_max = F.mse_loss(pred_z_max, stats[:, 3])
                     total_loss += loss_z_min + loss_z_max
 
                 total_loss.backward()
@@ -272,73 +247,110 @@ class Normalizer:
                 f"Epoch {epoch+1}/{self.normalizer_cfg.n_epochs}: Loss={epoch_loss:.4f}"
             )
 
+    def _get_row_stats(self, df: pd.DataFrame, use_model: bool):
+        """
+        Look up (mu, sigma, z_min, z_max) for every row of df in one batch.
+
+        Returns:
+          mu, sigma: (n_rows, n_dims) arrays
+          z_min, z_max: (n_rows, n_dims) arrays if do_scale=True else (None, None)
+        """
+        if use_model:
+            codes = torch.from_numpy(
+                np.ascontiguousarray(df[self.context_vars].to_numpy(dtype=np.int64).T)
+            ).to(self.device, non_blocking=True)
+            cat_vars_dict = {vn: codes[i] for i, vn in enumerate(self.context_vars)}
+
+            with torch.no_grad():
+                pmu, psigma, pzmin, pzmax = self.normalizer_model(cat_vars_dict)
+            mu = pmu.cpu().numpy()
+            sigma = psigma.cpu().numpy()
+            if self.do_scale and pzmin is not None and pzmax is not None:
+                return mu, sigma, pzmin.cpu().numpy(), pzmax.cpu().numpy()
+            return mu, sigma, None, None
+
+        n_categories, bases, packed_keys, stats_matrix = self._group_stats_table()
+        codes = df[self.context_vars].to_numpy(dtype=np.int64)
+        row_idx = packed_keys.get_indexer(codes @ bases)
+        # Out-of-range codes could pack onto another group's key
+        missing = (row_idx < 0) | ((codes < 0) | (codes >= n_categories)).any(axis=1)
+        if missing.any():
+            raise KeyError(tuple(df[self.context_vars].iloc[int(np.argmax(missing))]))
+
+        stats = np.take(stats_matrix, row_idx, axis=1)
+        if self.do_scale:
+            return stats[0], stats[1], stats[2], stats[3]
+        return stats[0], stats[1], None, None
+
+    def _group_stats_table(self):
+        """
+        group_stats as arrays for vectorized row lookups. Every context tuple is packed
+        into one int64 with mixed-radix bases from the category counts. Rebuilt whenever
+        group_stats is replaced.
+
+        Returns:
+          n_categories: (n_context_vars,) category count per context variable
+          bases: (n_context_vars,) packing bases
+          packed_keys: pd.Index of the packed context tuples, in group_stats order
+          stats_matrix: (4 or 2, n_groups, n_dims) [mu, sigma, (z_min, z_max)] per key
+        """
+        if getattr(self, "_stats_table_source", None) is not self.group_stats:
+            n_categories = np.array(
+                [
+                    self.dataset_cfg.conditioning_vars[var_name]
+                    for var_name in self.context_vars
+                ],
+                dtype=np.int64,
+            )
+            bases = np.cumprod(np.concatenate(([1], n_categories[:-1])))
+            n_stats = 4 if self.do_scale else 2
+            keys = np.array(list(self.group_stats.keys()), dtype=np.int64).reshape(
+                len(self.group_stats), len(self.context_vars)
+            )
+            stats_matrix = np.array(
+                [s[:n_stats] for s in self.group_stats.values()], dtype=np.float32
+            ).reshape(len(self.group_stats), n_stats, self.n_dims)
+
+            self._stats_table = (
+                n_categories,
+                bases,
+                pd.Index(keys @ bases),
+                np.ascontiguousarray(stats_matrix.transpose(1, 0, 2)),
+            )
+            self._stats_table_source = self.group_stats
+        return self._stats_table
+
     def transform(self, use_model: bool = False) -> pd.DataFrame:
         df = self.dataset.data.copy()
-        for i, row in df.iterrows():
-            cat_vars_dict = {
-                vn: torch.tensor(
-                    row[vn], dtype=torch.long, device=self.device
-                ).unsqueeze(0)
-                for vn in self.context_vars
-            }
-
-            if use_model:
-                with torch.no_grad():
-                    pmu, psigma, pzmin, pzmax = self.normalizer_model(cat_vars_dict)
-                mu_arr = pmu[0].cpu().numpy()
-                sigma_arr = psigma[0].cpu().numpy()
-                if self.do_scale and pzmin is not None and pzmax is not None:
-                    zmin_arr = pzmin[0].cpu().numpy()
-                    zmax_arr = pzmax[0].cpu().numpy()
-                else:
-                    zmin_arr = None
-                    zmax_arr = None
-            else:
-                ctx_tuple = tuple(row[vn] for vn in self.context_vars)
-                mu_arr, sigma_arr, zmin_arr, zmax_arr = self.group_stats[ctx_tuple]
-
-            for d, col_name in enumerate(self.time_series_cols):
-                arr = np.array(row[col_name], dtype=np.float32)
-                z = (arr - mu_arr[d]) / (sigma_arr[d] + 1e-8)
-                if self.do_scale and (zmin_arr is not None) and (zmax_arr is not None):
-                    rng = (zmax_arr[d] - zmin_arr[d]) + 1e-8
-                    z = (z - zmin_arr[d]) / rng
-                df.at[i, col_name] = z
+        mu_arr, sigma_arr, zmin_arr, zmax_arr = self._get_row_stats(df, use_model)
+
+        # Each step runs in place on the freshly stacked column, so no temporaries of the
+        # column's size are allocated
+        for d, col_name in enumerate(self.time_series_cols):
+            z = stack_timeseries(df[col_name], np.float32)
+            np.subtract(z, mu_arr[:, d, None], out=z)
+            np.divide(z, sigma_arr[:, d, None] + 1e-8, out=z)
+            if self.do_scale and (zmin_arr is not None) and (zmax_arr is not None):
+                rng = (zmax_arr[:, d, None] - zmin_arr[:, d, None]) + 1e-8
+                np.subtract(z, zmin_arr[:, d, None], out=z)
+                np.divide(z, rng, out=z)
+            df[col_name] = list(z)
         return df
 
     def inverse_transform(
         self, df: pd.DataFrame, use_model: bool = True
     ) -> pd.DataFrame:
-        for i, row in df.iterrows():
-            cat_vars_dict = {
-                vn: torch.tensor(
-                    row[vn], dtype=torch.long, device=self.device
-                ).unsqueeze(0)
-                for vn in self.context_vars
-            }
-
-            if use_model:
-                with torch.no_grad():
-                    pmu, psigma, pzmin, pzmax = self.normalizer_model(cat_vars_dict)
-                mu_arr = pmu[0].cpu().numpy()
-                sigma_arr = psigma[0].cpu().numpy()
-                if self.do_scale and pzmin is not None and pzmax is not None:
-                    zmin_arr = pzmin[0].cpu().numpy()
-                    zmax_arr = pzmax[0].cpu().numpy()
-                else:
-                    zmin_arr = None
-                    zmax_arr = None
-            else:
-                ctx_tuple = tuple(row[vn] for vn in self.context_vars)
-                mu_arr, sigma_arr, zmin_arr, zmax_arr = self.group_stats[ctx_tuple]
-
-            for d, col_name in enumerate(self.time_series_cols):
-                z = np.array(row[col_name], dtype=np.float32)
-                if self.do_scale and (zmin_arr is not None) and (zmax_arr is not None):
-                    rng = (zmax_arr[d] - zmin_arr[d]) + 1e-8
-                    z = z * rng + zmin_arr[d]
-                arr_orig = z * (sigma_arr[d] + 1e-8) + mu_arr[d]
-                df.at[i, col_name] = arr_orig
+        mu_arr, sigma_arr, zmin_arr, zmax_arr = self._get_row_stats(df, use_model)
+
+        for d, col_name in enumerate(self.time_series_cols):
+            arr_orig = stack_timeseries(df[col_name], np.float32)
+            if self.do_scale and (zmin_arr is not None) and (zmax_arr is not None):
+                rng = (zmax_arr[:, d, None] - zmin_arr[:, d, None]) + 1e-8
+                np.multiply(arr_orig, rng, out=arr_orig)
+                np.add(arr_orig, zmin_arr[:, d, None], out=arr_orig)
+            np.multiply(arr_orig, sigma_arr[:, d, None] + 1e-8, out=arr_orig)
+            np.add(arr_orig, mu_arr[:, d, None], out=arr_orig)
+            df[col_name] = list(arr_orig)
         return df
 
     def save(self, path: str = None, epoch: int = None):
@@ -361,7 +373,7 @@ class Normalizer:
 
     def load(self, path: str):
         checkpoint = torch.load(
-            path, map_location=torch.device(self.normalizer_cfg.device)
+            path, map_location=torch.device(self.normalizer_cfg.device), mmap=True
         )
         self.normalizer_model.load_state_dict(checkpoint["normalizer_model_state"])
         print(f"Loaded Normalizer from {path}")
@@ -1,3 +1,8 @@
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
 import hydra
 from omegaconf import DictConfig, OmegaConf
 
@@ -6,6 +11,19 @@ from datasets.pecanstreet import PecanStreetDataset
 from eval.evaluator import Evaluator
 
 
+def setup_queue_logging():
+    """
+    Route the root logger through a queue, so logging calls only enqueue their records
+    and the handlers configured by Hydra write them from a background thread.
+    """
+    root = logging.getLogger()
+    log_queue = queue.Queue()
+    listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop)
+
+
 def evaluate_single_dataset_model(cfg: DictConfig):
     if cfg.dataset.name == "pecanstreet":
         dataset = PecanStreetDataset(cfg.dataset)
@@ -18,6 +36,7 @@ def evaluate_single_dataset_model(cfg: DictConfig):
 
 @hydra.main(version_base=None, config_path="config", config_name="config")
 def main(cfg: DictConfig):
+    setup_queue_logging()
     evaluate_single_dataset_model(cfg=cfg)
 
 
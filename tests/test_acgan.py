@@ -0,0 +1,42 @@
+import torch
+import torch.nn.functional as F
+
+from generator.gan.acgan import Discriminator
+
+
+def test_load_per_variable_aux_classifier_state_dict():
+    torch.manual_seed(0)
+    n_categories = {"month": 12, "weekday": 7, "building_type": 3}
+    discriminator = Discriminator(
+        window_length=16,
+        input_dim=2,
+        device="cpu",
+        conditioning_var_n_categories=n_categories,
+        base_channels=32,
+    ).eval()
+
+    # Checkpoints saved before the fusion hold one Linear classifier per variable
+    state_dict = discriminator.state_dict()
+    n_features = state_dict.pop("aux_fc.weight").shape[1]
+    state_dict.pop("aux_fc.bias")
+    for name, num_classes in n_categories.items():
+        state_dict[f"aux_classifiers.{name}.weight"] = torch.randn(
+            num_classes, n_features
+        )
+        state_dict[f"aux_classifiers.{name}.bias"] = torch.randn(num_classes)
+    old_state_dict = dict(state_dict)
+
+    discriminator.load_state_dict(state_dict)
+
+    x = torch.randn(5, 2, 16)
+    with torch.no_grad():
+        _, aux_outputs = discriminator(x)
+        features = discriminator.conv_layers(x).flatten(1)
+    assert aux_outputs.keys() == n_categories.keys()
+    for name in n_categories:
+        expected = F.linear(
+            features,
+            old_state_dict[f"aux_classifiers.{name}.weight"],
+            old_state_dict[f"aux_classifiers.{name}.bias"],
+        )
+        torch.testing.assert_close(aux_outputs[name], expected)
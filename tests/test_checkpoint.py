@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from generator.checkpoint import AsyncCheckpointWriter
+
+
+def test_async_checkpoint_writer_round_trip(tmp_path):
+    writer = AsyncCheckpointWriter()
+    checkpoint = {"epoch": 3, "state": {"weight": torch.arange(6.0).view(2, 3)}}
+
+    writer.save(checkpoint, tmp_path / "checkpoint.pt")
+    writer.wait()
+
+    loaded = torch.load(tmp_path / "checkpoint.pt")
+    assert loaded["epoch"] == 3
+    assert torch.equal(loaded["state"]["weight"], checkpoint["state"]["weight"])
+
+
+def test_async_checkpoint_writer_raises_failed_write_from_wait(tmp_path):
+    writer = AsyncCheckpointWriter()
+
+    writer.save({"weight": torch.ones(2)}, tmp_path / "missing" / "checkpoint.pt")
+
+    with pytest.raises(RuntimeError):
+        writer.wait()
+    # The error is reported once
+    writer.wait()
+
+
+def test_async_checkpoint_writer_raises_failed_write_from_next_save(tmp_path):
+    writer = AsyncCheckpointWriter()
+    writer.save({"weight": torch.ones(2)}, tmp_path / "missing" / "checkpoint.pt")
+
+    with pytest.raises(RuntimeError):
+        writer.save({"weight": torch.ones(2)}, tmp_path / "checkpoint.pt")
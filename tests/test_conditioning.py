@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from sklearn.mixture import GaussianMixture as SklearnGaussianMixture
+
+from generator.conditioning import ConditioningModule, GaussianMixture
+
+
+def _fitted_module(embeddings):
+    module = ConditioningModule(
+        {"a": 3, "b": 4}, embedding_dim=4, device="cpu", n_components=2
+    )
+    module.fit_gmm(embeddings)
+    return module
+
+
+@pytest.mark.parametrize("n", [5, 10, 50, 1000])
+def test_set_rare_threshold_matches_percentile(n):
+    embeddings = torch.randn(n, 4, generator=torch.Generator().manual_seed(n))
+    module = _fitted_module(
+        torch.randn(200, 4, generator=torch.Generator().manual_seed(0))
+    )
+
+    module.set_rare_threshold(embeddings, fraction=0.1)
+
+    log_probs = module.compute_log_likelihood(embeddings).numpy()
+    expected = np.percentile(log_probs, 10)
+    assert module.log_prob_threshold == pytest.approx(expected, rel=1e-12)
+    assert module.is_rare(embeddings).sum().item() == (log_probs < expected).sum()
+    assert module.is_rare(embeddings).any()
+
+
+def _clustered_data(seed=0):
+    rng = np.random.default_rng(seed)
+    centers = np.array([[0.0, 0.0, 0.0], [8.0, 0.0, 0.0], [0.0, 8.0, 0.0]])
+    return np.concatenate(
+        [rng.normal(center, [1.0, 0.5, 2.0], size=(300, 3)) for center in centers]
+    )
+
+
+def test_gmm_log_likelihood_matches_sklearn():
+    X = _clustered_data()
+    module = ConditioningModule({"a": 3}, embedding_dim=3, device="cpu", n_components=3)
+    module.fit_gmm(torch.as_tensor(X))
+    reference = SklearnGaussianMixture(3, random_state=0).fit(X)
+
+    np.testing.assert_allclose(
+        module.compute_log_likelihood(torch.as_tensor(X)).numpy(),
+        reference.score_samples(X),
+        rtol=1e-8,
+    )
+
+    module.set_rare_threshold(torch.as_tensor(X), fraction=0.1)
+    assert module.log_prob_threshold == pytest.approx(
+        np.percentile(reference.score_samples(X), 10), rel=1e-8
+    )
+
+
+def test_gmm_single_component_matches_sklearn():
+    X = torch.as_tensor(_clustered_data())
+
+    gmm = GaussianMixture(n_components=1).fit(X)
+    reference = SklearnGaussianMixture(1).fit(X.numpy())
+
+    np.testing.assert_allclose(gmm.weights_.numpy(), [1.0])
+    np.testing.assert_allclose(gmm.means_.numpy(), reference.means_, rtol=1e-10)
+    np.testing.assert_allclose(
+        gmm.covariances_.numpy(), reference.covariances_, rtol=1e-10
+    )
+
+
+def test_gmm_degenerate_covariance_matches_sklearn():
+    # A constant feature leaves only reg_covar on its covariance diagonal
+    X = _clustered_data()
+    X[:, 2] = 1.0
+    module = ConditioningModule({"a": 3}, embedding_dim=3, device="cpu", n_components=1)
+    module.fit_gmm(torch.as_tensor(X))
+
+    log_probs = module.compute_log_likelihood(torch.as_tensor(X)).numpy()
+
+    assert np.isfinite(log_probs).all()
+    np.testing.assert_allclose(
+        log_probs, SklearnGaussianMixture(1).fit(X).score_samples(X), rtol=1e-8
+    )
+
+
+def _old_layout_state_dict(categorical_dims, embedding_dim, prefix=""):
+    generator = torch.Generator().manual_seed(0)
+    state_dict = {
+        f"{prefix}category_embeddings.{name}.weight": torch.randn(
+            num_categories, embedding_dim, generator=generator
+        )
+        for name, num_categories in categorical_dims.items()
+    }
+    total_dim = len(categorical_dims) * embedding_dim
+    state_dict[f"{prefix}mlp.0.weight"] = torch.randn(
+        128, total_dim, generator=generator
+    )
+    state_dict[f"{prefix}mlp.0.bias"] = torch.randn(128, generator=generator)
+    state_dict[f"{prefix}mlp.2.weight"] = torch.randn(
+        2 * embedding_dim, 128, generator=generator
+    )
+    state_dict[f"{prefix}mlp.2.bias"] = torch.randn(
+        2 * embedding_dim, generator=generator
+    )
+    return state_dict
+
+
+def _old_layout_forward(state_dict, categorical_vars, prefix=""):
+    conditioning_matrix = torch.cat(
+        [
+            F.embedding(codes, state_dict[f"{prefix}category_embeddings.{name}.weight"])
+            for name, codes in categorical_vars.items()
+        ],
+        dim=1,
+    )
+    hidden = F.relu(
+        F.linear(
+            conditioning_matrix,
+            state_dict[f"{prefix}mlp.0.weight"],
+            state_dict[f"{prefix}mlp.0.bias"],
+        )
+    )
+    return F.linear(
+        hidden, state_dict[f"{prefix}mlp.2.weight"], state_dict[f"{prefix}mlp.2.bias"]
+    )
+
+
+@pytest.mark.parametrize("prefix", ["", "conditioning_module."])
+def test_load_old_layout_state_dict(prefix):
+    categorical_dims = {"month": 12, "weekday": 7, "building_type": 3}
+    embedding_dim = 4
+    state_dict = _old_layout_state_dict(categorical_dims, embedding_dim, prefix)
+    categorical_vars = {
+        name: torch.arange(10) % num_categories
+        for name, num_categories in categorical_dims.items()
+    }
+    expected = _old_layout_forward(state_dict, categorical_vars, prefix)
+
+    module = ConditioningModule(categorical_dims, embedding_dim, device="cpu")
+    if prefix:
+        parent = nn.Module()
+        parent.conditioning_module = module
+        parent.load_state_dict(dict(state_dict))
+    else:
+        module.load_state_dict(dict(state_dict))
+
+    with torch.no_grad():
+        _, mu, logvar = module(categorical_vars, sample=False)
+    torch.testing.assert_close(mu, expected[:, :embedding_dim])
+    torch.testing.assert_close(logvar, expected[:, embedding_dim:])
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from datasets.utils import PrefetchLoader, encode_conditioning_variables
+
+
+class _DictDataset(Dataset):
+    def __init__(self, n):
+        self.timeseries = torch.arange(n * 6, dtype=torch.float32).view(n, 3, 2)
+        self.codes = torch.arange(n) % 4
+
+    def __len__(self):
+        return len(self.timeseries)
+
+    def __getitem__(self, idx):
+        return self.timeseries[idx], {"month": self.codes[idx], "weekday": idx}
+
+
+@pytest.mark.parametrize(
+    "device",
+    [
+        "cpu",
+        pytest.param(
+            "cuda",
+            marks=pytest.mark.skipif(
+                not torch.cuda.is_available(), reason="CUDA is not available"
+            ),
+        ),
+    ],
+)
+def test_prefetch_loader_yields_loader_batches(device):
+    # Ten samples in batches of four leave a partial last batch
+    loader = DataLoader(_DictDataset(10), batch_size=4, shuffle=False)
+    prefetch_loader = PrefetchLoader(loader, device)
+
+    batches = list(prefetch_loader)
+
+    expected = list(loader)
+    assert len(batches) == len(expected) == len(prefetch_loader) == 3
+    for (timeseries, conditioning), (expected_ts, expected_cond) in zip(
+        batches, expected
+    ):
+        assert timeseries.device.type == device
+        assert torch.equal(timeseries.cpu(), expected_ts)
+        assert conditioning.keys() == expected_cond.keys()
+        for name, codes in conditioning.items():
+            assert codes.device.type == device
+            assert torch.equal(codes.cpu(), expected_cond[name])
+    assert batches[-1][0].shape[0] == 2
+
+
+def test_prefetch_loader_passes_through_sampler():
+    loader = DataLoader(_DictDataset(10), batch_size=4, shuffle=True)
+
+    prefetch_loader = PrefetchLoader(loader, "cpu")
+
+    assert prefetch_loader.sampler is loader.sampler
+    assert len(prefetch_loader) == len(loader)
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        # Minimum, maximum, every inner bin edge and values just around them
+        [0.0, 8.0, 2.0, 4.0, 6.0, 1.999, 2.001, 5.5, 7.999, np.nan],
+        [-3.5, 10.25, 0.0, 3.375, -3.5, 10.25],
+        [5.0, 5.0, 5.0],
+    ],
+)
+def test_numeric_binning_matches_pd_cut(values):
+    data = pd.DataFrame({"total_square_footage": values})
+
+    encoded_data, mapping = encode_conditioning_variables(
+        data, ["total_square_footage"], bins=4
+    )
+
+    binned = pd.cut(data["total_square_footage"], bins=4, include_lowest=True)
+    np.testing.assert_array_equal(
+        encoded_data["total_square_footage"].to_numpy(), binned.cat.codes.to_numpy()
+    )
+    assert mapping["total_square_footage"] == {
+        code: str(interval) for code, interval in enumerate(binned.cat.categories)
+    }
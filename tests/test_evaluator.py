@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import torch
+
+from eval.evaluator import _split_by_rarity
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float64])
+@pytest.mark.parametrize("n", range(1, 11))
+def test_split_by_rarity_matches_quantile(n, dtype):
+    generator = torch.Generator().manual_seed(n)
+    rarity_scores = torch.randn(n, generator=generator, dtype=dtype)
+
+    rare_indices, non_rare_indices = _split_by_rarity(rarity_scores)
+
+    expected = (rarity_scores > torch.quantile(rarity_scores, 0.8)).numpy()
+    np.testing.assert_array_equal(rare_indices, np.flatnonzero(expected))
+    np.testing.assert_array_equal(non_rare_indices, np.flatnonzero(~expected))
+
+
+def test_split_by_rarity_small_input_has_rare_samples():
+    rare_indices, non_rare_indices = _split_by_rarity(
+        torch.tensor([0.3, 2.0, 0.1], dtype=torch.float64)
+    )
+
+    np.testing.assert_array_equal(rare_indices, [1])
+    np.testing.assert_array_equal(non_rare_indices, [0, 2])
+
+
+def test_split_by_rarity_with_ties():
+    rarity_scores = torch.tensor([1.0, 1.0, 1.0, 1.0, 5.0, 5.0])
+
+    rare_indices, _ = _split_by_rarity(rarity_scores)
+
+    expected = rarity_scores > torch.quantile(rarity_scores, 0.8)
+    np.testing.assert_array_equal(rare_indices, np.flatnonzero(expected.numpy()))
@@ -0,0 +1,110 @@
+from functools import partial
+
+import numpy as np
+import pytest
+from dtaidistance import dtw
+
+from eval.loss import gaussian_kernel_matrix, maximum_mean_discrepancy
+from eval.metrics import EmbeddingCache, calculate_mmd, dynamic_time_warping_dist
+
+
+def _pairwise_dtw(X, Y):
+    X, Y = X.astype(np.float64), Y.astype(np.float64)
+    return np.array(
+        [
+            np.sqrt(
+                sum(
+                    dtw.distance(x[:, dim], y[:, dim]) ** 2 for dim in range(X.shape[2])
+                )
+            )
+            for x, y in zip(X, Y)
+        ]
+    )
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2, 3])
+def test_dynamic_time_warping_dist_matches_pairwise(n_jobs):
+    rng = np.random.default_rng(0)
+    # Seven series split unevenly across the worker blocks
+    X = rng.normal(size=(7, 12, 2)).astype(np.float32)
+    Y = rng.normal(size=(7, 12, 2)).astype(np.float32)
+
+    mean, std = dynamic_time_warping_dist(X, Y, n_jobs=n_jobs)
+
+    distances = _pairwise_dtw(X, Y)
+    assert mean == pytest.approx(distances.mean(), rel=1e-10)
+    assert std == pytest.approx(distances.std(), rel=1e-10)
+
+
+def test_dynamic_time_warping_dist_empty_input():
+    X = np.empty((0, 12, 2))
+
+    mean, std = dynamic_time_warping_dist(X, X)
+
+    assert np.isnan(mean) and np.isnan(std)
+
+
+class _CountingEmbeddingCache(EmbeddingCache):
+    def __init__(self, max_entries):
+        super().__init__(max_entries)
+        self.trained = []
+
+    def _train(self, ori_data):
+        self.trained.append(ori_data)
+        return len(self.trained)
+
+    @staticmethod
+    def _encode(model, data):
+        return data + model
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = _CountingEmbeddingCache(max_entries=2)
+    ori_data, generated_data = np.zeros((4, 3, 1)), np.ones((4, 3, 1))
+
+    for key in ["a", "b", "a", "c", "a", "b"]:
+        cache.get_or_train(key, ori_data, generated_data)
+
+    # "b" was the least recently used entry when "c" was added
+    assert len(cache.trained) == 4
+    assert list(cache._entries) == ["a", "b"]
+
+
+def test_embedding_cache_reuses_encoder():
+    cache = _CountingEmbeddingCache(max_entries=1)
+    ori_data, generated_data = np.zeros((4, 3, 1)), np.ones((4, 3, 1))
+
+    first = cache.get_or_train("a", ori_data, generated_data)
+    second = cache.get_or_train("a", ori_data, 2 * generated_data)
+
+    assert len(cache.trained) == 1
+    np.testing.assert_array_equal(second[0], first[0])
+    np.testing.assert_array_equal(second[1], 2 * generated_data + 1)
+
+
+def _reference_mmd(X, Y):
+    kernel = partial(gaussian_kernel_matrix, sigmas=np.array([1]))
+    discrepancies = [
+        np.sqrt(
+            sum(
+                maximum_mean_discrepancy(x[:, dim, None], y[:, dim, None], kernel) ** 2
+                for dim in range(X.shape[2])
+            )
+        )
+        for x, y in zip(X, Y)
+    ]
+    return np.mean(discrepancies), np.std(discrepancies)
+
+
+@pytest.mark.parametrize("n_timeseries", [1, 5, 130])
+def test_calculate_mmd_matches_per_series_reference(n_timeseries):
+    rng = np.random.default_rng(n_timeseries)
+    # 130 series of length 24 with two dimensions span three chunks
+    X = rng.normal(size=(n_timeseries, 24, 2)).astype(np.float32)
+    Y = rng.normal(0.5, 1.5, size=(n_timeseries, 24, 2)).astype(np.float32)
+
+    mean, std = calculate_mmd(X, Y)
+
+    expected_mean, expected_std = _reference_mmd(X, Y)
+    assert mean == pytest.approx(expected_mean, rel=1e-6)
+    assert std == pytest.approx(expected_std, rel=1e-6, abs=1e-12)